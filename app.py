@@ -1,45 +1,232 @@
-from flask import Flask
+import contextvars
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed
+from functools import partial
+
+from flask import Flask, Response, request
 from flask_restful import Api, Resource
 
-from bitbucket_api import BitbucketAPI, get_bitbucket_stats
-from github_api import GithubAPI, get_github_stats
-from util import aggregate_git_accounts
+from async_api import github_stats_view, bitbucket_stats_view, merged_stats_view
+from bitbucket_api import BitbucketAPI, get_bitbucket_stats, iter_bitbucket_stats, BITBUCKET_STATS_KEYS
+from cache import CacheAPI, get_cached_stats
+from coalesce import new_batch_context
+from github_api import GithubAPI, get_github_stats, iter_github_stats, GITHUB_STATS_KEYS
+from metrics import MetricsAPI, init_app
+from options import get_request_options, select_fields
+from profiling import profile_request
+from refresher import WarmAPI, serve_stats, get_age_headers
+from responses import serve_serialized
+from streaming import stream_response, stream_provider_stats, merge_provider_streams, merge_streamed_stats
+from util import merge_provider_stats, get_max_workers, is_truthy, BoundedExecutor, ProviderBusyError, GITHUB_TIMEOUT, \
+    BITBUCKET_TIMEOUT, BATCH_MAX_USERS, BATCH_MAX_WORKERS, PROVIDER_MAX_WORKERS
 
 app = Flask(__name__)
 api = Api(app)
 
+# time and count every request - exposed on /metrics
+init_app(app)
+
+# runs the github and bitbucket pipelines side by side - two per in-flight merged request, a timed out pipeline keeps
+# its slot until it finishes (its stats still land in the cache) but never makes a new request queue behind it
+provider_pool = BoundedExecutor(max_workers=PROVIDER_MAX_WORKERS)
+
+# runs the provider pipelines of every batch - shared so batches together stay bounded
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS)
+
+
+def submit_provider(func, *args):
+    """
+    Given a provider pipeline start it in a copy of the request's context
+    :param func: function returning the provider stats and their age - ex: serve_stats
+    :return: future holding the provider stats and their age - a message dict (no age) right away if every slot is taken
+    """
+
+    try:
+        return provider_pool.submit(contextvars.copy_context().run, func, *args)
+
+    except ProviderBusyError as e:
+        future = Future()
+        future.set_result(({'message': str(e)}, None))
+        return future
+
+
+def get_provider_result(future, started, timeout, provider):
+    """
+    Wait on a provider's stats for whatever is left of its timeout
+    :param future: future holding the provider stats
+    :param started: time.monotonic() the provider was submitted at
+    :param timeout: seconds the provider is allowed in total
+    :param provider: provider name used in the message - Github or Bitbucket
+    :return: provider stats and their age, or a message dict (no age) when the provider ran out of time
+    """
+
+    remaining = max(0, timeout - (time.monotonic() - started))
+
+    try:
+        return future.result(timeout=remaining)
+    except TimeoutError:
+        # leave it running in the background - the other provider's result is still returned
+        return {'message': "{} did not respond within {} seconds".format(provider, timeout)}, None
+
 
 class MergedAPI(Resource):  # aggregate data from given github and bitbucket users
 
     def get(self, gh_user, bb_user):
 
-        gh_data = get_github_stats(gh_user)     # get github stats
-        bb_data = get_bitbucket_stats(bb_user)      # get bitbucket stats
+        # query string options - ex: ?workers=4&nocache=1&stream=ndjson&fields=followers,repos
+        try:
+            options = get_request_options(request.args, GITHUB_STATS_KEYS)
+        except ValueError as e:
+            return {'message': str(e)}, 400
 
-        if 'message' not in gh_data.keys() and 'message' not in bb_data.keys():
-            # aggregate stats - github & bitbucket
-            result = {
-                'data': aggregate_git_accounts(gh_data, bb_data)
-            }
+        max_workers, bypass, fields = options['max_workers'], options['bypass'], options['fields']
 
-        elif 'message' in gh_data.keys() and 'message' not in bb_data.keys():
-            result = {
-                'message': "Check Github user, could not aggregate with Bitbucket user",
-                'bitbucket_data': bb_data
-            }
+        # github reports every stat - bitbucket only computes the ones it has
+        bb_fields = select_fields(fields, BITBUCKET_STATS_KEYS)
 
-        elif 'message' in bb_data.keys() and 'message' not in gh_data.keys():
-            result = {
-                'message': "Check Bitbucket user, could not aggregate with Github user",
-                'github_data': gh_data
-            }
+        # send each provider's stats as soon as they are computed
+        if options['stream_format']:
+            return stream_response(stream_merged_stats(gh_user, bb_user, max_workers, bypass, fields, bb_fields),
+                                   options['stream_format'])
+
+        with profile_request(options['profile']) as profile:
+
+            # run both providers at the same time - each through the stats cache, in a copy of the request's context
+            started = time.monotonic()
+            gh_future = submit_provider(serve_stats, 'github', gh_user,
+                                        partial(get_github_stats, gh_user, max_workers, fields), bypass, fields)
+            bb_future = submit_provider(serve_stats, 'bitbucket', bb_user,
+                                        partial(get_bitbucket_stats, bb_user, max_workers, bb_fields), bypass, bb_fields)
+
+            gh_data, gh_age = get_provider_result(gh_future, started, GITHUB_TIMEOUT, 'Github')
+            bb_data, bb_age = get_provider_result(bb_future, started, BITBUCKET_TIMEOUT, 'Bitbucket')
+
+            result = merge_provider_stats(gh_data, bb_data)
+
+        # ?profile=1 - where the time went, both providers together
+        if profile:
+            result['profile'] = profile.report()
+
+        # serialized once while the cache hands out the same stats of both providers - X-Stats-Age is the older of them
+        return serve_serialized(('merged', gh_user, bb_user, fields), [gh_data, bb_data], lambda: result,
+                                get_age_headers(gh_age, bb_age), cache=not profile)
+
+
+def stream_merged_stats(gh_user, bb_user, max_workers, bypass, gh_fields=None, bb_fields=None):
+    """
+    Given github and bitbucket users send each provider's stats as they are computed, then the aggregated stats
+    :param gh_user: github user
+    :param bb_user: bitbucket user
+    :param max_workers: max number of per-repo calls in flight per provider
+    :param bypass: skip the cached stats and refresh them
+    :param gh_fields: github stats wanted, default is None meaning all of them
+    :param bb_fields: bitbucket stats wanted, default is None meaning all of them
+    :return: generator of {'provider': ..., 'stat': ..., 'value': ...} events, ends with the aggregated stats
+    """
+
+    streams = {
+        'github': stream_provider_stats('github', gh_user, partial(iter_github_stats, gh_user, max_workers, gh_fields),
+                                        GITHUB_STATS_KEYS, bypass, gh_fields),
+        'bitbucket': stream_provider_stats('bitbucket', bb_user,
+                                           partial(iter_bitbucket_stats, bb_user, max_workers, bb_fields),
+                                           BITBUCKET_STATS_KEYS, bypass, bb_fields)
+    }
+
+    timeouts = {'github': GITHUB_TIMEOUT, 'bitbucket': BITBUCKET_TIMEOUT}
 
+    return merge_streamed_stats(merge_provider_streams(streams, timeouts, provider_pool))
+
+
+class BatchAPI(Resource):   # stats for many github/bitbucket users at once
+
+    def post(self):
+        """
+        Given a list of github/bitbucket user pairs stream back each user's stats as it finishes, newline delimited json
+        body: {"users": [{"github": "gh_user", "bitbucket": "bb_user"}, {"github": "gh_user"}, ...]}
+        :return: one json line per pair - {"index": 0, "github": ..., "bitbucket": ..., "result": {...}}
+        """
+
+        users = (request.get_json(silent=True) or {}).get('users')
+
+        # check the body
+        if not isinstance(users, list) or not users:
+            return {'message': "Body must be json with a non-empty list of users"}, 400
+
+        if len(users) > BATCH_MAX_USERS:
+            return {'message': "Too many users, at most {} per batch".format(BATCH_MAX_USERS)}, 400
+
+        if not all(isinstance(pair, dict) and (pair.get('github') or pair.get('bitbucket')) for pair in users):
+            return {'message': "Each user must have a github and/or a bitbucket user"}, 400
+
+        # optional per-request concurrency limit - ex: ?workers=4
+        try:
+            max_workers = get_max_workers(request.args.get('workers'))
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        # ?nocache=1 skips the cached stats and refreshes them
+        bypass = is_truthy(request.args.get('nocache'))
+
+        return Response(stream_batch_stats(users, max_workers, bypass), mimetype='application/x-ndjson')
+
+
+def stream_batch_stats(users, max_workers, bypass):
+    """
+    Given a list of github/bitbucket user pairs compute every provider's stats on the shared batch pool, identical upstream calls made once
+    :param users: list of {"github": gh_user, "bitbucket": bb_user}
+    :param max_workers: max number of per-repo calls in flight per provider
+    :param bypass: skip the cached stats and refresh them
+    :return: generator of json lines - as each pair finishes
+    """
+
+    # every task of this batch shares one batch scope
+    context = new_batch_context()
+
+    # future -> (index, provider) - one task per provider per pair, all on the shared bounded pool
+    futures = {}
+    for index, pair in enumerate(users):
+        if pair.get('github'):
+            compute = partial(get_github_stats, pair['github'], max_workers)
+            future = batch_pool.submit(context.copy().run, get_cached_stats, 'github', pair['github'], compute, bypass)
+            futures[future] = (index, 'github')
+
+        if pair.get('bitbucket'):
+            compute = partial(get_bitbucket_stats, pair['bitbucket'], max_workers)
+            future = batch_pool.submit(context.copy().run, get_cached_stats, 'bitbucket', pair['bitbucket'], compute, bypass)
+            futures[future] = (index, 'bitbucket')
+
+    # index -> provider -> stats - collected until the pair is complete
+    done = {}
+
+    for future in as_completed(futures):
+        index, provider = futures[future]
+        pair = users[index]
+
+        try:
+            stats = future.result()
+        except Exception as e:
+            stats = {'message': "Could not get {} stats: {}".format(provider, e)}
+
+        done.setdefault(index, {})[provider] = stats
+
+        # wait on the other provider of the pair
+        if len(done[index]) < len([key for key in ['github', 'bitbucket'] if pair.get(key)]):
+            continue
+
+        pair_stats = done.pop(index)
+
+        # both users - aggregate them, otherwise just the one provider's stats
+        if len(pair_stats) == 2:
+            result = merge_provider_stats(pair_stats['github'], pair_stats['bitbucket'])
         else:
             result = {
-                'messsage': "Check Github and Bitbucket user, could not aggregate the users"
+                'data': pair_stats[provider]
             }
 
-        return result
+        yield json.dumps({'index': index, 'github': pair.get('github'), 'bitbucket': pair.get('bitbucket'),
+                          'result': result}) + '\n'
+
 
 # route to get just github stats
 api.add_resource(GithubAPI, '/stats/github/<gh_user>')
@@ -47,10 +234,27 @@ api.add_resource(GithubAPI, '/stats/github/<gh_user>')
 # route to get just bitbucket stats
 api.add_resource(BitbucketAPI, '/stats/bitbucket/<bb_user>')
 
+# route to get the stats cache counters
+api.add_resource(CacheAPI, '/cache/stats')
+
+# route to get the prometheus metrics
+api.add_resource(MetricsAPI, '/metrics')
+
+# route to get the hot users kept warm - admins only, off unless ADMIN_TOKEN is set
+api.add_resource(WarmAPI, '/admin/warm')
+
+# route to get stats for many users at once
+api.add_resource(BatchAPI, '/stats/batch')
+
 # route to get both stats
 api.add_resource(MergedAPI, '/stats/github/<gh_user>/bitbucket/<bb_user>',
                  '/stats/github/<string:gh_user>/bitbucket/<string:bb_user>')
 
+# async routes - same stats, every upstream call of a request driven from one event loop
+app.add_url_rule('/async/stats/github/<gh_user>', view_func=github_stats_view)
+app.add_url_rule('/async/stats/bitbucket/<bb_user>', view_func=bitbucket_stats_view)
+app.add_url_rule('/async/stats/github/<gh_user>/bitbucket/<bb_user>', view_func=merged_stats_view)
+
 # run it
 if __name__ == "__main__":
     app.run(port=5002)
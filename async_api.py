@@ -0,0 +1,1102 @@
+import asyncio
+import atexit
+import json
+import math
+import queue
+import threading
+import time
+from functools import partial
+from urllib.parse import urlsplit
+
+import aiohttp
+from flask import request
+
+from bitbucket_api import build_bitbucket_url, build_bitbucket_page_url, build_bitbucket_size_url, \
+    build_bitbucket_commits_url, build_bitbucket_open_issues_url, is_original_repo, get_bitbucket_repo_table, \
+    BITBUCKET_REPO_FIELDS, BITBUCKET_STATS_KEYS, BITBUCKET_STATS_COST_ORDER
+from cache import stats_cache, get_stats_key, github_response_cache, CachedResponse
+from coalesce import AsyncFlight
+from github_api import build_github_request, get_github_pagination, cleaned_repos_data, project_repos, \
+    GITHUB_PER_PAGE, GITHUB_STATS_KEYS, GITHUB_STATS_COST_ORDER
+from metrics import observe_upstream
+from options import get_request_options, select_fields
+from profiling import profile_request, record_pages
+from ratelimit import scheduler, request_priority, RateLimitError
+from refresher import get_age_headers
+from repo_store import repo_store, get_repo_version
+from repo_table import RepoTable
+from responses import serve_serialized
+from streaming import stream_response, iter_events, iter_provider_events, merge_streamed_stats
+from transport import DEFAULT_HEADERS, HOST_AUTH, get_credential
+from util import flatten_list, count_items_in_list, collect_stats, merge_provider_stats, select_stats, \
+    set_query_params, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, ASYNC_HOST_CONCURRENCY, GITHUB_TIMEOUT, \
+    BITBUCKET_TIMEOUT, RATE_LIMIT_RETRIES, MAX_WORKERS
+
+
+class AsyncResponse(object):
+    """
+    Upstream response read off of the event loop - only what the callers read off of a requests response
+    """
+
+    def __init__(self, status_code, headers, content):
+        """
+        :param status_code: http status
+        :param headers: response headers
+        :param content: raw body
+        """
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        """
+        Parse the body
+        :return: json body
+        """
+
+        return json.loads(self.content)
+
+
+class AsyncClient(object):
+    """
+    Event loop http client - one keep-alive session, at most ASYNC_HOST_CONCURRENCY calls in flight per upstream host
+    """
+
+    def __init__(self, host_concurrency=ASYNC_HOST_CONCURRENCY):
+        """
+        :param host_concurrency: max number of calls in flight per upstream host
+        """
+        self.host_concurrency = host_concurrency
+
+        # host -> semaphore
+        self.limits = {}
+        self.session = None
+
+    async def __aenter__(self):
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(headers=DEFAULT_HEADERS, timeout=timeout,
+                                             connector=aiohttp.TCPConnector(limit=0))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get(self, url, headers=None):
+        """
+        Given a url make a GET request with the host's default auth - paced by the rate limit scheduler, waiting for a
+        free slot on the host, rate limited calls are retried after backing off
+        :param url: full url
+        :param headers: extra headers for this call
+        :return: response
+        """
+
+        host = urlsplit(url).netloc
+
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.host_concurrency)
+
+        # auth based on the host being hit
+        auth = HOST_AUTH.get(host)
+        credential = get_credential(auth)
+        if auth:
+            auth = aiohttp.BasicAuth(*auth)
+
+        priority = request_priority.get()
+
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+
+            # wait for quota without holding a thread - raises RateLimitError when it would take too long
+            await scheduler.acquire_async(host, credential, priority)
+
+            async with self.limits[host]:
+                with observe_upstream(url) as call:
+                    async with self.session.get(url, headers=headers, auth=auth) as r:
+                        response = AsyncResponse(r.status, r.headers, await r.read())
+                    call.record(response.status_code, len(response.content))
+
+            # record the quota left, back off and retry if rate limited
+            if not scheduler.update(host, credential, response.status_code, response.headers):
+                return response
+
+        raise RateLimitError("Rate limit for {} exhausted after {} retries".format(host, RATE_LIMIT_RETRIES))
+
+
+class AsyncLoop(object):
+    """
+    One event loop on its own daemon thread and one client on it - every async request's upstream calls share the
+    connections and the per-host limits
+    """
+
+    def __init__(self, host_concurrency=ASYNC_HOST_CONCURRENCY):
+        """
+        :param host_concurrency: max number of calls in flight per upstream host, all requests together
+        """
+        self.host_concurrency = host_concurrency
+        self.loop = None
+        self.client = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the loop and open the client - once, on first use
+        """
+
+        with self.lock:
+            if self.loop is not None:
+                return
+
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+
+            # the session belongs to the loop it is opened on
+            self.client = asyncio.run_coroutine_threadsafe(AsyncClient(self.host_concurrency).__aenter__(), loop).result()
+            self.loop = loop
+
+            # close the keep-alive connections on the way out
+            atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """
+        Close the client and stop the loop
+        :param timeout: max seconds to wait for the client to close
+        """
+
+        with self.lock:
+            if self.loop is None:
+                return
+
+            loop, client = self.loop, self.client
+            self.loop = self.client = None
+
+        try:
+            asyncio.run_coroutine_threadsafe(client.__aexit__(None, None, None), loop).result(timeout)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+
+    def submit(self, func, *args):
+        """
+        Given a coroutine function run it on the loop with the shared client - in a copy of the caller's context
+        :param func: coroutine function taking the client then args - ex: get_cached_stats
+        :return: concurrent future holding its result
+        """
+
+        self.start()
+
+        return asyncio.run_coroutine_threadsafe(func(self.client, *args), self.loop)
+
+
+# process wide event loop - every async route runs its upstream calls on it
+async_loop = AsyncLoop()
+
+# single flights on the shared loop - concurrent requests for the same user stats, concurrent calls to the same url
+stats_flight = AsyncFlight()
+url_flight = AsyncFlight()
+
+
+async def gather_all(*aws):
+    """
+    Given awaitables wait for all of them at once - the first error cancels the rest instead of leaving them running
+    :param aws: awaitables
+    :return: list of their results in the same order
+    """
+
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+
+    try:
+        return await asyncio.gather(*tasks)
+
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def bounded(limit, aw):
+    """
+    Given a request's limit and an awaitable wait for it once the limit lets it through - ?workers= per request
+    :param limit: semaphore of the request
+    :param aw: awaitable
+    :return: its result
+    """
+
+    async with limit:
+        return await aw
+
+
+async def cancel_tasks(tasks):
+    """
+    Given tasks a pipeline started cancel the ones still running - ex: the stats were not all gone through
+    :param tasks: list of tasks
+    """
+
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# github
+
+
+async def fetch_github_response(client, url, headers, project=None):
+    """
+    Given a url and headers make the request, revalidating the stored response if there is one - same stored responses
+    as the threaded routes
+    :param client: async client
+    :param url: full url
+    :param headers: request headers - must have the Accept
+    :param project: function taking the parsed body returning only what is read of it - ex: project_repos, default is
+    None meaning the whole body
+    :return: response
+    """
+
+    # revalidate the stored response if there is one - 304s do not count against the rate limit
+    key = (url, headers['Accept'])
+    r = await client.get(url, headers=dict(headers, **github_response_cache.validators(key)))
+
+    # not modified - serve the stored body (refetch in full if it was evicted in the meantime)
+    if r.status_code == 304:
+        r = github_response_cache.revalidated(key) or await client.get(url, headers=headers)
+
+    # new or changed - parse once and keep it for the next revalidation
+    if r.status_code == 200 and not isinstance(r, CachedResponse):
+        r = github_response_cache.store(key, r, project)
+
+    return r
+
+
+async def get_github_data(client, path):
+    """
+    Given path extract the endpoint data, provide the appropriate Accept return the request and the endpoint
+    :param client: async client
+    :param path: endpoint
+    :return: result - request, endpoint
+    """
+
+    url, headers, endpoint = build_github_request(path)
+
+    # repo listings are kept with only the repo keys the stats read
+    project = project_repos if endpoint == 'repos' else None
+
+    # identical calls in flight are made once
+    r = await url_flight.do(('github', url, headers['Accept']),
+                            partial(fetch_github_response, client, url, headers, project))
+
+    result = {
+        'result': r,
+        'endpoint': endpoint
+    }
+
+    return result
+
+
+async def page_thru_github_data_count(client, path):
+    """
+    Given a path/endpoint return the count of all of the data without downloading it - one item per page so the last page number is the count
+    :param client: async client
+    :param path: commits or starred endpoint
+    :return: counts
+    """
+
+    result = 0
+
+    r = (await get_github_data(client, set_query_params(path, per_page=1)))['result']
+
+    if r.status_code == 200:
+        last_url, last_page = get_github_pagination(r.headers.get('Link'))
+        result = last_page if last_url else len(r.json())
+
+    return result
+
+
+async def get_github_page_json(client, url):
+    """
+    Given a page url grab its json data, fail loudly if it could not be grabbed - an error body is not a page of data
+    :param client: async client
+    :param url: page url
+    :return: json data
+    """
+
+    r = (await get_github_data(client, url))['result']
+
+    if r.status_code != 200:
+        raise ValueError("Could not grab {}".format(url))
+
+    return r.json()
+
+
+async def page_thru_github_data_json(client, path, limit):
+    """
+    Given a path, page through all of the pages at once and return all of the data as a flattened json
+    :param client: async client
+    :param path: any list endpoint or a single object such as the user profile
+    :param limit: semaphore bounding the request's calls in flight
+    :return: flattened json - nothing if the data could not be grabbed
+    """
+
+    r = (await get_github_data(client, set_query_params(path, per_page=GITHUB_PER_PAGE)))['result']
+
+    if r.status_code != 200:
+        return []
+
+    result = r.json()
+    last_url, last_page = get_github_pagination(r.headers.get('Link'))
+
+    record_pages('github', last_page)
+
+    if last_url:
+        pages = await gather_all(*[bounded(limit, get_github_page_json(client, set_query_params(last_url, page=page)))
+                                   for page in range(2, last_page+1)])
+        result = flatten_list([result] + pages)
+
+    return result
+
+
+async def get_repo_topics(client, path):
+    """
+    Given a repo topics path grab the list of topic names
+    :param client: async client
+    :param path: repos/<full_name>/topics
+    :return: list of topic names
+    """
+
+    return (await get_github_data(client, path))['result'].json()['names']
+
+
+async def get_repo_topics_by_name(client, full_name):
+    """
+    Given a repo full name grab the list of topic names
+    :param client: async client
+    :param full_name: repo full name - ex: user/repo
+    :return: list of topic names
+    """
+
+    return await get_repo_topics(client, 'repos/{}/topics'.format(full_name))
+
+
+async def get_repo_commit_count_by_name(client, full_name):
+    """
+    Given a repo full name count its commits
+    :param client: async client
+    :param full_name: repo full name - ex: user/repo
+    :return: commit count
+    """
+
+    return await page_thru_github_data_count(client, 'repos/{}/commits'.format(full_name))
+
+
+async def get_repo_stat(full_names, stored, stat, fetch, limit):
+    """
+    Given repos get a per-repo stat from the stored stats, fetching it only for the repos that have nothing stored
+    :param full_names: list of repo full names
+    :param stored: full name -> stored stats, from the repo store
+    :param stat: stored stat - topics or commit_count
+    :param fetch: coroutine function taking a repo full name returning the stat
+    :param limit: semaphore bounding the request's calls in flight
+    :return: full name -> stat (same order as full_names), set of full names fetched
+    """
+
+    # nothing stored for the current version - fetched at once
+    stale = [full_name for full_name in full_names if stored.get(full_name, {}).get(stat) is None]
+    fetched = dict(zip(stale, await gather_all(*[bounded(limit, fetch(full_name)) for full_name in stale])))
+
+    result = {full_name: fetched[full_name] if full_name in fetched else stored[full_name][stat]
+              for full_name in full_names}
+
+    return result, set(fetched)
+
+
+async def get_github_repo_stats(client, user, limit, wanted):
+    """
+    Given a github user get what the repo stats are computed from - the per-repo calls are started, not waited on
+    :param client: async client
+    :param user: github user
+    :param limit: semaphore bounding the request's calls in flight
+    :param wanted: stats asked for
+    :return: {'all_repos': ..., 'versions': ..., 'summary': ..., 'topics': task or None, 'commits': task or None}
+    """
+
+    # every sum and count in one pass over the repo columns
+    all_repos = cleaned_repos_data(await page_thru_github_data_json(client, 'users/{}/repos'.format(user), limit))
+    repo_table = RepoTable.from_repos(all_repos)
+
+    result = {
+        'all_repos': all_repos,
+        'versions': {repo['full_name']: get_repo_version(repo) for repo in all_repos},
+        'summary': repo_table.summarize(),
+        'topics': None,
+        'commits': None
+    }
+
+    if 'repo_topics' not in wanted and 'total_commits' not in wanted:
+        return result
+
+    # stored per-repo stats still valid for the repos' current versions - same store as the threaded routes
+    stored = await asyncio.to_thread(repo_store.get_many, 'github', result['versions'])
+
+    # repo topics and commits at the same time - only repos changed since they were stored are fetched
+    if 'repo_topics' in wanted:
+        result['topics'] = asyncio.ensure_future(get_repo_stat(
+            repo_table.column('full_name'), stored, 'topics', partial(get_repo_topics_by_name, client), limit))
+
+    if 'total_commits' in wanted:
+        result['commits'] = asyncio.ensure_future(get_repo_stat(
+            repo_table.column('full_name', repo_type='original'), stored, 'commit_count',
+            partial(get_repo_commit_count_by_name, client), limit))
+
+    return result
+
+
+async def iter_github_stats(client, user, max_workers=None, fields=None):
+    """
+    Given a github user get the summary stats one at a time - cheapest first, only the upstream calls the stats need,
+    all started at once
+    :param client: async client
+    :param user: github user
+    :param max_workers: max number of per-repo calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: async generator of (stat, value) - only ('message', ...) if the user is not valid
+    """
+
+    limit = asyncio.Semaphore(max_workers or MAX_WORKERS)
+    wanted = [stat for stat in GITHUB_STATS_COST_ORDER if fields is None or stat in fields]
+
+    # check user is valid - user profile
+    profile = (await get_github_data(client, 'users/{}'.format(user)))['result']
+
+    if profile.status_code != 200:
+        yield "message", profile.json()['message']
+        return
+
+    profile_data = profile.json()
+    profile_stats = {'user': profile_data['login'], 'followers': profile_data['followers'],
+                     'following': profile_data['following']}
+
+    # stars given and the repos alongside each other - cancelled if the stats are not all gone through
+    tasks = []
+    starred = repo_stats = None
+
+    if 'total_stars_given' in wanted:
+        starred = asyncio.ensure_future(page_thru_github_data_count(client, 'users/{}/starred'.format(user)))
+        tasks.append(starred)
+
+    if any(stat not in profile_stats and stat != 'total_stars_given' for stat in wanted):
+        repo_stats = asyncio.ensure_future(get_github_repo_stats(client, user, limit, wanted))
+        tasks.append(repo_stats)
+
+    try:
+        for stat in wanted:
+            if stat in profile_stats:
+                yield stat, profile_stats[stat]
+                continue
+
+            if stat == 'total_stars_given':
+                yield stat, await starred
+                continue
+
+            repos = await repo_stats
+            tasks += [task for task in [repos['topics'], repos['commits']] if task and task not in tasks]
+            summary = repos['summary']
+
+            if stat == 'repo_topics':
+                value = count_items_in_list(flatten_list((await repos['topics'])[0].values()))
+            elif stat == 'total_commits':
+                value = sum((await repos['commits'])[0].values())
+            else:
+                value = {
+                    'repos': summary['count']['pub_repo_type'],
+                    'languages': summary['count']['language'],
+                    'total_stars_received': summary['sum']['star_count'],
+                    'total_watchers': summary['sum']['watchers_count'],
+                    'total_open_issues': summary['sum']['open_issues_count'],
+                    'total_account_size': summary['sum']['size']
+                }[stat]
+
+            yield stat, value
+
+    finally:
+        await cancel_tasks(tasks)
+
+    # keep what was fetched for the next refresh
+    if repo_stats is None:
+        return
+
+    repos = repo_stats.result()
+    fetched_topics = repos['topics'].result()[1] if repos['topics'] else set()
+    fetched_commits = repos['commits'].result()[1] if repos['commits'] else set()
+
+    if fetched_topics or fetched_commits:
+        # a stat not asked for is left as stored
+        repo_topics = repos['topics'].result()[0] if fetched_topics else {}
+        repo_commits = repos['commits'].result()[0] if fetched_commits else {}
+        fetched = fetched_topics | fetched_commits
+
+        await asyncio.to_thread(repo_store.put_many, 'github', [{
+            'full_name': repo['full_name'],
+            'version': repos['versions'][repo['full_name']],
+            'topics': repo_topics.get(repo['full_name']),
+            'commit_count': repo_commits.get(repo['full_name']),
+            'watchers': repo['watchers_count']
+        } for repo in repos['all_repos'] if repo['full_name'] in fetched])
+
+
+async def get_github_stats(client, user, max_workers=None, fields=None):
+    """
+    Given a github user get the summary stats, out of quota reported as a message
+    :param client: async client
+    :param user: github user
+    :param max_workers: max number of per-repo calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: summary stats json
+    """
+
+    try:
+        return collect_stats([stat async for stat in iter_github_stats(client, user, max_workers, fields)],
+                             GITHUB_STATS_KEYS)
+
+    # out of upstream quota - report it like any other error
+    except RateLimitError as e:
+        return {"message": str(e)}
+
+
+# bitbucket
+
+
+async def fetch_bitbucket_data(client, url):
+    """
+    Given a url make the request, return json data
+    :param client: async client
+    :param url: full url
+    :return: json data or None if it could not be grabbed
+    """
+
+    r = await client.get(url)
+
+    if r.status_code == 200:
+        return {"result": r.json()}
+
+    return None
+
+
+async def get_bitbucket_data(client, path):
+    """
+    Given path extract the endpoint data, return json data
+    :param client: async client
+    :param path: endpoint
+    :return: json data or None if it could not be grabbed
+    """
+
+    url = build_bitbucket_url(path)
+
+    # identical calls in flight are made once
+    return await url_flight.do(('bitbucket', url), partial(fetch_bitbucket_data, client, url))
+
+
+async def get_bitbucket_result(client, url):
+    """
+    Given a url grab its json data, fail loudly if it could not be grabbed
+    :param client: async client
+    :param url: url
+    :return: json data
+    """
+
+    data = await get_bitbucket_data(client, url)
+
+    if not data:
+        raise ValueError("Could not grab {}".format(url))
+
+    return data['result']
+
+
+async def get_bitbucket_size(client, url):
+    """
+    Given a url for a list endpoint grab the total size - ex: watchers, followers
+    :param client: async client
+    :param url: url
+    :return: size
+    """
+
+    return (await get_bitbucket_result(client, build_bitbucket_size_url(url)))['size']
+
+
+async def page_thru_bitbucket_data_json(client, path, limit, fields=None):
+    """
+    Parse through all bitbucket data, grab all pages at once when the size is known
+    :param client: async client
+    :param path: endpoint
+    :param limit: semaphore bounding the request's calls in flight
+    :param fields: partial response filter - must keep next, size and pagelen, default is None meaning whole objects
+    :return: all data for given endpoint
+    """
+
+    data = await get_bitbucket_data(client, build_bitbucket_page_url(path, fields))
+
+    if not data:
+        return {'result': []}
+
+    data = data['result']
+    all_data = [data['values']]
+
+    # size known - fetch the rest at once
+    if 'next' in data.keys() and 'size' in data.keys():
+        last_page = int(math.ceil(data['size'] / float(data['pagelen'])))
+        urls = [set_query_params(data['next'], page=page) for page in range(2, last_page+1)]
+        pages = await gather_all(*[bounded(limit, get_bitbucket_result(client, url)) for url in urls])
+        all_data += [page['values'] for page in pages]
+
+    # no size - follow next
+    else:
+        while 'next' in data.keys():
+            data = await get_bitbucket_result(client, data['next'])
+            all_data.append(data['values'])
+
+    record_pages('bitbucket', len(all_data))
+
+    return {'result': flatten_list(all_data)}
+
+
+async def get_bitbucket_commit_count(client, url):
+    """
+    Given a repo commits url count all of its commits - every page is walked, moving only each commit's hash
+    :param client: async client
+    :param url: url
+    :return: number of commits
+    """
+
+    data = await get_bitbucket_result(client, build_bitbucket_commits_url(url))
+    count = len(data['values'])
+    pages = 1
+
+    # commits have no size - next only appears if there is a next page
+    while 'next' in data:
+        data = await get_bitbucket_result(client, data['next'])
+        count += len(data['values'])
+        pages += 1
+
+    record_pages('bitbucket', pages)
+
+    return count
+
+
+async def get_bitbucket_open_issue_count(client, url):
+    """
+    Given a repo issues url count its open issues - filtered upstream, one small response however many issues there are
+    :param client: async client
+    :param url: url
+    :return: number of open issues, None if the repo has no issue data
+    """
+
+    issues_link = await get_bitbucket_data(client, build_bitbucket_open_issues_url(url))
+
+    # no data in issues endpoint
+    if not issues_link:
+        return None
+
+    return issues_link['result']['size']
+
+
+async def get_bitbucket_repo_calls(client, repos, limit, wanted):
+    """
+    Given bitbucket repos make the independent per-repo calls the stats asked for need - all at once
+    :param client: async client
+    :param repos: list of repo json
+    :param limit: semaphore bounding the request's calls in flight
+    :param wanted: stats asked for
+    :return: {'commits': [...], 'issues': [...], 'failed_repos': [...]}
+    """
+
+    # (repo full name, stat, coroutine)
+    tasks = []
+
+    for repo in repos:
+
+        # count commits per repo - only for original
+        if 'total_commits' in wanted and is_original_repo(repo):
+            tasks.append((repo['full_name'], 'commits',
+                          get_bitbucket_commit_count(client, repo['links']['commits']['href'])))
+
+        # count open issues - if it has (not all repos have issues)
+        if 'total_open_issues' in wanted and 'issues' in repo['links']:
+            tasks.append((repo['full_name'], 'issues',
+                          get_bitbucket_open_issue_count(client, repo['links']['issues']['href'])))
+
+    # a failed per-repo call does not stop the rest
+    task_results = await asyncio.gather(*[bounded(limit, task) for _, _, task in tasks], return_exceptions=True)
+
+    result = {'commits': [], 'issues': [], 'failed_repos': []}
+
+    # per-repo failures are recorded, the rest of the stats still go out
+    for (repo_name, stat, _), value in zip(tasks, task_results):
+
+        if isinstance(value, Exception):
+            result['failed_repos'].append({'repo': repo_name, 'stat': stat, 'error': str(value)})
+
+        elif stat == 'commits':
+            result['commits'].append(value)
+
+        elif stat == 'issues' and value is not None:
+            result['issues'].append(value)
+
+    return result
+
+
+async def get_bitbucket_repo_stats(client, links, limit, wanted):
+    """
+    Given a bitbucket user's links get what the repo stats are computed from - the per-repo calls are started, not
+    waited on
+    :param client: async client
+    :param links: user links - ex: {'repositories': {'href': ...}, ...}
+    :param limit: semaphore bounding the request's calls in flight
+    :param wanted: stats asked for
+    :return: {'summary': ..., 'repo_calls': task or None}
+    """
+
+    # only the repo keys read below - same partial responses as the threaded pipeline
+    repos = (await page_thru_bitbucket_data_json(client, links['repositories']['href'], limit,
+                                                 BITBUCKET_REPO_FIELDS))['result']
+
+    # every sum and count in one pass over the repo columns
+    result = {
+        'summary': get_bitbucket_repo_table(repos).summarize(),
+        'repo_calls': None
+    }
+
+    if any(stat in wanted for stat in ['total_open_issues', 'total_commits']):
+        result['repo_calls'] = asyncio.ensure_future(get_bitbucket_repo_calls(client, repos, limit, wanted))
+
+    return result
+
+
+async def iter_bitbucket_stats(client, user, max_workers=None, fields=None):
+    """
+    Given a user (or team), grab the desired stats one at a time - cheapest first, only the upstream calls they need,
+    all started at once
+    :param client: async client
+    :param user: bitbucket user or team
+    :param max_workers: max number of upstream calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: async generator of (stat, value) - only ('message', ...) if the user is not valid
+    """
+
+    limit = asyncio.Semaphore(max_workers or MAX_WORKERS)
+    wanted = [stat for stat in BITBUCKET_STATS_COST_ORDER if fields is None or stat in fields]
+
+    # users endpoint, then teams
+    profile = await get_bitbucket_data(client, 'users/{}'.format(user)) or \
+        await get_bitbucket_data(client, 'teams/{}'.format(user))
+
+    # could not get from users or teams
+    if not profile:
+        yield "message", "Given user is not of type 'teams' or type 'user, please check user is a valid bitbucket user."
+        return
+
+    links = profile['result']['links']
+
+    # followers & following alongside going through all of the repos - cancelled if the stats are not all gone through
+    tasks = {stat: asyncio.ensure_future(get_bitbucket_size(client, links[stat]['href']))
+             for stat in ['followers', 'following'] if stat in wanted}
+
+    if any(stat not in ['user', 'followers', 'following'] for stat in wanted):
+        tasks['repo_stats'] = asyncio.ensure_future(get_bitbucket_repo_stats(client, links, limit, wanted))
+
+    repo_calls = None
+
+    try:
+        for stat in wanted:
+            if stat == 'user':
+                yield stat, profile['result']['username']
+                continue
+
+            if stat in ['followers', 'following']:
+                yield stat, await tasks[stat]
+                continue
+
+            repos = await tasks['repo_stats']
+            summary = repos['summary']
+
+            if stat in ['total_open_issues', 'total_commits']:
+                tasks['repo_calls'] = repos['repo_calls']
+                repo_calls = await repos['repo_calls']
+                value = sum(repo_calls[{'total_open_issues': 'issues', 'total_commits': 'commits'}[stat]])
+            else:
+                value = {
+                    'repos': summary['count']['pub_repo_type'],
+                    'languages': summary['count']['language'],
+                    'total_account_size': summary['sum']['size']
+                }[stat]
+
+            yield stat, value
+
+    finally:
+        await cancel_tasks(list(tasks.values()))
+
+    # only there when some of the per-repo calls failed
+    if repo_calls and repo_calls['failed_repos']:
+        yield "failed_repos", repo_calls['failed_repos']
+
+
+async def get_bitbucket_stats(client, user, max_workers=None, fields=None):
+    """
+    Given a user (or team), grab all desired stats, out of quota reported as a message
+    :param client: async client
+    :param user: bitbucket user or team
+    :param max_workers: max number of upstream calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: aggregated bitbucket stats
+    """
+
+    try:
+        return collect_stats([stat async for stat in iter_bitbucket_stats(client, user, max_workers, fields)],
+                             BITBUCKET_STATS_KEYS)
+
+    # out of upstream quota - report it like any other error
+    except RateLimitError as e:
+        return {"message": str(e)}
+
+
+# views
+
+
+def get_async_stats_key(provider, user, fields=None):
+    """
+    Given a provider, user and the stats asked for get the stats cache key of the async routes - kept apart from the
+    threaded routes' stats
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param fields: stats wanted (canonical order), default is None meaning all of them
+    :return: (provider, user, 'async') or (provider, user, fields, 'async')
+    """
+
+    return get_stats_key(provider, user, fields) + ('async',)
+
+
+async def get_cached_stats(client, provider, user, compute, bypass=False, fields=None):
+    """
+    Given a provider and user get the stats through the stats cache, computing them on the event loop if missing -
+    concurrent misses share one computation
+    :param client: async client
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param compute: coroutine function taking the client returning the stats dict (only the fields asked for)
+    :param bypass: skip the cache lookup and refresh it
+    :param fields: stats wanted, default is None meaning all of them
+    :return: stats dict, age in seconds if it came from the cache (None if just computed)
+    """
+
+    key = get_async_stats_key(provider, user, fields)
+
+    if not bypass:
+        # fresh whole stats already have every field asked for
+        if fields is not None:
+            value, age = stats_cache.get_with_age(get_async_stats_key(provider, user))
+
+            if value is not None:
+                return select_stats(value, fields), age
+
+        value, age = stats_cache.get_with_age(key)
+
+        if value is not None:
+            return value, age
+
+    async def compute_and_set():
+        result = await compute(client)
+        stats_cache.set(key, result)
+        return result
+
+    return await stats_flight.do(key, compute_and_set), None
+
+
+async def stream_cached_stats(client, provider, user, iter_stats, keys, put, bypass=False, fields=None):
+    """
+    Given a provider's stats generator hand each stat over as it is computed, cached stats in one go - through the
+    stats cache, so concurrent requests share one computation
+    :param client: async client
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param iter_stats: function taking the client returning an async generator of (stat, value)
+    :param keys: stats in the order they are reported
+    :param put: function taking an event - ex: events.put, ends with the whole stats {'data': ...}
+    :param bypass: skip the cache lookup and refresh it
+    :param fields: stats wanted, default is None meaning all of them
+    """
+
+    async def compute(client):
+        stats = []
+
+        try:
+            async for stat, value in iter_stats(client):
+                stats.append((stat, value))
+                put({'stat': stat, 'value': value})
+
+        # out of upstream quota - report it like any other error
+        except RateLimitError as e:
+            return {'message': str(e)}
+
+        return collect_stats(stats, keys)
+
+    try:
+        result = (await get_cached_stats(client, provider, user, compute, bypass, fields))[0]
+    except Exception as e:
+        result = {'message': "Could not get {} stats: {}".format(provider, e)}
+
+    put({'data': result})
+
+
+async def get_merged_stats(client, gh_user, bb_user, max_workers=None, bypass=False, gh_fields=None, bb_fields=None):
+    """
+    Given github and bitbucket users get both providers' stats at the same time, each within its timeout
+    :param client: async client
+    :param gh_user: github user
+    :param bb_user: bitbucket user
+    :param max_workers: max number of per-repo calls in flight per provider
+    :param bypass: skip the cache lookup and refresh it
+    :param gh_fields: github stats wanted, default is None meaning all of them
+    :param bb_fields: bitbucket stats wanted, default is None meaning all of them
+    :return: (github stats, age), (bitbucket stats, age) - a message dict (no age) for a provider that ran out of time
+    """
+
+    async def with_timeout(provider, user, compute, fields, timeout):
+        compute = partial(compute, user=user, max_workers=max_workers, fields=fields)
+
+        try:
+            return await asyncio.wait_for(get_cached_stats(client, provider, user, compute, bypass, fields), timeout)
+        except asyncio.TimeoutError:
+            return {'message': "{} did not respond within {} seconds".format(provider.capitalize(), timeout)}, None
+
+    return await asyncio.gather(with_timeout('github', gh_user, get_github_stats, gh_fields, GITHUB_TIMEOUT),
+                                with_timeout('bitbucket', bb_user, get_bitbucket_stats, bb_fields, BITBUCKET_TIMEOUT))
+
+
+async def run_on_loop(func, *args):
+    """
+    Given a coroutine function wait for it to run on the shared event loop
+    :param func: coroutine function taking the client then args
+    :return: its result
+    """
+
+    return await asyncio.wrap_future(async_loop.submit(func, *args))
+
+
+def add_profile(result, profile):
+    """
+    Given a response and the request's profile attach the profile - ?profile=1
+    :param result: response json
+    :param profile: profile, None when not profiling
+    :return: response json
+    """
+
+    if profile:
+        result['profile'] = profile.report()
+
+    return result
+
+
+async def provider_stats_view(provider, user, keys, get_stats, iter_stats):
+    """
+    Given a provider and user pull all of its stats - same query parameters and responses as the threaded routes
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param keys: stats the provider reports, in the order they are reported
+    :param get_stats: coroutine function taking the client, user, max_workers and fields returning the stats dict
+    :param iter_stats: function taking the client, user, max_workers and fields returning an async generator of
+    (stat, value)
+    :return: stats
+    """
+
+    # query string options - ex: ?workers=4&nocache=1&stream=ndjson&fields=followers,repos
+    try:
+        options = get_request_options(request.args, keys)
+    except ValueError as e:
+        return {'message': str(e)}, 400
+
+    max_workers, bypass, fields = options['max_workers'], options['bypass'], options['fields']
+
+    # send each stat as soon as it is computed
+    if options['stream_format']:
+        events = queue.Queue()
+        async_loop.submit(stream_cached_stats, provider, user,
+                          partial(iter_stats, user=user, max_workers=max_workers, fields=fields), keys, events.put,
+                          bypass, fields)
+        return stream_response(iter_events(events), options['stream_format'])
+
+    with profile_request(options['profile']) as profile:
+        data, age = await run_on_loop(get_cached_stats, provider, user,
+                                      partial(get_stats, user=user, max_workers=max_workers, fields=fields), bypass,
+                                      fields)
+
+    result = add_profile({'data': data}, profile)
+
+    # serialized once while the cache hands out the same stats - compressed if accepted, 304 on a matching ETag
+    return serve_serialized(('async', provider, user, fields), [data], lambda: result, get_age_headers(age),
+                            cache=not profile)
+
+
+async def github_stats_view(gh_user):
+    """
+    Given the github user pull all the github stats
+    :param gh_user: github user
+    :return: stats
+    """
+
+    return await provider_stats_view('github', gh_user, GITHUB_STATS_KEYS, get_github_stats, iter_github_stats)
+
+
+async def bitbucket_stats_view(bb_user):
+    """
+    Given the bitbucket user pull all the bitbucket stats
+    :param bb_user: bitbucket user
+    :return: stats
+    """
+
+    return await provider_stats_view('bitbucket', bb_user, BITBUCKET_STATS_KEYS, get_bitbucket_stats,
+                                     iter_bitbucket_stats)
+
+
+async def merged_stats_view(gh_user, bb_user):
+    """
+    Given github and bitbucket users aggregate their stats - both providers on the shared event loop
+    :param gh_user: github user
+    :param bb_user: bitbucket user
+    :return: aggregated stats or message
+    """
+
+    # query string options - ex: ?workers=4&nocache=1&stream=ndjson&fields=followers,repos
+    try:
+        options = get_request_options(request.args, GITHUB_STATS_KEYS)
+    except ValueError as e:
+        return {'message': str(e)}, 400
+
+    max_workers, bypass, fields = options['max_workers'], options['bypass'], options['fields']
+
+    # github reports every stat - bitbucket only computes the ones it has
+    bb_fields = select_fields(fields, BITBUCKET_STATS_KEYS)
+
+    # send each provider's stats as soon as they are computed
+    if options['stream_format']:
+        events = queue.Queue()
+        started = time.monotonic()
+
+        for provider, user, iter_stats, keys, provider_fields in [
+                ('github', gh_user, iter_github_stats, GITHUB_STATS_KEYS, fields),
+                ('bitbucket', bb_user, iter_bitbucket_stats, BITBUCKET_STATS_KEYS, bb_fields)]:
+            async_loop.submit(stream_cached_stats, provider, user,
+                              partial(iter_stats, user=user, max_workers=max_workers, fields=provider_fields), keys,
+                              partial(lambda provider, event: events.put((provider, event)), provider), bypass,
+                              provider_fields)
+
+        timeouts = {'github': GITHUB_TIMEOUT, 'bitbucket': BITBUCKET_TIMEOUT}
+
+        return stream_response(merge_streamed_stats(iter_provider_events(events, timeouts, started)),
+                               options['stream_format'])
+
+    with profile_request(options['profile']) as profile:
+        (gh_data, gh_age), (bb_data, bb_age) = await run_on_loop(get_merged_stats, gh_user, bb_user, max_workers,
+                                                                 bypass, fields, bb_fields)
+
+        result = merge_provider_stats(gh_data, bb_data)
+
+    result = add_profile(result, profile)
+
+    # serialized once while the cache hands out the same stats of both providers - X-Stats-Age is the older of them
+    return serve_serialized(('async', 'merged', gh_user, bb_user, fields), [gh_data, bb_data], lambda: result,
+                            get_age_headers(gh_age, bb_age), cache=not profile)
@@ -0,0 +1,607 @@
+"""
+Offline benchmarks - runs the stats pipelines and routes against local stubs of the github and bitbucket apis
+usage: python benchmark.py [--sizes 10,500,5000] [--targets github_stats,...] [--latency 0.005] [--rate-limit-every 100]
+                           [--no-memory] [--json] [--output bench_output.txt]
+                           [--baseline bench_baseline.txt] [--max-regression 0.1]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+# synthetic data - every user's shape comes from the number at the end of its name (ex: bench500 has 500 repos)
+LANGUAGES = ['Python', 'JavaScript', 'Go', None]
+TOPICS = ['api', 'flask', 'cli', 'data']
+COMMITS_PER_REPO = 25
+ISSUES_PER_REPO = 6
+FOLLOWERS = 40
+FOLLOWING = 12
+
+# the rest of a github repo listing item - links the stats never read, github sends every one of them
+GITHUB_REPO_LINKS = ['archive', 'assignees', 'blobs', 'branches', 'collaborators', 'comments', 'commits', 'compare',
+                     'contents', 'contributors', 'deployments', 'downloads', 'events', 'forks', 'git_commits',
+                     'git_refs', 'git_tags', 'hooks', 'issue_comment', 'issue_events', 'issues', 'keys', 'labels',
+                     'languages', 'merges', 'milestones', 'notifications', 'pulls', 'releases', 'stargazers',
+                     'statuses', 'subscribers', 'subscription', 'tags', 'teams', 'trees']
+
+# default scenarios and what runs through them
+SIZES = [10, 500, 5000]
+TARGETS = ['github_stats', 'bitbucket_stats', 'github_route', 'bitbucket_route', 'merged_route', 'async_merged_route']
+
+# compared against the baseline - lower is better for every one of them
+METRICS = ['wall_seconds', 'github_calls', 'bitbucket_calls', 'github_kb', 'bitbucket_kb', 'peak_mb']
+
+
+class StubServer(object):
+    """
+    Local stand-in for an upstream api - counts calls and bytes sent, adds latency, rate limits every so often, sends an
+    ETag with every 200 and a 304 when it still matches
+    """
+
+    def __init__(self, handler, prefix, latency=0.0, rate_limit_every=0):
+        """
+        :param handler: function taking (server, path, query) returning (status, body, headers)
+        :param prefix: path the api is served under - ex: /2.0/
+        :param latency: seconds added to every call
+        :param rate_limit_every: every nth call is answered with a 429, 0 to never rate limit
+        """
+        self.handler = handler
+        self.prefix = prefix
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+
+        self.calls = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            # keep-alive - the pooled connections are reused like they would be upstream
+            protocol_version = 'HTTP/1.1'
+
+            # headers and body go out in separate writes - without this a reused connection waits on delayed acks
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub.serve(self)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # many connections opened at once - a short listen backlog drops them into a 1s SYN retransmit
+            request_queue_size = 1024
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), RequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """
+        Get the api base url
+        :return: url
+        """
+
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], self.prefix)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def reset(self):
+        """
+        Reset the call and byte counts - between runs
+        """
+
+        with self.lock:
+            self.calls = 0
+            self.bytes = 0
+
+    def serve(self, request):
+        """
+        Given an incoming request answer it from the handler
+        :param request: BaseHTTPRequestHandler
+        """
+
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        parts = urlsplit(request.path)
+        path = parts.path[len(self.prefix):].strip('/')
+        query = dict(parse_qsl(parts.query))
+
+        # secondary rate limit - retried by the scheduler right away
+        if self.rate_limit_every and call % self.rate_limit_every == 0:
+            status, body, headers = 429, {'message': 'API rate limit exceeded'}, {'Retry-After': '0'}
+        else:
+            status, body, headers = self.handler(self, path, query)
+
+        content = json.dumps(body).encode()
+
+        # conditional requests - not modified goes back without a body
+        if status == 200:
+            etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+            headers = dict(headers, ETag=etag)
+
+            if request.headers.get('If-None-Match') == etag:
+                status, content = 304, b''
+
+        with self.lock:
+            self.bytes += len(content)
+
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(content)))
+        request.send_header('X-RateLimit-Limit', '1000000')
+        request.send_header('X-RateLimit-Remaining', '1000000')
+        request.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(content)
+
+
+def get_user_size(user):
+    """
+    Given a benchmark user get its number of repos - ex: bench500 -> 500
+    :param user: user name
+    :return: number of repos
+    """
+
+    match = re.search(r'(\d+)$', user)
+
+    return int(match.group(1)) if match else 10
+
+
+def github_page(server, path, query, total, make_item):
+    """
+    Given a github list endpoint serve one page of it with the Link header github sends
+    :param server: stub server
+    :param path: endpoint path
+    :param query: query params
+    :param total: number of items in the list
+    :param make_item: function taking the item index
+    :return: status, body, headers
+    """
+
+    per_page = int(query.get('per_page', 30))
+    page = int(query.get('page', 1))
+    last_page = max(1, -(-total // per_page))
+
+    start = (page - 1) * per_page
+    body = [make_item(index) for index in range(start, min(start + per_page, total))]
+
+    headers = {}
+    if page < last_page:
+        link = '{}{}?{}'.format(server.url, path, urlencode(dict(query, page=page + 1)))
+        last = '{}{}?{}'.format(server.url, path, urlencode(dict(query, page=last_page)))
+        headers['Link'] = '<{}>; rel="next", <{}>; rel="last"'.format(link, last)
+
+    return 200, body, headers
+
+
+def make_github_repo(user, index):
+    full_name = '{}/repo{}'.format(user, index)
+    url = 'https://api.github.com/repos/{}'.format(full_name)
+
+    repo = {'full_name': full_name, 'fork': index % 5 == 0,
+            'language': LANGUAGES[index % len(LANGUAGES)], 'forks_count': index % 3, 'watchers_count': index % 7,
+            'open_issues_count': index % 4, 'stargazers_count': index % 11, 'url': url,
+            'html_url': 'https://github.com/{}'.format(full_name), 'size': 100 + index,
+            'pushed_at': '2020-01-01T00:00:00Z', 'updated_at': '2020-01-01T00:00:00Z'}
+
+    # what else github sends - about as big as the real listing items
+    repo.update({'{}_url'.format(link): '{}/{}{{/id}}'.format(url, link) for link in GITHUB_REPO_LINKS})
+    repo.update({'id': index, 'node_id': 'MDEwOlJlcG9zaXRvcnk{:08d}'.format(index), 'name': 'repo{}'.format(index),
+                 'private': False, 'description': 'Benchmark repository number {}'.format(index),
+                 'created_at': '2019-01-01T00:00:00Z', 'default_branch': 'master', 'has_issues': True,
+                 'owner': {'login': user, 'id': 1, 'type': 'User', 'site_admin': False,
+                           'avatar_url': 'https://avatars.githubusercontent.com/u/1',
+                           'url': 'https://api.github.com/users/{}'.format(user)},
+                 'permissions': {'admin': False, 'push': False, 'pull': True}})
+
+    return repo
+
+
+def handle_github(server, path, query):
+    """
+    Given a github api path answer it with synthetic data
+    :return: status, body, headers
+    """
+
+    parts = path.split('/')
+
+    # users/<user>
+    if len(parts) == 2 and parts[0] == 'users':
+        user = parts[1]
+        return 200, {'login': user, 'followers': FOLLOWERS, 'following': FOLLOWING,
+                     'public_repos': get_user_size(user)}, {}
+
+    # users/<user>/repos, users/<user>/starred
+    if len(parts) == 3 and parts[0] == 'users' and parts[2] == 'repos':
+        user = parts[1]
+        return github_page(server, path, query, get_user_size(user), lambda index: make_github_repo(user, index))
+
+    if len(parts) == 3 and parts[0] == 'users' and parts[2] == 'starred':
+        return github_page(server, path, query, get_user_size(parts[1]) // 2, lambda index: {'id': index})
+
+    # repos/<user>/<repo>/topics, repos/<user>/<repo>/commits
+    if len(parts) == 4 and parts[0] == 'repos' and parts[3] == 'topics':
+        return 200, {'names': TOPICS[:1 + len(parts[2]) % len(TOPICS)]}, {}
+
+    if len(parts) == 4 and parts[0] == 'repos' and parts[3] == 'commits':
+        return github_page(server, path, query, COMMITS_PER_REPO, lambda index: {'sha': str(index)})
+
+    return 404, {'message': 'Not Found'}, {}
+
+
+def bitbucket_page(server, path, query, total, make_item, sized=True):
+    """
+    Given a bitbucket list endpoint serve one page of it with the next link (and size) bitbucket sends
+    :param server: stub server
+    :param path: endpoint path
+    :param query: query params
+    :param total: number of items in the list
+    :param make_item: function taking the item index
+    :param sized: send the size - bitbucket leaves it out of some endpoints (ex: commits)
+    :return: status, body, headers - only the ?fields= asked for, like bitbucket's partial responses
+    """
+
+    pagelen = int(query.get('pagelen', 10))
+    page = int(query.get('page', 1))
+
+    start = (page - 1) * pagelen
+    body = {'pagelen': pagelen, 'page': page,
+            'values': [make_item(index) for index in range(start, min(start + pagelen, total))]}
+
+    if sized:
+        body['size'] = total
+
+    if start + pagelen < total:
+        body['next'] = '{}{}?{}'.format(server.url, path, urlencode(dict(query, page=page + 1)))
+
+    if query.get('fields'):
+        body = select_fields(body, query['fields'].split(','))
+
+    return 200, body, {}
+
+
+def select_fields(value, fields):
+    """
+    Given a json value keep only the dotted fields asked for - ex: ['next', 'values.hash'], lists are filtered per item
+    :param value: json value
+    :param fields: list of dotted field paths
+    :return: filtered json value
+    """
+
+    if isinstance(value, list):
+        return [select_fields(item, fields) for item in value]
+
+    if not isinstance(value, dict):
+        return value
+
+    result = {}
+
+    for key, item in value.items():
+        nested = [field[len(key) + 1:] for field in fields if field.startswith(key + '.')]
+
+        if key in fields:
+            result[key] = item
+        elif nested:
+            result[key] = select_fields(item, nested)
+
+    return result
+
+
+def make_bitbucket_account(name):
+    return {'type': 'user', 'username': name, 'display_name': name.title(), 'uuid': '{{{}}}'.format(name),
+            'links': {link: {'href': 'https://bitbucket.org/{}/{}'.format(name, link)}
+                      for link in ['self', 'html', 'avatar']}}
+
+
+def make_bitbucket_commit(server, full_name, index):
+    commit_hash = '{:040x}'.format(index)
+    return {'type': 'commit', 'hash': commit_hash, 'date': '2020-01-01T00:00:00+00:00',
+            'message': 'Commit number {} of {}\n'.format(index, full_name), 'author': make_bitbucket_account('author'),
+            'parents': [{'hash': '{:040x}'.format(index + 1), 'type': 'commit'}],
+            'links': {link: {'href': '{}repositories/{}/{}/{}'.format(server.url, full_name, link, commit_hash)}
+                      for link in ['self', 'html', 'diff', 'patch', 'comments', 'statuses']}}
+
+
+def make_bitbucket_issue(index):
+    states = ['new', 'open', 'resolved']
+    return {'type': 'issue', 'id': index + 1, 'title': 'Issue number {}'.format(index + 1), 'kind': 'bug',
+            'priority': 'major', 'state': states[index % len(states)], 'reporter': make_bitbucket_account('reporter'),
+            'content': {'raw': 'Steps to reproduce issue {}'.format(index + 1), 'markup': 'markdown'},
+            'created_on': '2020-01-01T00:00:00+00:00', 'updated_on': '2020-01-02T00:00:00+00:00'}
+
+
+def make_bitbucket_repo(server, user, index):
+    full_name = '{}/repo{}'.format(user, index)
+    links = {stat: {'href': '{}repositories/{}/{}'.format(server.url, full_name, stat)}
+             for stat in ['commits', 'watchers']}
+
+    # not every repo has an issue tracker
+    if index % 2 == 0:
+        links['issues'] = {'href': '{}repositories/{}/issues'.format(server.url, full_name)}
+
+    repo = {'full_name': full_name, 'size': 1000 + index, 'language': (LANGUAGES[index % len(LANGUAGES)] or ''),
+            'links': links}
+
+    if index % 5 == 0:
+        repo['parent'] = {'full_name': 'someone/repo{}'.format(index)}
+
+    return repo
+
+
+def handle_bitbucket(server, path, query):
+    """
+    Given a bitbucket api path answer it with synthetic data
+    :return: status, body, headers
+    """
+
+    parts = path.split('/')
+
+    # users/<user>
+    if len(parts) == 2 and parts[0] == 'users':
+        user = parts[1]
+        links = {
+            'followers': {'href': '{}users/{}/followers'.format(server.url, user)},
+            'following': {'href': '{}users/{}/following'.format(server.url, user)},
+            'repositories': {'href': '{}repositories/{}'.format(server.url, user)}
+        }
+        return 200, {'username': user, 'links': links}, {}
+
+    # users/<user>/followers, users/<user>/following
+    if len(parts) == 3 and parts[0] == 'users' and parts[2] in ('followers', 'following'):
+        total = FOLLOWERS if parts[2] == 'followers' else FOLLOWING
+        return bitbucket_page(server, path, query, total, lambda index: {'username': 'follower{}'.format(index)})
+
+    # repositories/<user>
+    if len(parts) == 2 and parts[0] == 'repositories':
+        user = parts[1]
+        return bitbucket_page(server, path, query, get_user_size(user),
+                              lambda index: make_bitbucket_repo(server, user, index))
+
+    # repositories/<user>/<repo>/commits|watchers|issues
+    if len(parts) == 4 and parts[0] == 'repositories':
+        if parts[3] == 'commits':
+            return bitbucket_page(server, path, query, COMMITS_PER_REPO,
+                                  lambda index: make_bitbucket_commit(server, '/'.join(parts[1:3]), index), sized=False)
+
+        if parts[3] == 'watchers':
+            return bitbucket_page(server, path, query, 3,
+                                  lambda index: make_bitbucket_account('watcher{}'.format(index)))
+
+        if parts[3] == 'issues':
+            issues = [make_bitbucket_issue(index) for index in range(ISSUES_PER_REPO)]
+
+            # ?q=state="new" - only the matching issues, like bitbucket's filtering
+            match = re.match(r'state\s*=\s*"([^"]*)"$', query.get('q', ''))
+            if match:
+                issues = [issue for issue in issues if issue['state'] == match.group(1)]
+
+            return bitbucket_page(server, path, query, len(issues), issues.__getitem__)
+
+    return 404, {'type': 'error', 'error': {'message': 'Not Found'}}, {}
+
+
+def run_target(target, user, modules):
+    """
+    Given a target and a user compute the stats once
+    :param target: one of TARGETS
+    :param user: benchmark user
+    :param modules: the app modules - imported once the stub urls are in the environment
+    """
+
+    client = modules['app'].app.test_client()
+
+    if target == 'github_stats':
+        modules['github_api'].get_github_stats(user)
+    elif target == 'bitbucket_stats':
+        modules['bitbucket_api'].get_bitbucket_stats(user)
+    elif target == 'github_route':
+        client.get('/stats/github/{}?nocache=1'.format(user)).get_data()
+    elif target == 'bitbucket_route':
+        client.get('/stats/bitbucket/{}?nocache=1'.format(user)).get_data()
+    elif target == 'merged_route':
+        client.get('/stats/github/{0}/bitbucket/{0}?nocache=1'.format(user)).get_data()
+    elif target == 'async_merged_route':
+        client.get('/async/stats/github/{0}/bitbucket/{0}?nocache=1'.format(user)).get_data()
+
+
+def reset_caches(modules):
+    """
+    Drop everything the process keeps between requests - repo store, stats, upstream responses, serialized responses
+    :param modules: the app modules
+    """
+
+    modules['github_api'].repo_store = modules['repo_store'].RepoStore(':memory:')
+    modules['cache'].stats_cache.clear()
+    modules['cache'].github_response_cache.clear()
+    modules['responses'].serialized_cache.clear()
+
+
+def run_scenario(target, size, stubs, modules, memory=True):
+    """
+    Given a target and a number of repos run it cold - empty repo store, nothing cached
+    :param target: one of TARGETS
+    :param size: number of repos of the user
+    :param stubs: provider -> stub server
+    :param modules: the app modules
+    :param memory: also run it under tracemalloc for the peak memory (slower, so timed separately)
+    :return: result json
+    """
+
+    user = 'bench{}'.format(size)
+
+    def cold_run():
+        reset_caches(modules)
+        for stub in stubs.values():
+            stub.reset()
+
+        started = time.perf_counter()
+        run_target(target, user, modules)
+        return time.perf_counter() - started
+
+    wall = cold_run()
+    calls = {provider: stub.calls for provider, stub in stubs.items()}
+    sent = {provider: stub.bytes for provider, stub in stubs.items()}
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        cold_run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'target': target,
+        'repos': size,
+        'wall_seconds': round(wall, 3),
+        'github_calls': calls['github'],
+        'bitbucket_calls': calls['bitbucket'],
+        'github_kb': round(sent['github'] / 1024.0, 1),
+        'bitbucket_kb': round(sent['bitbucket'] / 1024.0, 1),
+        'peak_mb': round(peak / 1024.0 / 1024.0, 2) if peak is not None else None
+    }
+
+
+def format_result(result):
+    peak = '{:>9.2f}'.format(result['peak_mb']) if result['peak_mb'] is not None else '{:>9}'.format('-')
+
+    return '{:<20} {:>6} {:>10.3f} {:>12} {:>15} {:>10.1f} {:>13.1f} {}'.format(
+        result['target'], result['repos'], result['wall_seconds'], result['github_calls'], result['bitbucket_calls'],
+        result['github_kb'], result['bitbucket_kb'], peak)
+
+
+def load_baseline(path):
+    """
+    Given a file of earlier results (--json --output) get them by scenario
+    :param path: baseline file
+    :return: (target, repos) -> result json
+    """
+
+    with open(path) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+
+    return {(result['target'], result['repos']): result for result in results}
+
+
+def find_regressions(result, baseline, max_regression):
+    """
+    Given a result and the baseline list every metric that got worse by more than the allowed fraction
+    :param result: result json
+    :param baseline: (target, repos) -> result json
+    :param max_regression: fraction a metric may grow by - ex: 0.1
+    :return: list of messages, empty if within bounds or the scenario is not in the baseline
+    """
+
+    before = baseline.get((result['target'], result['repos']))
+
+    if before is None:
+        return []
+
+    regressions = []
+
+    for metric in METRICS:
+        # peak memory is missing from --no-memory runs
+        if result.get(metric) is None or before.get(metric) is None:
+            continue
+
+        if result[metric] > before[metric] * (1 + max_regression):
+            regressions.append('{} {} repos: {} {} -> {} (more than {:.0%} worse)'.format(
+                result['target'], result['repos'], metric, before[metric], result[metric], max_regression))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks against local github/bitbucket stubs')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                        help='comma separated number of repos per user')
+    parser.add_argument('--targets', default=','.join(TARGETS), help='comma separated targets: {}'.format(TARGETS))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every upstream call')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='answer every nth upstream call with a 429')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--json', action='store_true', help='one json line per result')
+    parser.add_argument('--output', help='also write the results to this file - ex: bench_output.txt')
+    parser.add_argument('--baseline', help='earlier --json results to compare against, exits 1 on a regression')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='fraction a metric may grow by over the baseline (default 0.1)')
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+
+    stubs = {
+        'github': StubServer(handle_github, '/', args.latency, args.rate_limit_every).start(),
+        'bitbucket': StubServer(handle_bitbucket, '/2.0/', args.latency, args.rate_limit_every).start()
+    }
+
+    # the app reads its upstreams and limits at import - point it at the stubs, pacing left to the stubs
+    os.environ['GITHUB_API_URL'] = stubs['github'].url
+    os.environ['BITBUCKET_API_URL'] = stubs['bitbucket'].url
+    os.environ.pop('GITHUB_USER', None)
+    os.environ.pop('GITHUB_PASSWORD', None)
+    os.environ.setdefault('REPO_STORE_PATH', ':memory:')
+    os.environ.setdefault('RATE_LIMIT_RATE', '1000000')
+    os.environ.setdefault('RATE_LIMIT_BURST', '1000000')
+    os.environ.setdefault('HOT_THRESHOLD', '1000000')     # no background refreshes mixed into the runs
+
+    import app
+    import bitbucket_api
+    import cache
+    import github_api
+    import repo_store
+    import responses
+
+    modules = {'app': app, 'bitbucket_api': bitbucket_api, 'cache': cache, 'github_api': github_api,
+               'repo_store': repo_store, 'responses': responses}
+
+    lines = []
+    regressions = []
+
+    if not args.json:
+        lines.append('{:<20} {:>6} {:>10} {:>12} {:>15} {:>10} {:>13} {:>9}'.format(
+            'target', 'repos', 'wall (s)', 'github calls', 'bitbucket calls', 'github KB', 'bitbucket KB', 'peak (MB)'))
+        print(lines[-1], flush=True)
+
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            for target in args.targets.split(','):
+                result = run_scenario(target, size, stubs, modules, memory=not args.no_memory)
+                lines.append(json.dumps(result) if args.json else format_result(result))
+                print(lines[-1], flush=True)
+                regressions += find_regressions(result, baseline, args.max_regression)
+    finally:
+        for stub in stubs.values():
+            stub.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    # fail the build
+    if regressions:
+        print('\n'.join(['regressed against {}:'.format(args.baseline)] + regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
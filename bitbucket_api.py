@@ -1,9 +1,43 @@
+import math
 import os
+from functools import partial
 
-import requests
+from flask import request
 from flask_restful import Resource
 
-from util import flatten_list, count_items_in_list, get_specific_count_to_sum
+from coalesce import dedupe_call
+from options import get_request_options
+from metrics import time_stage
+from profiling import profile_request, record_pages, profiled
+from ratelimit import RateLimitError
+from refresher import serve_stats, get_age_headers
+from repo_table import RepoTable
+from responses import serve_serialized
+from streaming import stream_response, stream_provider_stats
+from transport import http_get
+from util import flatten_list, count_items_in_list, collect_stats, run_in_pool, run_tasks, set_query_params, LazyStats, \
+    BITBUCKET_API_URL
+
+# biggest page length bitbucket allows for list endpoints
+BITBUCKET_PAGELEN = 100
+
+# partial responses - bitbucket sends only these keys (?fields=), everything else the stats never read stays upstream
+BITBUCKET_SIZE_FIELDS = 'size'
+BITBUCKET_COMMIT_FIELDS = 'next,values.hash'
+BITBUCKET_REPO_FIELDS = ','.join(['next', 'size', 'pagelen', 'values.full_name', 'values.size', 'values.language',
+                                  'values.parent.full_name', 'values.links.commits.href',
+                                  'values.links.issues.href'])
+
+# open issues - bitbucket filters them (?q=) and sends back only how many matched
+BITBUCKET_OPEN_ISSUES_QUERY = 'state="new"'
+
+# bitbucket stats in the order they are reported
+BITBUCKET_STATS_KEYS = ['user', 'followers', 'following', 'languages', 'repos', 'total_open_issues', 'total_commits',
+                        'total_account_size']
+
+# bitbucket stats in the order they are computed - cheapest first, the per-repo calls last
+BITBUCKET_STATS_COST_ORDER = ['user', 'followers', 'following', 'repos', 'languages', 'total_account_size',
+                              'total_open_issues', 'total_commits']
 
 
 class BitbucketAPI(Resource):       # used to hit bitbucket stats endpoint
@@ -13,11 +47,54 @@ class BitbucketAPI(Resource):       # used to hit bitbucket stats endpoint
         :param bb_user: bitbucket user
         :return: stats
         """
+        # query string options - ex: ?workers=4&nocache=1&stream=ndjson&fields=followers,repos
+        try:
+            options = get_request_options(request.args, BITBUCKET_STATS_KEYS)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        max_workers, bypass, fields = options['max_workers'], options['bypass'], options['fields']
+
+        # send each stat as soon as it is computed
+        if options['stream_format']:
+            events = stream_provider_stats('bitbucket', bb_user,
+                                           partial(iter_bitbucket_stats, bb_user, max_workers, fields),
+                                           BITBUCKET_STATS_KEYS, bypass, fields)
+            return stream_response(events, options['stream_format'])
+
+        # through the stats cache - hot users are kept warm, X-Stats-Age tells how old cached stats are
+        with profile_request(options['profile']) as profile:
+            data, age = serve_stats('bitbucket', bb_user, lambda: get_bitbucket_stats(bb_user, max_workers, fields),
+                                    bypass, fields)
+
         result = {
-            'data': get_bitbucket_stats(bb_user)
+            'data': data
         }
 
-        return result
+        # ?profile=1 - where the time went
+        if profile:
+            result['profile'] = profile.report()
+
+        # serialized once while the cache hands out the same stats - compressed if accepted, 304 on a matching ETag
+        return serve_serialized(('bitbucket', bb_user, fields), [data], lambda: result, get_age_headers(age), cache=not profile)
+
+
+def build_bitbucket_url(path):
+    """
+    Given path construct the url
+    :param path: endpoint or full url
+    :return: url
+    """
+
+    # construct url - links handed back by bitbucket are already full urls
+    if '://' not in path:
+        url = os.path.join(BITBUCKET_API_URL, path)
+
+    # go to url directly
+    else:
+        url = path
+
+    return url
 
 
 def get_bitbucket_data(path):
@@ -27,19 +104,21 @@ def get_bitbucket_data(path):
     :return: json data
     """
 
-    # base bitbucket url
-    bitbucket_api = "https://api.bitbucket.org/2.0/"
+    url = build_bitbucket_url(path)
 
-    # construct url
-    if 'api.bitbucket.org' not in path:
-        url = os.path.join(bitbucket_api, path)
+    # identical calls inside a batch are made once - only the parsed data is shared, not the response
+    return dedupe_call(('bitbucket', url), partial(fetch_bitbucket_data, url))
 
-    # go to url directly
-    else:
-        url = path
 
-    # request
-    r = requests.get(url)
+def fetch_bitbucket_data(url):
+    """
+    Given a url make the request, return json data
+    :param url: full url
+    :return: json data
+    """
+
+    # request - pooled keep-alive connection
+    r = http_get(url)
 
     # check it's good to go if so return the json data
     if r.status_code == 200:
@@ -50,155 +129,345 @@ def get_bitbucket_data(path):
     return result
 
 
-def page_thru_bitbucket_data_json(path):
+def get_bitbucket_page_values(url):
+    """
+    Given a page url grab the values on that page, fail loudly if it could not be grabbed - a missing page would
+    silently undercount every stat
+    :param url: page url
+    :return: list of values
+    """
+
+    return get_bitbucket_result(url)['values']
+
+
+def build_bitbucket_page_url(path, fields=None):
+    """
+    Given a list endpoint build the url of its first page - biggest page bitbucket allows
+    :param path: endpoint
+    :param fields: partial response filter - must keep next, size and pagelen, default is None meaning whole objects
+    :return: url
+    """
+
+    params = {'pagelen': BITBUCKET_PAGELEN}
+
+    if fields:
+        params['fields'] = fields
+
+    return set_query_params(path, **params)
+
+
+def page_thru_bitbucket_data_json(path, max_workers=None, fields=None):
     """
     Parse through all bitbucket data, grab all data from all pages
     :param path: endpoint
+    :param max_workers: max number of pages fetched at once, default is None meaning use MAX_WORKERS
+    :param fields: partial response filter - must keep next, size and pagelen, default is None meaning whole objects
     :return: all data for given endpoint
     """
 
-    # grab all the data
-    all_data = []
+    # first time call - the next links bitbucket sends keep the same params
+    data = get_bitbucket_data(build_bitbucket_page_url(path, fields))
 
-    # first time call
-    data = get_bitbucket_data(path)['result']
+    # nothing to page through
+    if not data:
+        return {'result': []}
 
-    # next only appears if there is a next page
-    while 'next' in data.keys():
-        all_data.append(data['values'])     # get just the values node (all data we care about is in there)
-        data = get_bitbucket_data(data['next'])['result']   # get the data from the next page
+    data = data['result']
 
-    # grab data - in cases where there is no next ex: first item with no next, last time with no next
-    all_data.append(data['values'])
+    # grab all the data - values node holds all data we care about
+    all_data = [data['values']]
 
-    # flatten if necessary (list of lists of dicts) - in case where there was a next
-    if len(all_data) > 1:
-        r = flatten_list(all_data)
+    # size known - work out the number of pages and fetch the rest in parallel (comes back in page order)
+    if 'next' in data.keys() and 'size' in data.keys():
+        last_page = int(math.ceil(data['size'] / float(data['pagelen'])))
+        urls = [set_query_params(data['next'], page=page) for page in range(2, last_page+1)]
+        all_data += run_in_pool(get_bitbucket_page_values, urls, max_workers)
 
+    # no size - next only appears if there is a next page
     else:
-        r = all_data[0]
+        while 'next' in data.keys():
+            data = get_bitbucket_result(data['next'])   # get the data from the next page
+            all_data.append(data['values'])
+
+    record_pages('bitbucket', len(all_data))
+
+    # flatten the list of lists of dicts
+    r = flatten_list(all_data)
 
     result = {'result': r}
 
     return result
 
 
-def get_bitbucket_stats(user):
+def get_bitbucket_result(url):
     """
-    Given a user (or team), grab all desired stats
+    Given a url grab its json data, fail loudly if it could not be grabbed
+    :param url: url
+    :return: json data
+    """
+
+    data = get_bitbucket_data(url)
+
+    if not data:
+        raise ValueError("Could not grab {}".format(url))
+
+    return data['result']
+
+
+def get_bitbucket_size(url):
+    """
+    Given a url for a list endpoint grab the total size - ex: watchers, followers
+    :param url: url
+    :return: size
+    """
+
+    # only the size comes back - none of the list items
+    return get_bitbucket_result(build_bitbucket_size_url(url))['size']
+
+
+def build_bitbucket_size_url(url):
+    """
+    Given a url for a list endpoint build the url asking only for its total size
+    :param url: url - ex: watchers, followers
+    :return: url
+    """
+
+    return set_query_params(url, fields=BITBUCKET_SIZE_FIELDS)
+
+
+def build_bitbucket_commits_url(url):
+    """
+    Given a repo commits url build the url of its first page - biggest page, only each commit's hash and the next link
+    :param url: url
+    :return: url
+    """
+
+    return set_query_params(url, pagelen=BITBUCKET_PAGELEN, fields=BITBUCKET_COMMIT_FIELDS)
+
+
+def build_bitbucket_open_issues_url(url):
+    """
+    Given a repo issues url build the url counting only its open issues
+    :param url: url
+    :return: url
+    """
+
+    return set_query_params(url, q=BITBUCKET_OPEN_ISSUES_QUERY, fields=BITBUCKET_SIZE_FIELDS)
+
+
+def is_original_repo(repo):
+    """
+    Given a bitbucket repo tell whether it is an original - parent only set on forks
+    :param repo: repo json
+    :return: True if not a fork
+    """
+
+    return repo.get('parent') is None
+
+
+@profiled
+def get_bitbucket_repo_table(repos):
+    """
+    Given bitbucket repos build the repo table the repo stats are summed and counted from - bitbucket only has sizes
+    :param repos: list of repo json
+    :return: repo table
+    """
+
+    return RepoTable.from_columns(
+        [repo['full_name'] for repo in repos],
+
+        # no language set comes back empty
+        [repo.get('language') or 'Not Specified' for repo in repos],
+
+        # differentiate between original & forked repos
+        ['original' if is_original_repo(repo) else 'forked' for repo in repos],
+        size=[repo['size'] for repo in repos])
+
+
+def get_bitbucket_commit_count(url):
+    """
+    Given a repo commits url count all of its commits - every page is walked, moving only each commit's hash
+    :param url: url
+    :return: number of commits
+    """
+
+    data = get_bitbucket_result(build_bitbucket_commits_url(url))
+    count = len(data['values'])
+    pages = 1
+
+    # commits have no size - next only appears if there is a next page
+    while 'next' in data:
+        data = get_bitbucket_result(data['next'])
+        count += len(data['values'])
+        pages += 1
+
+    record_pages('bitbucket', pages)
+
+    return count
+
+
+def get_bitbucket_open_issue_count(url):
+    """
+    Given a repo issues url count its open issues - filtered upstream, one small response however many issues there are
+    :param url: url
+    :return: number of open issues, None if the repo has no issue data
+    """
+
+    issues_link = get_bitbucket_data(build_bitbucket_open_issues_url(url))
+
+    # no data in issues endpoint
+    if not issues_link:
+        return None
+
+    return issues_link['result']['size']
+
+
+def get_bitbucket_producers(user, max_workers=None, fields=None):
+    """
+    Given a user (or team) get how each stat (and each value the stats share) is computed - nothing is called until asked for
     :param user: bitbucket user or team
-    :return: aggregated bitbucket stats
+    :param max_workers: max number of upstream calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them - only their per-repo calls are made
+    :return: name -> function taking the lazy stats
     """
 
-    # users endpoint
-    user_data = get_bitbucket_data('users/{}'.format(user))
+    def wanted(stat):
+        return fields is None or stat in fields
 
-    # if you cannot get from users endpoint then teams
-    if not user_data:
-        user_data = get_bitbucket_data('teams/{}'.format(user))
+    def profile(stats):
+        with time_stage('bitbucket', 'profile'):
+            # users endpoint
+            user_data = get_bitbucket_data('users/{}'.format(user))
 
-    # could not get from users or teams
-    if not user_data:
-        # raise ValueError("Given user is not of type 'teams' or type 'user, please check again")
+            # if you cannot get from users endpoint then teams
+            if not user_data:
+                user_data = get_bitbucket_data('teams/{}'.format(user))
 
-        result = {"message": "Given user is not of type 'teams' or type 'user, please check user is a valid bitbucket user."}
+        return user_data
 
-    else:
-        # get results of data
-        data = user_data['result']
+    def all_repos(stats):
+        # only the repo keys read below
+        return page_thru_bitbucket_data_json(stats['links']['repositories']['href'], max_workers,
+                                             BITBUCKET_REPO_FIELDS)['result']
 
-        # links holds all the endpoints/links we will need to go through
-        user_data_links = data['links']
+    def repo_calls(stats):
+        # independent per-repo upstream calls - (repo full name, stat, call) - only the ones the stats asked for need
+        tasks = []
 
-        # go through all of the repos for the user
-        parse_thru_repos = page_thru_bitbucket_data_json(user_data_links['repositories']['href'])['result']
+        for repo in stats['all_repos']:
 
-        commits = []
-        watchers = []
-        size = []
-        language = []
-        issues = []
-        repo_types = []
+            # count commits per repo - only for original
+            if wanted('total_commits') and is_original_repo(repo):
+                tasks.append((repo['full_name'], 'commits',
+                              partial(get_bitbucket_commit_count, repo['links']['commits']['href'])))
 
-        for repo in parse_thru_repos:
+            # count open issues - if it has (not all repos have issues)
+            if wanted('total_open_issues') and 'issues' in repo['links']:
+                tasks.append((repo['full_name'], 'issues',
+                              partial(get_bitbucket_open_issue_count, repo['links']['issues']['href'])))
 
-            # differentiate between original & forked repos
-            if 'parent' not in repo.keys():     # parent only appears in forked repos
-                repo_type = 'original'
+        # run every per-repo call - comes back in task order
+        with time_stage('bitbucket', 'repo_calls'):
+            task_results = run_tasks([task for _, _, task in tasks], max_workers)
 
-                # get commits per repo - only for original
-                commits += get_bitbucket_data(repo['links']['commits']['href'])['result']['values']
+        result = {'commits': [], 'issues': [], 'failed_repos': []}
 
-            else:
-                repo_type = 'forked'
+        # per-repo failures are recorded, the rest of the stats still go out
+        for (repo_name, stat, _), (value, error) in zip(tasks, task_results):
 
-            # add repo types to list - counted later
-            repo_types.append(repo_type)
+            if error:
+                result['failed_repos'].append({'repo': repo_name, 'stat': stat, 'error': str(error)})
 
-            # get sizes of repo - add repo size to list
-            size.append(repo['size'])
+            elif stat == 'commits':
+                result['commits'].append(value)
 
-            # get languages - add language to list
-            if 'language' in repo.keys():
-                if repo['language'] == '':
-                    repo['language'] = 'Not Specified'
+            elif stat == 'issues' and value is not None:
+                result['issues'].append(value)
 
-                language.append(repo['language'])
+        return result
 
-            # get watchers per repo - add watchers to list
-            watchers.append(get_bitbucket_data(repo['links']['watchers']['href'])['result']['size'])
+    producers = {
+        'profile': profile,
 
-            # get all issues - if it has (not all repos have issues)
-            if 'issues' in repo['links']:
+        # links holds all the endpoints/links we will need to go through
+        'links': lambda stats: stats['profile']['result']['links'],
+        'all_repos': all_repos,
 
-                # hit issues endpoint
-                issues_link = get_bitbucket_data(repo['links']['issues']['href'])
+        # every sum and count in one pass over the repo columns
+        'repo_table': lambda stats: get_bitbucket_repo_table(stats['all_repos']),
+        'summary': lambda stats: stats['repo_table'].summarize(),
+        'repo_calls': repo_calls,
 
-                # if data in issues endpoint then grab the values
-                if issues_link:
-                    all_issues = issues_link['result']['values']
+        # user/team, total follower count, total following count
+        'user': lambda stats: stats['profile']['result']['username'],
+        'followers': lambda stats: get_bitbucket_size(stats['links']['followers']['href']),
+        'following': lambda stats: get_bitbucket_size(stats['links']['following']['href']),
 
-                # create list/count of issues
-                issues.append(count_items_in_list(all_issues, 'state'))
+        # total number of public repos (original vs forked), list/count of languages used, total size of their account
+        'repos': lambda stats: stats['summary']['count']['pub_repo_type'],
+        'languages': lambda stats: stats['summary']['count']['language'],
+        'total_account_size': lambda stats: stats['summary']['sum']['size'],
 
-        # get followers info
-        followers = get_bitbucket_data(user_data_links['followers']['href'])
+        # total number of open issues
+        'total_open_issues': lambda stats: sum(stats['repo_calls']['issues']),
 
-        # get following info
-        following = get_bitbucket_data(user_data_links['following']['href'])
+        # total number of commits to their repos (not forks)
+        'total_commits': lambda stats: sum(stats['repo_calls']['commits'])
 
-        result = {
+        # total number of stars given, stars received, list/count of repo topics - NA
+    }
 
-            # user/team
-            "user": data['username'],
+    return producers
 
-            # total follower count
-            "followers": followers['result']['size'],
 
-            # total following count
-            "following": following['result']['size'],
+def iter_bitbucket_stats(user, max_workers=None, fields=None):
+    """
+    Given a user (or team), grab the desired stats one at a time - cheapest first, only the upstream calls they need
+    :param user: bitbucket user or team
+    :param max_workers: max number of upstream calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: generator of (stat, value) - only ('message', ...) if the user is not valid
+    """
 
-            # total number of stars given - NA
+    stats = LazyStats(get_bitbucket_producers(user, max_workers, fields))
 
-            # total number of stars received - NA
+    # could not get from users or teams
+    if not stats['profile']:
+        yield "message", "Given user is not of type 'teams' or type 'user, please check user is a valid bitbucket user."
+        return
 
-            # list/count of repo topics - NA
+    wanted = [stat for stat in BITBUCKET_STATS_COST_ORDER if fields is None or stat in fields]
 
-            # list/count of languages used
-            "languages": count_items_in_list(language),
+    # followers & following info alongside going through all of the repos for the user
+    needs_repos = [stat for stat in wanted if stat not in ['user', 'followers', 'following']]
 
-            # total number of public repos (original vs forked)
-            "repos": count_items_in_list(repo_types),
+    # what the prefetched values all need - computed once here, not raced for on their threads
+    stats['links']
 
-            # total number of open issues
-            "total_open_issues": get_specific_count_to_sum(issues, 'new'),
+    with time_stage('bitbucket', 'repos'):
+        stats.prefetch([stat for stat in ['followers', 'following'] if stat in wanted] +
+                       (['all_repos'] if needs_repos else []), max_workers)
 
-            # total number of commits to their repos (not forks)
-            "total_commits": len(commits),
+    for stat in wanted:
+        yield stat, stats[stat]
 
-            # total size of their account
-            "total_account_size": sum(size)
+    # only there when some of the per-repo calls failed
+    if stats.computed('repo_calls') and stats['repo_calls']['failed_repos']:
+        yield "failed_repos", stats['repo_calls']['failed_repos']
 
-        }
 
-    return result
+def get_bitbucket_stats(user, max_workers=None, fields=None):
+    """
+    Given a user (or team), grab all desired stats
+    :param user: bitbucket user or team
+    :param max_workers: max number of upstream calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: aggregated bitbucket stats
+    """
+
+    try:
+        return collect_stats(iter_bitbucket_stats(user, max_workers, fields), BITBUCKET_STATS_KEYS)
+
+    # out of upstream quota - report it like any other error
+    except RateLimitError as e:
+        return {"message": str(e)}
@@ -0,0 +1,431 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError
+
+from flask_restful import Resource
+
+from coalesce import stats_flight, url_flight
+from responses import serialized_cache
+from util import GITHUB_CACHE_TTL, BITBUCKET_CACHE_TTL, NEGATIVE_CACHE_TTL, STALE_CACHE_TTL, CACHE_MAX_ENTRIES, \
+    CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES
+
+
+class CacheAPI(Resource):       # used to hit cache stats endpoint
+    def get(self):
+        """
+        Report the stats cache counters
+        :return: hits, misses, evictions, entries and bytes
+        """
+
+        result = {
+            'data': stats_cache.stats(),
+            'github_responses': github_response_cache.stats(),
+            'coalesced_stats': stats_flight.stats(),
+            'coalesced_calls': url_flight.stats(),
+            'serialized_responses': serialized_cache.stats()
+        }
+
+        return result
+
+
+class StatsCache(object):
+    """
+    Bounded in-memory cache of computed stats dicts - expires by ttl, evicts least recently used by entry count and size
+    """
+
+    def __init__(self, ttls, negative_ttl, max_entries, max_bytes, stale_ttl=0):
+        """
+        :param ttls: seconds to keep a result per provider - ex: {'github': 300}
+        :param negative_ttl: seconds to keep an error result (has a 'message') or a partial one (has 'failed_repos')
+        :param max_entries: max number of results kept
+        :param max_bytes: max approximate size of all results kept
+        :param stale_ttl: seconds an expired result is still kept around to be served while it is refreshed
+        """
+        self.ttls = ttls
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+
+        # key -> (value, expires at, size, stored at, kept until) - ordered least to most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.bypasses = 0
+
+    def get(self, key):
+        """
+        Given a key get the cached value if it has not expired
+        :param key: (provider, user)
+        :return: cached value or None
+        """
+
+        return self.get_with_age(key)[0]
+
+    def get_with_age(self, key):
+        """
+        Given a key get the cached value if it has not expired, and how old it is
+        :param key: (provider, user)
+        :return: cached value, age in seconds - (None, None) if missing or expired
+        """
+
+        with self.lock:
+            entry = self._get_entry(key)
+
+            # missing or expired - expired but still within the stale window is kept for get_stale
+            if not entry or entry[1] <= time.monotonic():
+                self.misses += 1
+                return None, None
+
+            # most recently used goes to the end
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[0], time.monotonic() - entry[3]
+
+    def get_stale(self, key):
+        """
+        Given a key get the cached value even if it expired, as long as it is within the stale window
+        :param key: (provider, user)
+        :return: cached value, age in seconds - (None, None) if missing
+        """
+
+        with self.lock:
+            entry = self._get_entry(key)
+
+            if not entry:
+                return None, None
+
+            self.entries.move_to_end(key)
+            self.stale_hits += 1
+
+            return entry[0], time.monotonic() - entry[3]
+
+    def get_expiry(self, key):
+        """
+        Given a key get how long until its value expires
+        :param key: (provider, user)
+        :return: seconds until it expires (negative once expired), None if missing
+        """
+
+        with self.lock:
+            entry = self._get_entry(key)
+
+            if not entry:
+                return None
+
+            return entry[1] - time.monotonic()
+
+    def set(self, key, value):
+        """
+        Given a key and a stats dict cache it - error and partial results only for the negative ttl, never served stale
+        :param key: (provider, user)
+        :param value: stats dict
+        """
+
+        # error results and partial ones (some repos failed) are only cached briefly
+        if 'message' in value or value.get('failed_repos'):
+            ttl, stale_ttl = self.negative_ttl, 0
+        else:
+            ttl, stale_ttl = self.ttls[key[0]], self.stale_ttl
+
+        # approximate size - the serialized result
+        size = len(json.dumps(value))
+
+        # never going to fit
+        if ttl <= 0 or size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            now = time.monotonic()
+            self.entries[key] = (value, now + ttl, size, now, now + ttl + stale_ttl)
+            self.total_bytes += size
+
+            # evict least recently used until within bounds
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, bypass=False):
+        """
+        Given a key get the cached value, compute and cache it if missing - concurrent misses share one computation
+        :param key: (provider, user)
+        :param compute: function returning the stats dict
+        :param bypass: skip the lookup and refresh the cached value
+        :return: stats dict
+        """
+
+        if bypass:
+            with self.lock:
+                self.bypasses += 1
+        else:
+            value = self.get(key)
+            if value is not None:
+                return value
+
+        return self.compute(key, compute)
+
+    def compute(self, key, compute):
+        """
+        Given a key compute and cache its value - concurrent computations of the same key share one
+        :param key: (provider, user)
+        :param compute: function returning the stats dict
+        :return: stats dict
+        """
+
+        def compute_and_set():
+            result = compute()
+            self.set(key, result)
+            return result
+
+        try:
+            return stats_flight.do(key, compute_and_set)
+
+        # waited too long on someone else's computation - not cached
+        except TimeoutError:
+            return {'message': "Timed out waiting on the {} stats for {}".format(*key)}
+
+    def stats(self):
+        """
+        Get the cache counters
+        :return: counters json
+        """
+
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+                'bypasses': self.bypasses,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+    def clear(self):
+        """
+        Drop every cached value
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _get_entry(self, key):
+        # caller holds the lock - drops the entry once it is past the stale window
+        entry = self.entries.get(key)
+
+        if entry and entry[4] <= time.monotonic():
+            self._remove(key)
+            entry = None
+
+        return entry
+
+    def _remove(self, key):
+        # caller holds the lock
+        self.total_bytes -= self.entries.pop(key)[2]
+
+
+# process wide stats cache
+stats_cache = StatsCache(ttls={'github': GITHUB_CACHE_TTL, 'bitbucket': BITBUCKET_CACHE_TTL},
+                         negative_ttl=NEGATIVE_CACHE_TTL,
+                         max_entries=CACHE_MAX_ENTRIES,
+                         max_bytes=CACHE_MAX_BYTES,
+                         stale_ttl=STALE_CACHE_TTL)
+
+
+def get_stats_key(provider, user, fields=None):
+    """
+    Given a provider, user and the stats asked for get the stats cache key - ?fields= subsets are cached on their own
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param fields: stats wanted (canonical order), default is None meaning all of them
+    :return: (provider, user) or (provider, user, fields)
+    """
+
+    if fields is None:
+        return provider, user
+
+    return provider, user, tuple(fields)
+
+
+def get_cached_stats(provider, user, compute, bypass=False):
+    """
+    Given a provider and user get the stats through the stats cache
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param compute: function returning the stats dict
+    :param bypass: skip the cache lookup and refresh it
+    :return: stats dict
+    """
+
+    return stats_cache.get_or_compute((provider, user), compute, bypass)
+
+
+class CachedResponse(object):
+    """
+    Stored upstream response - only what the callers read off of a requests response
+    """
+
+    def __init__(self, body, headers, size, status_code=200):
+        """
+        :param body: parsed json body
+        :param headers: response headers
+        :param size: size of the raw body
+        :param status_code: response status
+        """
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+        self.size = size
+
+    def json(self):
+        """
+        Get the already parsed body - shared, do not mutate
+        :return: json body
+        """
+
+        return self.body
+
+
+class ResponseCache(object):
+    """
+    Bounded store of upstream responses revalidated with ETag / Last-Modified - evicts least recently used
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        """
+        :param max_entries: max number of responses kept
+        :param max_bytes: max approximate size of all responses kept
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # key -> (etag, last modified, cached response) - ordered least to most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        # counters
+        self.not_modified = 0
+        self.modified = 0
+        self.evictions = 0
+
+    def validators(self, key):
+        """
+        Given a key get the conditional request headers for the stored response
+        :param key: (url, accept)
+        :return: If-None-Match / If-Modified-Since headers, empty if nothing stored
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        headers = {}
+
+        if entry:
+            if entry[0]:
+                headers['If-None-Match'] = entry[0]
+            if entry[1]:
+                headers['If-Modified-Since'] = entry[1]
+
+        return headers
+
+    def revalidated(self, key):
+        """
+        Given a key the upstream answered 304 for, get the stored response
+        :param key: (url, accept)
+        :return: cached response or None if it was evicted in the meantime
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if not entry:
+                return None
+
+            self.entries.move_to_end(key)
+            self.not_modified += 1
+
+            return entry[2]
+
+    def store(self, key, r, project=None):
+        """
+        Given a key and a 200 response keep it if it can be revalidated
+        :param key: (url, accept)
+        :param r: requests response
+        :param project: function taking the parsed body returning only what the callers read, default is None meaning
+        keep the whole body
+        :return: cached response
+        """
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+
+        # parse once - every later 304 serves this body
+        if project is None:
+            cached = CachedResponse(r.json(), r.headers, len(r.content))
+
+        # approximate size - the serialized projection
+        else:
+            body = project(r.json())
+            cached = CachedResponse(body, r.headers, len(json.dumps(body)))
+
+        with self.lock:
+            self.modified += 1
+
+            # nothing to revalidate with or never going to fit
+            if not (etag or last_modified) or cached.size > self.max_bytes:
+                return cached
+
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[2].size
+
+            self.entries[key] = (etag, last_modified, cached)
+            self.total_bytes += cached.size
+
+            # evict least recently used until within bounds
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.entries.popitem(last=False)[1][2].size
+                self.evictions += 1
+
+        return cached
+
+    def stats(self):
+        """
+        Get the response cache counters
+        :return: counters json
+        """
+
+        with self.lock:
+            return {
+                'not_modified': self.not_modified,
+                'modified': self.modified,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+    def clear(self):
+        """
+        Drop every stored response
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+# process wide github response cache
+github_response_cache = ResponseCache(max_entries=RESPONSE_CACHE_MAX_ENTRIES, max_bytes=RESPONSE_CACHE_MAX_BYTES)
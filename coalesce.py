@@ -0,0 +1,188 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future
+
+from util import COALESCE_WAIT_TIMEOUT
+
+# calls made while handling one batch - shared by every task the batch spawns
+batch_scope = contextvars.ContextVar('batch_scope', default=None)
+
+
+class CallScope(object):
+    """
+    Remembers calls by key so identical calls are made once - later and concurrent callers share the first call's result,
+    kept until the scope is gone so hand it parsed values rather than whole responses
+    """
+
+    def __init__(self):
+        # key -> future holding the result of the first call
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def call(self, key, func):
+        """
+        Given a key and a function call it once for the key
+        :param key: hashable key - ex: (provider, url)
+        :param func: function taking no arguments
+        :return: result of the first call for the key, raises its error if it failed
+        """
+
+        with self.lock:
+            future = self.calls.get(key)
+            first = future is None
+
+            if first:
+                future = self.calls[key] = Future()
+
+        # first caller makes the call, everyone else waits on it
+        if first:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+
+class SingleFlight(object):
+    """
+    Concurrent callers with the same key wait on one in-flight call and share its result - forgotten once it is done
+    """
+
+    def __init__(self, timeout=None):
+        """
+        :param timeout: max seconds a waiting caller waits on the in-flight call, None waits as long as it takes
+        """
+        self.timeout = timeout
+
+        # key -> future of the in-flight call
+        self.calls = {}
+        self.lock = threading.Lock()
+
+        # counters
+        self.started = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Given a key and a function call it, or wait on the call already in flight for the key
+        :param key: hashable key - ex: (provider, user)
+        :param func: function taking no arguments
+        :return: result of the in-flight call, raises its error if it failed or TimeoutError if waited too long
+        """
+
+        with self.lock:
+            future = self.calls.get(key)
+            first = future is None
+
+            if first:
+                future = self.calls[key] = Future()
+                self.started += 1
+            else:
+                self.shared += 1
+
+        # someone else is on it - wait
+        if not first:
+            return future.result(timeout=self.timeout)
+
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            # waiters get the same error
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+        return future.result()
+
+    def stats(self):
+        """
+        Get the single flight counters
+        :return: counters json
+        """
+
+        with self.lock:
+            return {
+                'started': self.started,
+                'shared': self.shared,
+                'in_flight': len(self.calls)
+            }
+
+
+class AsyncFlight(object):
+    """
+    Concurrent coroutines with the same key wait on one in-flight call and share its result - forgotten once it is done,
+    every caller on the same event loop
+    """
+
+    def __init__(self):
+        # key -> task of the in-flight call
+        self.calls = {}
+
+        # counters
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key, func):
+        """
+        Given a key and a coroutine function call it, or wait on the call already in flight for the key
+        :param key: hashable key - ex: (provider, user)
+        :param func: coroutine function taking no arguments
+        :return: result of the in-flight call, raises its error if it failed - a caller cancelled (ex: timed out) leaves
+        the call running for the others
+        """
+
+        task = self.calls.get(key)
+
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        # the call is done - the next caller starts a new one, its error counts as seen even if every caller gave up
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+        if not task.cancelled():
+            task.exception()
+
+
+# process wide single flights - concurrent requests for the same user stats, concurrent calls to the same upstream url
+stats_flight = SingleFlight(timeout=COALESCE_WAIT_TIMEOUT)
+url_flight = SingleFlight(timeout=COALESCE_WAIT_TIMEOUT)
+
+
+def new_batch_context():
+    """
+    Get a context with a fresh batch scope - run each of the batch's tasks in a copy of it
+    :return: contextvars context
+    """
+
+    context = contextvars.copy_context()
+    context.run(batch_scope.set, CallScope())
+
+    return context
+
+
+def dedupe_call(key, func):
+    """
+    Given a key and a function call it - concurrent identical calls share one call, inside a batch once per key
+    :param key: hashable key - ex: (provider, url)
+    :param func: function taking no arguments
+    :return: result
+    """
+
+    scope = batch_scope.get()
+
+    # not in a batch - only share with calls in flight
+    if scope is None:
+        return url_flight.do(key, func)
+
+    return scope.call(key, lambda: url_flight.do(key, func))
@@ -1,9 +1,41 @@
 import os
+from functools import partial
+from urllib.parse import urlsplit
 
-import requests
+from flask import request
 from flask_restful import Resource
 
-from util import flatten_list, count_items_in_list, AUTH
+from cache import github_response_cache, CachedResponse
+from coalesce import dedupe_call
+from options import get_request_options
+from metrics import time_stage
+from profiling import profiled, profile_request, record_pages
+from ratelimit import RateLimitError
+from refresher import serve_stats, get_age_headers
+from repo_store import repo_store, get_repo_version
+from repo_table import RepoTable
+from responses import serve_serialized
+from streaming import stream_response, stream_provider_stats
+from transport import http_get
+from util import flatten_list, count_items_in_list, collect_stats, LazyStats, run_in_pool, iter_in_pool, \
+    parse_link_header, get_query_param, set_query_params, GITHUB_API_URL
+
+
+# biggest page size github allows for list endpoints
+GITHUB_PER_PAGE = 100
+
+# repo keys the stats read - stored repo listing pages keep only these (not the owner, permissions, *_url links...)
+GITHUB_REPO_KEYS = ['full_name', 'fork', 'language', 'forks_count', 'watchers_count', 'open_issues_count',
+                    'stargazers_count', 'url', 'html_url', 'size', 'pushed_at', 'updated_at']
+
+# github stats in the order they are reported
+GITHUB_STATS_KEYS = ['user', 'followers', 'following', 'total_stars_given', 'total_stars_received', 'repo_topics',
+                     'languages', 'repos', 'total_watchers', 'total_open_issues', 'total_commits', 'total_account_size']
+
+# github stats in the order they are computed - cheapest first, the per-repo fan-outs last
+GITHUB_STATS_COST_ORDER = ['user', 'followers', 'following', 'repos', 'languages', 'total_stars_received',
+                           'total_watchers', 'total_open_issues', 'total_account_size', 'total_stars_given',
+                           'repo_topics', 'total_commits']
 
 
 class GithubAPI(Resource):      # used to hit github stats endpoint
@@ -14,28 +46,88 @@ class GithubAPI(Resource):      # used to hit github stats endpoint
         :return: stats
         """
 
+        # query string options - ex: ?workers=4&nocache=1&stream=ndjson&fields=followers,repos
+        try:
+            options = get_request_options(request.args, GITHUB_STATS_KEYS)
+        except ValueError as e:
+            return {'message': str(e)}, 400
+
+        max_workers, bypass, fields = options['max_workers'], options['bypass'], options['fields']
+
+        # send each stat as soon as it is computed
+        if options['stream_format']:
+            events = stream_provider_stats('github', gh_user, partial(iter_github_stats, gh_user, max_workers, fields),
+                                           GITHUB_STATS_KEYS, bypass, fields)
+            return stream_response(events, options['stream_format'])
+
+        # through the stats cache - hot users are kept warm, X-Stats-Age tells how old cached stats are
+        with profile_request(options['profile']) as profile:
+            data, age = serve_stats('github', gh_user, lambda: get_github_stats(gh_user, max_workers, fields), bypass,
+                                    fields)
+
         result = {
-            'data': get_github_stats(gh_user)
+            'data': data
         }
 
-        return result
+        # ?profile=1 - where the time went
+        if profile:
+            result['profile'] = profile.report()
 
+        # serialized once while the cache hands out the same stats - compressed if accepted, 304 on a matching ETag
+        return serve_serialized(('github', gh_user, fields), [data], lambda: result, get_age_headers(age), cache=not profile)
 
-def get_github_data(path):
+
+def fetch_github_response(url, headers, project=None):
     """
-    Given path extract the endpoint data, provide the appropriate Accept return the request and the endpoint
+    Given a url and headers make the request, revalidating the stored response if there is one
+    :param url: full url
+    :param headers: request headers - must have the Accept
+    :param project: function taking the parsed body returning only what is read of it - ex: project_repos, default is
+    None meaning the whole body
+    :return: cached response - parsed
+    """
+
+    # revalidate the stored response if there is one - 304s do not count against the rate limit
+    key = (url, headers['Accept'])
+    r = http_get(url, headers=dict(headers, **github_response_cache.validators(key)))     # authenticated, pooled
+
+    # not modified - serve the stored body (refetch in full if it was evicted in the meantime)
+    if r.status_code == 304:
+        r = github_response_cache.revalidated(key) or http_get(url, headers=headers)
+
+    # new or changed - parse once and keep it for the next revalidation
+    if r.status_code == 200 and not isinstance(r, CachedResponse):
+        r = github_response_cache.store(key, r, project)
+
+    # error - keep only what the callers read off of it, not the raw response (a batch holds on to it)
+    elif not isinstance(r, CachedResponse):
+        try:
+            body = r.json()
+        except ValueError:
+            body = None
+
+        r = CachedResponse(body, r.headers, len(r.content), r.status_code)
+
+    return r
+
+
+def build_github_request(path):
+    """
+    Given path extract the endpoint, construct the url and provide the appropriate Accept
     :param path: endpoint
-    :return: result - request, endpoint
+    :return: url, headers, endpoint
     """
 
-    # parse out endpoint
-    endpoint = path.split('/')[-1]     # no endpoint for the user profile
+    # parse out endpoint - ignore the query string
+    endpoint = urlsplit(path).path.rstrip('/').split('/')[-1]     # no endpoint for the user profile
 
-    # base github api url
-    github_api = "https://api.github.com"
+    # construct specific url - links handed back by github are already full urls
+    if '://' not in path:
+        url = os.path.join(GITHUB_API_URL, path)
 
-    # construct specific url
-    url = os.path.join(github_api, path)
+    # go to url directly
+    else:
+        url = path
 
     # topics requires a different Accept
     if endpoint == 'topics':
@@ -43,8 +135,23 @@ def get_github_data(path):
     else:
         headers = {'Accept': 'application/vnd.github.VERSION.full+json'}
 
-    # request, authenticated
-    r = requests.get(url, headers=headers, auth=AUTH)
+    return url, headers, endpoint
+
+
+def get_github_data(path):
+    """
+    Given path extract the endpoint data, provide the appropriate Accept return the request and the endpoint
+    :param path: endpoint
+    :return: result - request, endpoint
+    """
+
+    url, headers, endpoint = build_github_request(path)
+
+    # repo listings are kept with only the repo keys the stats read
+    project = project_repos if endpoint == 'repos' else None
+
+    # identical calls inside a batch are made once
+    r = dedupe_call(('github', url, headers['Accept']), partial(fetch_github_response, url, headers, project))
 
     # result = request and given endpoint
     result = {
@@ -55,119 +162,184 @@ def get_github_data(path):
     return result
 
 
-def get_github_pagination(link_str, endpoint):
+def project_repos(repos):
     """
-    Given the Link string from the requests header and the specific endpoint determine the user (id) and the total number of pages
+    Given a page of json repos keep only the keys the stats read
+    :param repos: list of json repos
+    :return: list of json repos with only GITHUB_REPO_KEYS
+    """
+
+    return [{key: repo[key] for key in GITHUB_REPO_KEYS if key in repo} for repo in repos]
+
+
+def get_github_pagination(link_str):
+    """
+    Given the Link string from the requests header determine the last page url and the total number of pages
     :param link_str: Link string from request header
-    :param endpoint: endpoint
-    :return: user (id), last page number
+    :return: last page url, last page number - (None, 1) when there is no last page
     """
     # parse the last page info from the Link header
-    last_info = link_str.split(',')[1]
+    last_url = parse_link_header(link_str).get('last')
 
-    # grab user id and last page - commits is different, hits repositories endpoint
-    if endpoint != 'commits':
-        user, last_page = last_info.split('user/')[1].split('/{}?'.format(endpoint))[0], last_info.split('?page=')[1].split('>')[0]
-    else:
-        user, last_page = last_info.split('repositories/')[1].split('/{}?'.format(endpoint))[0], last_info.split('?page=')[1].split('>')[0]
+    # no last link - only one page
+    if not last_url:
+        return None, 1
 
-    return user, last_page
+    return last_url, int(get_query_param(last_url, 'page'))
 
 
 def page_thru_github_data_count(path):
     """
-    Given a path/endpoint, page through all of the pages and depending on the specific endpoint return the count of all of the data
+    Given a path/endpoint return the count of all of the data without downloading it - one item per page so the last page number is the count
     :param path: commits or starred endpoint
     :return: counts
     """
 
     result = 0
 
-    # get requested data
-    requested_data = get_github_data(path)
+    # get requested data - one item per page
+    requested_data = get_github_data(set_query_params(path, per_page=1))
 
     # continue if data grabbed without errors
     if requested_data['result'].status_code == 200:
 
-        # Link in header if there is more than one page
-        if 'Link' in requested_data['result'].headers.keys():
+        # grab the Link string from header - Link in header if there is more than one page
+        link_str = requested_data['result'].headers.get('Link')
 
-            # grab the Link string from header
-            link_str = requested_data['result'].headers['Link']
+        # last page number = number of items
+        last_url, last_page = get_github_pagination(link_str)
 
-            # grab user id and last page
-            user, last_page = get_github_pagination(link_str, requested_data['endpoint'])
+        if last_url:
+            result = last_page
 
-            # each page has 30(default) so quick assumptions - number of pages (minus the last one) can be multiplied by 30
-            pages = int(last_page) - 1
-            current_cnt = pages * 30  # 30 per page
+        else:   # only one page - zero or one items
+            result = len(requested_data['result'].json())
 
-            # grab the data from the last page - unknown count so add to assumed count
-            if requested_data['endpoint'] == 'starred':  # starred endpoint
-                url = 'user/{}/{}?page={}'.format(user, requested_data['endpoint'], last_page)
-            else:  # commits endpoint
-                url = 'repositories/{}/{}?page={}'.format(user, requested_data['endpoint'], last_page)
+    return result
 
-            # grab last page json data
-            data = get_github_data(url)['result'].json()
-            result = current_cnt + len(data)  # add assumed count plus the last page
 
-        else:   # only one page
-            result = len(requested_data['result'].json())
+def get_github_page_json(url):
+    """
+    Given a page url grab its json data, fail loudly if it could not be grabbed - an error body is not a page of data
+    :param url: page url
+    :return: json data
+    """
 
-    return result
+    r = get_github_data(url)['result']
+
+    if r.status_code != 200:
+        raise ValueError("Could not grab {}".format(url))
+
+    return r.json()
 
 
-def page_thru_github_data_json(path):
+def iter_github_pages(path, max_workers=None):
+    """
+    Given a path, page through all of the pages handing back each page's json in page order - the rest of the pages are
+    fetched in parallel, at most max_workers of them held at once
+    :param path: any list endpoint (not commits or starred - those are counted) or a single object such as the user profile
+    :param max_workers: max number of pages fetched at once, default is None meaning use MAX_WORKERS
+    :return: generator of page json - nothing if the data could not be grabbed
+    """
+
+    # get requested data - biggest page github allows
+    requested_data = get_github_data(set_query_params(path, per_page=GITHUB_PER_PAGE))
+
+    # stop if data not grabbed without errors
+    if requested_data['result'].status_code != 200:
+        return
+
+    # grab last page url and number - Link in header if there is more than one page
+    last_url, last_page = get_github_pagination(requested_data['result'].headers.get('Link'))
+
+    record_pages('github', last_page)
+
+    # first page is already here
+    yield requested_data['result'].json()
+
+    if last_url:
+
+        # construct the rest of the page urls to ping
+        urls = [set_query_params(last_url, page=page) for page in range(2, last_page+1)]
+
+        # fetch the rest in parallel - comes back in page order
+        for page in iter_in_pool(get_github_page_json, urls, max_workers):
+            yield page
+
+
+def page_thru_github_data_json(path, max_workers=None):
     """
     Given a path, page through all of the pages and depending on the specific endpoint return all of the data as a flattened json
-    :param path: repo (not commits or starred)
+    :param path: any list endpoint (not commits or starred - those are counted) or a single object such as the user profile
+    :param max_workers: max number of pages fetched at once, default is None meaning use MAX_WORKERS
     :return: flattened json
     """
 
-    all_data = []
-    result = []
+    all_data = list(iter_github_pages(path, max_workers))
 
-    # get requested data
-    requested_data = get_github_data(path)
+    # nothing grabbed
+    if not all_data:
+        return []
 
-    # continue if data grabbed without errors
-    if requested_data['result'].status_code == 200:
+    # one page - as is (ex: the user profile)
+    if len(all_data) == 1:
+        return all_data[0]
 
-        # Link in header if there is more than one page
-        if 'Link' in requested_data['result'].headers.keys():
+    # flatten the list with all the data (each page's data = list of dicts)
+    return flatten_list(all_data)
 
-            # grab the Link string from header
-            link_str = requested_data['result'].headers['Link']
 
-            # grab user id and last page
-            user, last_page = get_github_pagination(link_str, requested_data['endpoint'])
+class RepoRecord(object):
+    """
+    Cleaned up repo - only the fields the stats read, in slots instead of a dict, read like the dict (ex: repo['language'])
+    """
 
-            # page through each - needed for more details (repos)
-            for page in range(1,int(last_page)+1):
+    __slots__ = ('full_name', 'language', 'pub_repo_type', 'forks_count', 'watchers_count', 'open_issues_count',
+                 'star_count', 'api_url', 'url', 'size', 'pushed_at', 'updated_at')
 
-                # construct url to ping
-                url = 'user/{}/{}?page={}'.format(user, requested_data['endpoint'], page)
+    def __init__(self, **fields):
+        """
+        :param fields: field values - ex: full_name='user/repo', missing ones are None
+        """
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
 
-                # add to list
-                all_data.append(get_github_data(url)['result'].json())
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
 
-            # flatten the list with all the data (each page's data = list of dicts)
-            result = flatten_list(all_data)
+        return getattr(self, name)
 
-        else:
+    def __eq__(self, other):
+        return isinstance(other, RepoRecord) and self.to_dict() == other.to_dict()
 
-            # result as json data
-            result = requested_data['result'].json()
+    def __repr__(self):
+        return 'RepoRecord({!r})'.format(self.to_dict())
 
-    return result
+    def get(self, name, default=None):
+        """
+        Given a field name get its value
+        :param name: field name
+        :param default: value if it is not a field
+        :return: value
+        """
+
+        return getattr(self, name) if name in self.__slots__ else default
+
+    def to_dict(self):
+        """
+        Get the fields as the dict the record replaces
+        :return: cleaned up repo json
+        """
+
+        return {name: getattr(self, name) for name in self.__slots__}
 
 
 def get_repo_info(repo):
     """
     Given a specific json repo grab all the necessary data
     :param repo: specific repo
-    :return: cleaned up and wanted information json data
+    :return: cleaned up and wanted information record
     """
 
     # turn forked info into non bool
@@ -182,39 +354,36 @@ def get_repo_info(repo):
     else:
         language = 'Not Specified'
 
-    result = {
-        "full_name": repo['full_name'],
-        "language": language,
-        "pub_repo_type": forked,
-        "forks_count": repo['forks_count'],
-        "watchers_count": repo['watchers_count'],
-        "open_issues_count": repo['open_issues_count'],
-        "star_count": repo['stargazers_count'],
-        "api_url": repo['url'],
-        "url": repo['html_url'],
-        "size": repo['size']
-    }
+    result = RepoRecord(
+        full_name=repo['full_name'],
+        language=language,
+        pub_repo_type=forked,
+        forks_count=repo['forks_count'],
+        watchers_count=repo['watchers_count'],
+        open_issues_count=repo['open_issues_count'],
+        star_count=repo['stargazers_count'],
+        api_url=repo['url'],
+        url=repo['html_url'],
+        size=repo['size'],
+        pushed_at=repo.get('pushed_at'),
+        updated_at=repo.get('updated_at')
+    )
 
     return result
 
 
+@profiled
 def cleaned_repos_data(repos):
     """
-    Given the list of uncleaned/full json repos, parse only wanted information per repo
-    :param repos:
-    :return: cleaned information list of json repos
+    Given the uncleaned/full json repos, parse only wanted information per repo
+    :param repos: list of json repos - ex: one page of them, each full repo can be let go once cleaned
+    :return: cleaned information list of repo records
     """
 
-    # cleaned repos list
-    repos_data = []
-
-    # per each repo, clean up repo and save that
-    for repo in repos:
-        repos_data.append(get_repo_info(repo))
-
-    return repos_data
+    return [get_repo_info(repo) for repo in repos]
 
 
+@profiled
 def get_repo_summary(repos, item, action, repo_type=None):
     """
     Given a list of json repos takes in list of dicts and either sums up or counts
@@ -264,95 +433,195 @@ def get_repo_summary(repos, item, action, repo_type=None):
     return total
 
 
-def get_github_stats(user):
+def get_repo_topics(path):
     """
-    Given a github user get the summary stats
-    :param user: github user
-    :return: summary stats json
+    Given a repo topics path grab the list of topic names
+    :param path: repos/<full_name>/topics
+    :return: list of topic names
     """
-    # check user is valid
-    user_data = get_github_data('users/{}/repos'.format(user))['result']
 
-    if user_data.status_code != 200:
-        result = {
-            "message": user_data.json()['message']
-        }
+    return get_github_data(path)['result'].json()['names']
 
-    else:
-        # get repo data
-        repos = page_thru_github_data_json('users/{}/repos'.format(user))
-        all_repos = cleaned_repos_data(repos)
 
-        # get stars given
-        starred = page_thru_github_data_count('users/{}/starred'.format(user))
+def get_repo_topics_by_name(full_name):
+    """
+    Given a repo full name grab the list of topic names
+    :param full_name: repo full name - ex: user/repo
+    :return: list of topic names
+    """
 
-        # user profile
-        profile_data = page_thru_github_data_json('users/{}'.format(user))
+    return get_repo_topics('repos/{}/topics'.format(full_name))
 
-        # construct repo topics url
-        get_list_of_topics = ['repos/{}/topics'.format(user_repo)
-                              for user_repo in get_repo_summary(repos=all_repos, item='full_name', action='list')]
 
-        # construct repo commits url
-        get_list_of_repo_commits = ['repos/{}/commits'.format(user_repo)
-                                    for user_repo in get_repo_summary(all_repos, item='full_name', action='list', repo_type='original')]
+def get_repo_commit_count_by_name(full_name):
+    """
+    Given a repo full name count its commits
+    :param full_name: repo full name - ex: user/repo
+    :return: commit count
+    """
 
-        # list of json data - topics
-        repo_topics = []
-        for repo_topic in get_list_of_topics:
+    return page_thru_github_data_count('repos/{}/commits'.format(full_name))
 
-            repo_topics.append(get_github_data(repo_topic)['result'].json()['names'])
 
-        # list of json data - commits
-        repo_commits = []
-        for commits in get_list_of_repo_commits:
-            repo_commits.append(page_thru_github_data_count(commits))
+def get_repo_stat(full_names, stored, stat, fetch, max_workers=None):
+    """
+    Given repos get a per-repo stat from the stored stats, fetching it only for the repos that have nothing stored
+    :param full_names: list of repo full names
+    :param stored: full name -> stored stats, from the repo store
+    :param stat: stored stat - topics or commit_count
+    :param fetch: function taking a repo full name returning the stat
+    :param max_workers: max number of fetches in flight, default is None meaning use MAX_WORKERS
+    :return: full name -> stat (same order as full_names), set of full names fetched
+    """
 
-        # flatten repo topics
-        flat_repo_topics = flatten_list(repo_topics)
+    # nothing stored for the current version
+    stale = [full_name for full_name in full_names if stored.get(full_name, {}).get(stat) is None]
+    fetched = dict(zip(stale, run_in_pool(fetch, stale, max_workers)))
 
-        # count/list of topics
-        list_count_repo_topics = count_items_in_list(flat_repo_topics)
+    result = {full_name: fetched[full_name] if full_name in fetched else stored[full_name][stat]
+              for full_name in full_names}
 
-        result = {
-            # login
-            "user": profile_data['login'],
+    return result, set(fetched)
 
-            # total follower count
-            "followers": profile_data['followers'],
 
-            # total following count
-            "following": profile_data['following'],
+def get_github_producers(user, max_workers=None):
+    """
+    Given a github user get how each stat (and each value the stats share) is computed - nothing is called until asked for
+    :param user: github user
+    :param max_workers: max number of per-repo calls in flight, default is None meaning use MAX_WORKERS
+    :return: name -> function taking the lazy stats
+    """
 
-            # total number of stars given
-            "total_stars_given": starred,
+    def profile(stats):
+        # check user is valid - user profile
+        with time_stage('github', 'profile'):
+            return get_github_data('users/{}'.format(user))['result']
+
+    def all_repos(stats):
+        # get repo data - streamed page by page, only the cleaned up records are kept
+        with time_stage('github', 'repos'):
+            records = []
+
+            # each page is cleaned once it is here - waiting on the next page is not profiled as aggregation
+            for page in iter_github_pages('users/{}/repos'.format(user), max_workers):
+                records += cleaned_repos_data(page)
+
+            return records
+
+    def total_stars_given(stats):
+        with time_stage('github', 'starred'):
+            return page_thru_github_data_count('users/{}/starred'.format(user))
+
+    def stored(stats):
+        # stored per-repo stats still valid for the repos' current versions (pushed_at/updated_at)
+        with time_stage('github', 'repo_store'):
+            return repo_store.get_many('github', stats['versions'])
+
+    def topics_by_repo(stats):
+        # repo topics - only repos changed since they were stored are fetched (in parallel)
+        with time_stage('github', 'topics'):
+            return get_repo_stat(stats['repo_table'].column('full_name'), stats['stored'], 'topics',
+                                 get_repo_topics_by_name, max_workers)
+
+    def commits_by_repo(stats):
+        # repo commits - only original repos changed since they were stored are fetched (in parallel)
+        with time_stage('github', 'commits'):
+            return get_repo_stat(stats['repo_table'].column('full_name', repo_type='original'), stats['stored'],
+                                 'commit_count', get_repo_commit_count_by_name, max_workers)
+
+    producers = {
+        'profile': profile,
+        'profile_data': lambda stats: stats['profile'].json(),
+        'all_repos': all_repos,
+
+        # every sum and count in one pass over the repo columns
+        'repo_table': lambda stats: RepoTable.from_repos(stats['all_repos']),
+        'summary': lambda stats: stats['repo_table'].summarize(),
+        'versions': lambda stats: {repo['full_name']: get_repo_version(repo) for repo in stats['all_repos']},
+        'stored': stored,
+        'topics_by_repo': topics_by_repo,
+        'commits_by_repo': commits_by_repo,
+
+        # login, total follower count, total following count
+        'user': lambda stats: stats['profile_data']['login'],
+        'followers': lambda stats: stats['profile_data']['followers'],
+        'following': lambda stats: stats['profile_data']['following'],
+
+        # total number of public repos (original vs forked), list/count of languages used
+        'repos': lambda stats: stats['summary']['count']['pub_repo_type'],
+        'languages': lambda stats: stats['summary']['count']['language'],
+
+        # total number of stars received, watchers, open issues and size of their accounts
+        'total_stars_received': lambda stats: stats['summary']['sum']['star_count'],
+        'total_watchers': lambda stats: stats['summary']['sum']['watchers_count'],
+        'total_open_issues': lambda stats: stats['summary']['sum']['open_issues_count'],
+        'total_account_size': lambda stats: stats['summary']['sum']['size'],
+
+        # total number of stars given
+        'total_stars_given': total_stars_given,
+
+        # list/count of repo topics - flatten repo topics then count
+        'repo_topics': lambda stats: count_items_in_list(flatten_list(stats['topics_by_repo'][0].values())),
+
+        # total number of commits to their repos (not forks)
+        'total_commits': lambda stats: sum(stats['commits_by_repo'][0].values())
+    }
 
-            # total number of stars received
-            "total_stars_received": get_repo_summary(repos=all_repos, item='star_count', action='sum'),
+    return producers
 
-            # list/count of repo topics
-            "repo_topics": list_count_repo_topics,
 
-            # list/count of languages used
-            "languages": get_repo_summary(repos=all_repos, item='language', action='count'),
+def iter_github_stats(user, max_workers=None, fields=None):
+    """
+    Given a github user get the summary stats one at a time - cheapest first, only the upstream calls the stats need
+    :param user: github user
+    :param max_workers: max number of per-repo calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: generator of (stat, value) - only ('message', ...) if the user is not valid
+    """
 
-            # total number of public repos (original vs forked)
-            "repos": get_repo_summary(repos=all_repos, item='pub_repo_type', action='count'),
+    stats = LazyStats(get_github_producers(user, max_workers))
 
-            # total watchers count
-            "total_watchers": get_repo_summary(repos=all_repos, item='watchers_count', action='sum'),
+    # check user is valid - user profile
+    if stats['profile'].status_code != 200:
+        yield "message", stats['profile'].json()['message']
+        return
 
-            # total number of open issues
-            "total_open_issues":  get_repo_summary(repos=all_repos, item='open_issues_count', action='sum'),
+    for stat in GITHUB_STATS_COST_ORDER:
+        if fields is None or stat in fields:
+            yield stat, stats[stat]
 
-            # total number of commits to their repos (not forks)
-            "total_commits": sum(repo_commits),
+    # keep what was fetched for the next refresh
+    fetched_topics = stats['topics_by_repo'][1] if stats.computed('topics_by_repo') else set()
+    fetched_commits = stats['commits_by_repo'][1] if stats.computed('commits_by_repo') else set()
 
-            # total size of their accounts
-            "total_account_size": get_repo_summary(repos=all_repos, item='size', action='sum')
-        }
+    if fetched_topics or fetched_commits:
+        # a stat not asked for is left as stored
+        repo_topics = stats['topics_by_repo'][0] if fetched_topics else {}
+        repo_commits = stats['commits_by_repo'][0] if fetched_commits else {}
+        fetched = fetched_topics | fetched_commits
 
-    return result
+        with time_stage('github', 'repo_store'):
+            repo_store.put_many('github', [{
+                'full_name': repo['full_name'],
+                'version': stats['versions'][repo['full_name']],
+                'topics': repo_topics.get(repo['full_name']),
+                'commit_count': repo_commits.get(repo['full_name']),
+                'watchers': repo['watchers_count']
+            } for repo in stats['all_repos'] if repo['full_name'] in fetched])
 
 
+def get_github_stats(user, max_workers=None, fields=None):
+    """
+    Given a github user get the summary stats
+    :param user: github user
+    :param max_workers: max number of per-repo calls in flight, default is None meaning use MAX_WORKERS
+    :param fields: stats wanted, default is None meaning all of them
+    :return: summary stats json
+    """
+
+    try:
+        return collect_stats(iter_github_stats(user, max_workers, fields), GITHUB_STATS_KEYS)
 
+    # out of upstream quota - report it like any other error
+    except RateLimitError as e:
+        return {"message": str(e)}
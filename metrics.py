@@ -0,0 +1,179 @@
+import time
+from urllib.parse import urlsplit
+
+from flask import Response, g, request
+from flask_restful import Resource
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+from profiling import record_call
+from util import GITHUB_API_URL, BITBUCKET_API_URL
+
+# provider per upstream host
+PROVIDER_HOSTS = {
+    urlsplit(GITHUB_API_URL).netloc: 'github',
+    urlsplit(BITBUCKET_API_URL).netloc: 'bitbucket'
+}
+
+# logical endpoints - anything else (ex: user names, repo names) never becomes a label
+UPSTREAM_ENDPOINTS = {'repos', 'repositories', 'starred', 'topics', 'commits', 'watchers', 'issues', 'followers',
+                      'following'}
+
+# whole stats requests and their stages run for up to the provider timeouts
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+UPSTREAM_CALLS = Counter('upstream_calls_total', 'Upstream API calls made', ['provider', 'endpoint', 'status'])
+UPSTREAM_SECONDS = Histogram('upstream_call_seconds', 'Upstream API call latency', ['provider', 'endpoint'])
+UPSTREAM_BYTES = Counter('upstream_received_bytes_total', 'Upstream response body bytes received',
+                         ['provider', 'endpoint'])
+UPSTREAM_IN_FLIGHT = Gauge('upstream_calls_in_flight', 'Upstream API calls waiting on a response', ['provider'])
+
+STAGE_SECONDS = Histogram('stats_stage_seconds', 'Time spent per stage of computing a provider\'s stats',
+                          ['provider', 'stage'], buckets=SLOW_BUCKETS)
+
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being handled', ['route'])
+REQUEST_SECONDS = Histogram('http_request_seconds', 'Request latency', ['route', 'status'], buckets=SLOW_BUCKETS)
+
+
+class MetricsAPI(Resource):     # used to hit the prometheus metrics endpoint
+    def get(self):
+        """
+        Get every metric in the prometheus text format
+        :return: metrics
+        """
+
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def get_upstream_labels(url):
+    """
+    Given an upstream url get the provider and the logical endpoint it hits
+    :param url: full url
+    :return: provider, endpoint - ex: ('github', 'topics'), ('bitbucket', 'user')
+    """
+
+    parts = urlsplit(url)
+    segments = parts.path.strip('/').split('/')
+
+    provider = PROVIDER_HOSTS.get(parts.netloc, 'other')
+
+    # the last known endpoint in the path - ex: repositories/someone/repo/commits -> commits
+    for segment in reversed(segments):
+        if segment in UPSTREAM_ENDPOINTS:
+            return provider, segment
+
+    # user/team profile
+    if 'users' in segments or 'teams' in segments:
+        return provider, 'user'
+
+    return provider, 'other'
+
+
+class UpstreamCall(object):
+    """
+    Times one upstream call - counted once its response (or error) is recorded
+    """
+
+    def __init__(self, url):
+        """
+        :param url: full url being called
+        """
+        self.provider, self.endpoint = get_upstream_labels(url)
+        self.started = None
+        self.size = 0
+
+    def __enter__(self):
+        UPSTREAM_IN_FLIGHT.labels(self.provider).inc()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.started
+
+        UPSTREAM_SECONDS.labels(self.provider, self.endpoint).observe(seconds)
+        UPSTREAM_IN_FLIGHT.labels(self.provider).dec()
+
+        # ?profile=1 breakdown of the request making the call
+        record_call(self.provider, self.endpoint, seconds, self.size)
+
+        # no response at all - ex: connection error, timeout
+        if exc_type is not None:
+            UPSTREAM_CALLS.labels(self.provider, self.endpoint, 'error').inc()
+
+    def record(self, status_code, size):
+        """
+        Given the upstream response count the call and the bytes received
+        :param status_code: response status
+        :param size: response body size
+        """
+
+        self.size = size
+
+        UPSTREAM_CALLS.labels(self.provider, self.endpoint, str(status_code)).inc()
+        UPSTREAM_BYTES.labels(self.provider, self.endpoint).inc(size)
+
+
+def observe_upstream(url):
+    """
+    Given an upstream url time the call made to it - ex: with observe_upstream(url) as call: ... call.record(status, size)
+    :param url: full url
+    :return: context manager
+    """
+
+    return UpstreamCall(url)
+
+
+def time_stage(provider, stage):
+    """
+    Given a provider and a stage of its stats pipeline time it - ex: with time_stage('github', 'repos'): ...
+    :param provider: github or bitbucket
+    :param stage: stage name
+    :return: context manager
+    """
+
+    return STAGE_SECONDS.labels(provider, stage).time()
+
+
+def start_request():
+    """
+    Count the current request as in flight - registered to run before every request
+    """
+
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(g.metrics_route).inc()
+
+
+def finish_request(response):
+    """
+    Given the response time the current request - registered to run after every request
+    :param response: flask response
+    :return: the same response
+    """
+
+    if 'metrics_started' in g:
+        REQUEST_SECONDS.labels(g.metrics_route, str(response.status_code)).observe(
+            time.perf_counter() - g.metrics_started)
+
+    return response
+
+
+def end_request(error=None):
+    """
+    Stop counting the current request as in flight - registered to run when every request is torn down
+    :param error: unhandled error, if any
+    """
+
+    if 'metrics_started' in g:
+        REQUESTS_IN_FLIGHT.labels(g.metrics_route).dec()
+        g.pop('metrics_started')
+
+
+def init_app(app):
+    """
+    Given the flask app time and count every request it handles
+    :param app: flask app
+    """
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
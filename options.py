@@ -0,0 +1,68 @@
+from streaming import STREAM_FORMATS
+from util import get_max_workers, is_truthy
+
+
+def select_fields(fields, keys):
+    """
+    Given the stats asked for keep the ones a provider reports - ex: the bitbucket part of a merged request
+    :param fields: stats wanted, None meaning all of them
+    :param keys: stats the provider reports, in the order they are reported
+    :return: tuple of stats in the reported order, None if that is all of them
+    """
+
+    if fields is None:
+        return None
+
+    selected = tuple(key for key in keys if key in fields)
+
+    return None if len(selected) == len(keys) else selected
+
+
+def get_request_options(args, known_fields=None):
+    """
+    Given the query string of a stats request parse out the options shared by all stats routes
+    :param args: query string args - ex: request.args
+    :param known_fields: stats the route reports, in the order they are reported - default is None meaning no ?fields=
+    :return: options json - max_workers, bypass, stream_format, profile, fields
+    """
+
+    # optional per-request concurrency limit - ex: ?workers=4
+    max_workers = get_max_workers(args.get('workers'))
+
+    # ?nocache=1 skips the cached stats and refreshes them
+    bypass = is_truthy(args.get('nocache'))
+
+    # ?stream=ndjson or ?stream=sse sends each stat as soon as it is computed
+    stream_format = args.get('stream')
+
+    if stream_format is not None and stream_format not in STREAM_FORMATS:
+        raise ValueError("Incorrect stream format! Must be one of the following: {}".format(list(STREAM_FORMATS)))
+
+    # ?profile=1 attaches a breakdown of where the time went - computed fresh so there is something to break down
+    profile = is_truthy(args.get('profile'))
+
+    if profile and stream_format:
+        raise ValueError("Profiling is not available for streamed responses")
+
+    # ?fields=followers,repos computes only those stats - and makes only the upstream calls they need
+    fields = None
+
+    if known_fields is not None and args.get('fields'):
+        requested = {field.strip() for field in args.get('fields').split(',') if field.strip()}
+        unknown = requested.difference(known_fields)
+
+        if unknown:
+            raise ValueError("Unknown fields {}! Must be some of the following: {}".format(
+                sorted(unknown), list(known_fields)))
+
+        fields = select_fields(requested, known_fields)
+
+    result = {
+        'max_workers': max_workers,
+        'bypass': bypass or profile,
+        'stream_format': stream_format,
+        'profile': profile,
+        'fields': fields
+    }
+
+    return result
@@ -0,0 +1,169 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# profile of the request being handled - None unless ?profile=1, copied into the pool workers with the rest of the context
+request_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class Profile(object):
+    """
+    Breakdown of where one request's time went - upstream calls per endpoint, pages walked, local aggregation
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+        # (provider, endpoint) -> [calls, total seconds, max seconds, bytes]
+        self.calls = {}
+
+        # provider -> pages walked
+        self.pages = {}
+
+        # function name -> [calls, total seconds]
+        self.aggregations = {}
+
+    def record_call(self, provider, endpoint, seconds, size):
+        """
+        Given an upstream call made for the request add it to the breakdown
+        :param provider: github or bitbucket
+        :param endpoint: logical endpoint - ex: repos, topics
+        :param seconds: latency
+        :param size: response body size
+        """
+
+        with self.lock:
+            call = self.calls.setdefault((provider, endpoint), [0, 0.0, 0.0, 0])
+            call[0] += 1
+            call[1] += seconds
+            call[2] = max(call[2], seconds)
+            call[3] += size
+
+    def record_pages(self, provider, pages):
+        """
+        Given the number of pages walked through a list endpoint add them to the breakdown
+        :param provider: github or bitbucket
+        :param pages: pages walked
+        """
+
+        with self.lock:
+            self.pages[provider] = self.pages.get(provider, 0) + pages
+
+    def record_aggregation(self, name, seconds):
+        """
+        Given a local aggregation run for the request add it to the breakdown
+        :param name: function name
+        :param seconds: time spent
+        """
+
+        with self.lock:
+            aggregation = self.aggregations.setdefault(name, [0, 0.0])
+            aggregation[0] += 1
+            aggregation[1] += seconds
+
+    def report(self):
+        """
+        Get the breakdown
+        :return: profile json
+        """
+
+        with self.lock:
+            upstream = {}
+            for (provider, endpoint), (calls, total, slowest, size) in sorted(self.calls.items()):
+                upstream.setdefault(provider, {})[endpoint] = {
+                    'calls': calls,
+                    'total_seconds': round(total, 4),
+                    'max_seconds': round(slowest, 4),
+                    'bytes': size
+                }
+
+            aggregation = {name: {'calls': calls, 'seconds': round(total, 4)}
+                           for name, (calls, total) in sorted(self.aggregations.items())}
+
+            return {
+                'wall_seconds': round(time.perf_counter() - self.started, 4),
+                'upstream_calls': sum(call[0] for call in self.calls.values()),
+                'upstream_seconds': round(sum(call[1] for call in self.calls.values()), 4),
+                'bytes': sum(call[3] for call in self.calls.values()),
+                'aggregation_seconds': round(sum(total for _, total in self.aggregations.values()), 4),
+                'upstream': upstream,
+                'pages': dict(self.pages),
+                'aggregation': aggregation
+            }
+
+
+@contextmanager
+def profile_request(enabled=True):
+    """
+    Profile everything the request does inside the block - ex: with profile_request(options['profile']) as profile: ...
+    :param enabled: profile or not
+    :return: context manager giving the profile, None when not enabled
+    """
+
+    if not enabled:
+        yield None
+        return
+
+    profile = Profile()
+    token = request_profile.set(profile)
+
+    try:
+        yield profile
+    finally:
+        request_profile.reset(token)
+
+
+def record_call(provider, endpoint, seconds, size):
+    """
+    Given an upstream call add it to the current request's profile, if it is being profiled
+    :param provider: github or bitbucket
+    :param endpoint: logical endpoint - ex: repos, topics
+    :param seconds: latency
+    :param size: response body size
+    """
+
+    profile = request_profile.get()
+
+    if profile is not None:
+        profile.record_call(provider, endpoint, seconds, size)
+
+
+def record_pages(provider, pages):
+    """
+    Given the number of pages walked add them to the current request's profile, if it is being profiled
+    :param provider: github or bitbucket
+    :param pages: pages walked
+    """
+
+    profile = request_profile.get()
+
+    if profile is not None:
+        profile.record_pages(provider, pages)
+
+
+def profiled(func):
+    """
+    Given a local aggregation function time it into the current request's profile, if it is being profiled
+    :param func: function
+    :return: wrapped function
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = request_profile.get()
+
+        # not profiling - just the contextvar lookup
+        if profile is None:
+            return func(*args, **kwargs)
+
+        started = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.record_aggregation(func.__name__, time.perf_counter() - started)
+
+    return wrapper
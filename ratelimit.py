@@ -0,0 +1,253 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+from util import RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_WAIT, RATE_LIMIT_BACKGROUND_RESERVE
+
+# interactive requests go ahead of background ones (ex: cache refreshes) - set per request/task
+request_priority = contextvars.ContextVar('request_priority', default='interactive')
+
+
+class RateLimitError(Exception):
+    """
+    Upstream quota is exhausted for longer than we are willing to wait
+    """
+    pass
+
+
+class HostLimit(object):
+    """
+    Rate limit state of one upstream host for one credential - token bucket pacing plus the quota the upstream reports
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: tokens added per second
+        :param burst: max tokens saved up
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled_at = time.time()
+
+        # from the X-RateLimit-* headers - None until the upstream tells us
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+
+        # secondary rate limit - no calls until then
+        self.backoff_until = 0
+        self.backoffs = 0
+
+    def wait_time(self, now, reserve):
+        """
+        Given the time get how long to wait before the next call
+        :param now: time.time()
+        :param reserve: calls of the quota to leave untouched (kept for interactive requests)
+        :return: seconds to wait, 0 to go now
+        """
+
+        # refill the bucket
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+        waits = [self.backoff_until - now]
+
+        # quota used up - wait for the reset
+        if self.remaining is not None and self.reset_at and self.remaining <= reserve:
+            waits.append(self.reset_at - now)
+
+        # bucket empty - wait for a token
+        if self.tokens < 1:
+            waits.append((1 - self.tokens) / self.rate)
+
+        return max(0, max(waits))
+
+    def take(self):
+        """
+        Use up a token and one call of the quota
+        """
+
+        self.tokens -= 1
+
+        if self.remaining is not None:
+            self.remaining -= 1
+
+
+class RateLimitScheduler(object):
+    """
+    Every upstream call asks here first - paces calls per host and credential, waits out exhausted quotas and secondary rate limits
+    """
+
+    def __init__(self, rate, burst, max_wait, background_reserve):
+        """
+        :param rate: calls per second allowed per host and credential
+        :param burst: calls allowed at once after being idle
+        :param max_wait: max seconds a call waits before giving up with a RateLimitError
+        :param background_reserve: fraction of the quota background calls leave for interactive ones
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.background_reserve = background_reserve
+
+        # (host, credential) -> host limit
+        self.limits = {}
+        self.condition = threading.Condition()
+
+        # number of calls waiting per priority - background waits while interactive calls are waiting
+        self.waiting = {'interactive': 0, 'background': 0}
+
+    def acquire(self, host, credential, priority=None):
+        """
+        Given a host and credential wait until a call can be made
+        :param host: upstream host
+        :param credential: credential the call is made with - None when anonymous
+        :param priority: interactive or background, default is None meaning use the request priority
+        """
+
+        priority = priority or request_priority.get()
+        deadline = time.time() + self.max_wait
+
+        with self.condition:
+            limit = self._get_limit(host, credential)
+            self.waiting[priority] += 1
+
+            try:
+                while True:
+                    wait = self._try_take(limit, host, priority, deadline)
+
+                    if not wait:
+                        return
+
+                    # woken early when another call finishes - re-check
+                    self.condition.wait(timeout=wait)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    async def acquire_async(self, host, credential, priority=None):
+        """
+        Given a host and credential wait until a call can be made - on an event loop, sleeping instead of holding a thread
+        :param host: upstream host
+        :param credential: credential the call is made with - None when anonymous
+        :param priority: interactive or background, default is None meaning use the request priority
+        """
+
+        priority = priority or request_priority.get()
+        deadline = time.time() + self.max_wait
+
+        with self.condition:
+            limit = self._get_limit(host, credential)
+            self.waiting[priority] += 1
+
+        try:
+            while True:
+                # the lock only while the quota is checked - never across the sleep
+                with self.condition:
+                    wait = self._try_take(limit, host, priority, deadline)
+
+                if not wait:
+                    return
+
+                await asyncio.sleep(wait)
+        finally:
+            with self.condition:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def _try_take(self, limit, host, priority, deadline):
+        # caller holds the lock - take a call off the quota, or get how long to wait before checking again
+        now = time.time()
+
+        # background calls leave part of the quota for interactive ones
+        reserve = 0
+        if priority == 'background' and limit.limit:
+            reserve = int(limit.limit * self.background_reserve)
+
+        wait = limit.wait_time(now, reserve)
+
+        # go - background only when no interactive call is waiting
+        if wait == 0 and (priority == 'interactive' or not self.waiting['interactive']):
+            limit.take()
+            return 0
+
+        if now + wait > deadline:
+            message = "Rate limit for {} exhausted, try again in {} seconds".format(host, int(wait) + 1)
+            raise RateLimitError(message)
+
+        return max(wait, 0.01)
+
+    def update(self, host, credential, status_code, headers):
+        """
+        Given an upstream response record the quota it reports and back off on rate limit responses
+        :param host: upstream host
+        :param credential: credential the call was made with - None when anonymous
+        :param status_code: response status
+        :param headers: response headers
+        :return: True if the response was rate limited and the call should be retried
+        """
+
+        with self.condition:
+            limit = self._get_limit(host, credential)
+
+            if 'X-RateLimit-Remaining' in headers:
+                limit.remaining = int(headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Limit' in headers:
+                limit.limit = int(headers['X-RateLimit-Limit'])
+            if 'X-RateLimit-Reset' in headers:
+                limit.reset_at = float(headers['X-RateLimit-Reset'])
+
+            # 429, or 403 with the quota used up or a Retry-After (secondary rate limit)
+            limited = status_code == 429 or (status_code == 403 and (limit.remaining == 0 or 'Retry-After' in headers))
+
+            if limited:
+                limit.backoffs += 1
+
+                # upstream says how long, otherwise back off exponentially
+                if 'Retry-After' in headers:
+                    backoff = float(headers['Retry-After'])
+                elif limit.remaining == 0 and limit.reset_at:
+                    backoff = limit.reset_at - time.time()
+                else:
+                    backoff = min(60, 2 ** limit.backoffs)
+
+                limit.backoff_until = time.time() + max(0, backoff)
+
+            else:
+                limit.backoffs = 0
+
+            self.condition.notify_all()
+
+        return limited
+
+    def stats(self):
+        """
+        Get the tracked quota per host and credential
+        :return: list of quota json
+        """
+
+        with self.condition:
+            return [{
+                'host': host,
+                'credential': credential,
+                'limit': limit.limit,
+                'remaining': limit.remaining,
+                'reset_at': limit.reset_at,
+                'backoff_until': limit.backoff_until or None
+            } for (host, credential), limit in self.limits.items()]
+
+    def _get_limit(self, host, credential):
+        # caller holds the lock
+        key = (host, credential)
+
+        if key not in self.limits:
+            self.limits[key] = HostLimit(self.rate, self.burst)
+
+        return self.limits[key]
+
+
+# process wide scheduler - every upstream call goes through it
+scheduler = RateLimitScheduler(rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST, max_wait=RATE_LIMIT_MAX_WAIT,
+                               background_reserve=RATE_LIMIT_BACKGROUND_RESERVE)
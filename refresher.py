@@ -0,0 +1,339 @@
+import hmac
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from flask import request
+from flask_restful import Resource
+
+from cache import stats_cache, get_stats_key
+from ratelimit import scheduler, request_priority
+from util import GITHUB_API_URL, BITBUCKET_API_URL, ADMIN_TOKEN, HOT_WINDOW, HOT_THRESHOLD, REFRESH_AHEAD, REFRESH_INTERVAL, \
+    REFRESH_MAX_WORKERS, REFRESH_BUDGET, RATE_LIMIT_BACKGROUND_RESERVE, SERIALIZED_CACHE_MAX_ENTRIES, select_stats
+
+# upstream host per provider - refreshes are skipped while its quota is low
+PROVIDER_HOSTS = {
+    'github': urlsplit(GITHUB_API_URL).netloc,
+    'bitbucket': urlsplit(BITBUCKET_API_URL).netloc
+}
+
+
+class WarmAPI(Resource):        # used to hit the warmed users endpoint - admins only
+    def get(self):
+        """
+        List the hot users kept warm by the background refresher - Authorization: Bearer <ADMIN_TOKEN>
+        :return: warmed users
+        """
+
+        # no admin token configured - the route is off
+        if not ADMIN_TOKEN:
+            return {'message': "Not Found"}, 404
+
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer {}'.format(ADMIN_TOKEN)):
+            return {'message': "Admin token required"}, 401
+
+        result = {
+            'data': refresher.warmed()
+        }
+
+        return result
+
+
+class Refresher(object):
+    """
+    Keeps hot users' stats warm - tracks how often each user is asked for and refreshes hot ones in the background before they expire
+    """
+
+    def __init__(self, cache, window, hot_threshold, refresh_ahead, interval, max_workers, budget,
+                 max_selections=SERIALIZED_CACHE_MAX_ENTRIES):
+        """
+        :param cache: stats cache to keep warm
+        :param window: seconds of requests counted per user
+        :param hot_threshold: requests within the window that make a user hot
+        :param refresh_ahead: fraction of the ttl left when a hot user is refreshed - ex: 0.2 refreshes with 20% left
+        :param interval: seconds between checks for hot users to refresh
+        :param max_workers: max number of refreshes running at once
+        :param budget: max number of refreshes started per minute
+        :param max_selections: max number of ?fields= selections of whole stats kept
+        """
+        self.cache = cache
+        self.window = window
+        self.hot_threshold = hot_threshold
+        self.refresh_ahead = refresh_ahead
+        self.interval = interval
+        self.budget = budget
+
+        # key -> request times within the window, key -> latest function computing its stats
+        self.requests = {}
+        self.computes = {}
+
+        # keys being refreshed, key -> time of the last refresh, start times of the refreshes in the last minute
+        self.refreshing = set()
+        self.refreshed = {}
+        self.started = deque()
+
+        # key -> (whole stats, the fields selected from them) - ordered least to most recently used
+        self.selections = OrderedDict()
+        self.max_selections = max_selections
+
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.thread = None
+
+    def record(self, key, compute):
+        """
+        Given a requested key count the request and remember how to compute its stats
+        :param key: (provider, user)
+        :param compute: function returning the stats dict
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            self.requests.setdefault(key, deque()).append(now)
+            self.computes[key] = compute
+            self._prune(key, now)
+
+            # checks for hot users start with the first request
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='stats-refresher', daemon=True)
+                self.thread.start()
+
+    def is_hot(self, key):
+        """
+        Given a key check if it is asked for often enough to be kept warm
+        :param key: (provider, user)
+        :return: bool
+        """
+
+        with self.lock:
+            self._prune(key, time.monotonic())
+            return len(self.requests.get(key, ())) >= self.hot_threshold
+
+    def refresh(self, key):
+        """
+        Given a key refresh its stats in the background - unless already refreshing or out of refresh budget
+        :param key: (provider, user)
+        :return: True if a refresh was started
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            if key in self.refreshing or key not in self.computes or not self._has_budget(key[0], now):
+                return False
+
+            self.refreshing.add(key)
+            self.started.append(now)
+            compute = self.computes[key]
+
+        self.executor.submit(self._refresh, key, compute)
+
+        return True
+
+    def refresh_due(self):
+        """
+        Refresh every hot key that is about to expire
+        :return: list of keys a refresh was started for
+        """
+
+        with self.lock:
+            keys = list(self.requests)
+
+        started = []
+
+        for key in keys:
+            if not self.is_hot(key):
+                continue
+
+            expires_in = self.cache.get_expiry(key)
+            ttl = self.cache.ttls[key[0]]
+
+            # missing or close to expiring
+            if (expires_in is None or expires_in <= ttl * self.refresh_ahead) and self.refresh(key):
+                started.append(key)
+
+        return started
+
+    def warmed(self):
+        """
+        List the hot keys and how warm they are
+        :return: list of warmed users json
+        """
+
+        now = time.monotonic()
+        result = []
+
+        with self.lock:
+            keys = list(self.requests)
+
+        for key in keys:
+            if not self.is_hot(key):
+                continue
+
+            with self.lock:
+                requests = len(self.requests.get(key, ()))
+                refreshing = key in self.refreshing
+                refreshed = self.refreshed.get(key)
+
+            result.append({
+                'provider': key[0],
+                'user': key[1],
+                'requests': requests,
+                'expires_in': self.cache.get_expiry(key),
+                'refreshing': refreshing,
+                'last_refreshed': now - refreshed if refreshed else None
+            })
+
+        return result
+
+    def _refresh(self, key, compute):
+        # background priority - interactive calls go first at the rate limit scheduler
+        token = request_priority.set('background')
+
+        try:
+            self.cache.compute(key, compute)
+        finally:
+            request_priority.reset(token)
+
+            with self.lock:
+                self.refreshing.discard(key)
+                self.refreshed[key] = time.monotonic()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.refresh_due()
+            except Exception:
+                # keep the refresher alive - the next round tries again
+                pass
+
+    def _has_budget(self, provider, now):
+        # caller holds the lock - refreshes started in the last minute and the upstream quota left
+        while self.started and self.started[0] <= now - 60:
+            self.started.popleft()
+
+        if len(self.started) >= self.budget:
+            return False
+
+        for limit in scheduler.stats():
+            if limit['host'] == PROVIDER_HOSTS.get(provider) and limit['limit'] and limit['remaining'] is not None \
+                    and limit['remaining'] <= limit['limit'] * RATE_LIMIT_BACKGROUND_RESERVE:
+                return False
+
+        return True
+
+    def _prune(self, key, now):
+        # caller holds the lock - forget requests older than the window, and keys with none left
+        requests = self.requests.get(key)
+
+        while requests and requests[0] <= now - self.window:
+            requests.popleft()
+
+        if requests is not None and not requests and key not in self.refreshing:
+            del self.requests[key]
+            self.computes.pop(key, None)
+
+    def select(self, key, stats, fields):
+        """
+        Given a key and the whole stats get the fields asked for - the same dict for as long as the whole stats are the
+        same, so its serialized response is reused
+        :param key: (provider, user, fields)
+        :param stats: whole stats dict from the cache
+        :param fields: stats wanted
+        :return: stats dict
+        """
+
+        with self.lock:
+            selection = self.selections.get(key)
+
+            if selection and selection[0] is stats:
+                self.selections.move_to_end(key)
+                return selection[1]
+
+        selected = select_stats(stats, fields)
+
+        with self.lock:
+            self.selections[key] = (stats, selected)
+            self.selections.move_to_end(key)
+
+            # drop least recently used
+            while len(self.selections) > self.max_selections:
+                self.selections.popitem(last=False)
+
+        return selected
+
+    def serve(self, provider, user, compute, bypass=False, fields=None):
+        """
+        Given a provider and user get the stats - fresh from the cache, stale while a hot user is refreshed, computed otherwise
+        :param provider: github or bitbucket
+        :param user: provider user
+        :param compute: function returning the stats dict (only the fields asked for)
+        :param bypass: skip the cache lookup and refresh it
+        :param fields: stats wanted, default is None meaning all of them
+        :return: stats dict, age in seconds if it came from the cache (None if just computed)
+        """
+
+        key = get_stats_key(provider, user, fields)
+        self.record(key, compute)
+
+        if not bypass:
+            # fresh whole stats already have every field asked for
+            if fields is not None:
+                value, age = self.cache.get_with_age((provider, user))
+
+                if value is not None:
+                    return self.select(key, value, fields), age
+
+            value, age = self.cache.get_with_age(key)
+
+            if value is not None:
+                return value, age
+
+            # expired - a hot user gets the stale value while it is refreshed in the background
+            if self.is_hot(key):
+                value, age = self.cache.get_stale(key)
+
+                if value is not None:
+                    self.refresh(key)
+                    return value, age
+
+        return self.cache.get_or_compute(key, compute, bypass), None
+
+
+# process wide refresher for the stats cache
+refresher = Refresher(stats_cache, window=HOT_WINDOW, hot_threshold=HOT_THRESHOLD, refresh_ahead=REFRESH_AHEAD,
+                      interval=REFRESH_INTERVAL, max_workers=REFRESH_MAX_WORKERS, budget=REFRESH_BUDGET)
+
+
+def serve_stats(provider, user, compute, bypass=False, fields=None):
+    """
+    Given a provider and user get the stats through the stats cache, keeping hot users warm
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param compute: function returning the stats dict (only the fields asked for)
+    :param bypass: skip the cache lookup and refresh it
+    :param fields: stats wanted, default is None meaning all of them
+    :return: stats dict, age in seconds if it came from the cache (None if just computed)
+    """
+
+    return refresher.serve(provider, user, compute, bypass, fields)
+
+
+def get_age_headers(*ages):
+    """
+    Given the ages of the stats in a response get the headers reporting them
+    :param ages: ages in seconds, None for stats just computed
+    :return: X-Stats-Age header with the oldest age, empty if all were just computed
+    """
+
+    ages = [age for age in ages if age is not None]
+
+    if not ages:
+        return {}
+
+    return {'X-Stats-Age': str(int(max(ages)))}
@@ -0,0 +1,127 @@
+import json
+import sqlite3
+import threading
+import time
+
+from util import REPO_STORE_PATH
+
+
+class RepoStore(object):
+    """
+    On-disk store of per-repo derived stats (topics, commit count, watchers) - only valid for the repo version they were computed at
+    """
+
+    def __init__(self, path):
+        """
+        :param path: sqlite database file, ':memory:' keeps it in memory
+        """
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def get_many(self, provider, versions):
+        """
+        Given repos and their current versions get the stored stats still valid for them
+        :param provider: github or bitbucket
+        :param versions: full name -> current version (ex: pushed_at|updated_at)
+        :return: full name -> {'topics': ..., 'commit_count': ..., 'watchers': ...} - only repos stored at the current version
+        """
+
+        result = {}
+
+        if not versions:
+            return result
+
+        names = list(versions)
+        rows = []
+
+        with self.lock:
+            connection = self._connect()
+
+            # chunks keep under sqlite's limit on query params
+            for start in range(0, len(names), 500):
+                chunk = names[start:start+500]
+                rows += connection.execute(
+                    'SELECT full_name, version, topics, commit_count, watchers FROM repo_stats '
+                    'WHERE provider = ? AND full_name IN ({})'.format(','.join('?' * len(chunk))),
+                    [provider] + chunk).fetchall()
+
+        for full_name, version, topics, commit_count, watchers in rows:
+
+            # repo changed since - nothing stored is valid
+            if versions.get(full_name) != version:
+                continue
+
+            result[full_name] = {
+                'topics': json.loads(topics) if topics is not None else None,
+                'commit_count': commit_count,
+                'watchers': watchers
+            }
+
+        return result
+
+    def put_many(self, provider, repos):
+        """
+        Given repos with freshly computed stats store them for their current version - stats not given are kept if the version did not change
+        :param provider: github or bitbucket
+        :param repos: list of {'full_name': ..., 'version': ..., 'topics': ..., 'commit_count': ..., 'watchers': ...}
+        """
+
+        if not repos:
+            return
+
+        rows = [(provider, repo['full_name'], repo['version'],
+                 json.dumps(repo['topics']) if repo.get('topics') is not None else None,
+                 repo.get('commit_count'), repo.get('watchers'), time.time()) for repo in repos]
+
+        with self.lock:
+            connection = self._connect()
+
+            # same version - only fill in what was computed, new version - start over
+            connection.executemany('''
+                INSERT INTO repo_stats (provider, full_name, version, topics, commit_count, watchers, stored_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (provider, full_name) DO UPDATE SET
+                    topics = CASE WHEN version = excluded.version
+                        THEN COALESCE(excluded.topics, topics) ELSE excluded.topics END,
+                    commit_count = CASE WHEN version = excluded.version
+                        THEN COALESCE(excluded.commit_count, commit_count) ELSE excluded.commit_count END,
+                    watchers = CASE WHEN version = excluded.version
+                        THEN COALESCE(excluded.watchers, watchers) ELSE excluded.watchers END,
+                    version = excluded.version,
+                    stored_at = excluded.stored_at
+            ''', rows)
+            connection.commit()
+
+    def _connect(self):
+        # caller holds the lock - opened on first use, shared by all threads behind the lock
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS repo_stats (
+                    provider TEXT NOT NULL,
+                    full_name TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    topics TEXT,
+                    commit_count INTEGER,
+                    watchers INTEGER,
+                    stored_at REAL NOT NULL,
+                    PRIMARY KEY (provider, full_name)
+                )
+            ''')
+
+        return self.connection
+
+
+def get_repo_version(repo):
+    """
+    Given a cleaned up repo get the version its derived stats are valid for - changes when the repo is pushed to or updated
+    :param repo: cleaned up repo json
+    :return: version string
+    """
+
+    return '{}|{}'.format(repo['pushed_at'], repo['updated_at'])
+
+
+# process wide repo store
+repo_store = RepoStore(REPO_STORE_PATH)
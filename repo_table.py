@@ -0,0 +1,174 @@
+from array import array
+from collections import Counter
+from itertools import compress
+from operator import attrgetter
+
+from profiling import profiled
+
+# repo types - dictionary encoded as their index, one byte per repo
+REPO_TYPES = ('original', 'forked')
+
+# repo type -> code
+TYPE_CODES = {repo_type: index for index, repo_type in enumerate(REPO_TYPES)}
+
+# bytes.translate tables turning the repo type codes into a 0/1 mask per repo type
+TYPE_MASKS = {repo_type: bytes(int(code == index) for code in range(256)) for index, repo_type in enumerate(REPO_TYPES)}
+
+# numeric columns - summed by the stats
+NUMERIC_COLUMNS = ('forks_count', 'watchers_count', 'open_issues_count', 'star_count', 'size')
+
+# dictionary encoded columns - counted by the stats
+CATEGORICAL_COLUMNS = ('language', 'pub_repo_type')
+
+
+class RepoTable(object):
+    """
+    Columnar table of cleaned up repos - numeric columns in arrays, language and repo type dictionary encoded, so every
+    sum and count is a single pass done by builtins instead of a python loop over repo dicts
+
+    Tables are per provider and are not merged - the merged route adds up the two providers' cached stats, which are
+    already one entry per language / repo type, so it never holds both providers' tables
+    """
+
+    def __init__(self):
+        self.full_names = []
+
+        # column -> array of ints
+        self.numeric = {column: array('q') for column in NUMERIC_COLUMNS}
+
+        # languages - code per repo, code -> language and language -> code
+        self.language_codes = array('I')
+        self.languages = []
+        self.language_index = {}
+
+        # repo type code per repo - index into REPO_TYPES
+        self.type_codes = bytearray()
+
+    @classmethod
+    @profiled
+    def from_repos(cls, repos):
+        """
+        Given cleaned up repos build the table - one column at a time
+        :param repos: list or generator of repo records - ex: cleaned_repos_data
+        :return: repo table
+        """
+
+        repos = list(repos)
+
+        return cls.from_columns(list(map(attrgetter('full_name'), repos)), map(attrgetter('language'), repos),
+                                map(attrgetter('pub_repo_type'), repos),
+                                **{column: map(attrgetter(column), repos) for column in NUMERIC_COLUMNS})
+
+    @classmethod
+    def from_columns(cls, full_names, languages, repo_types, **numeric):
+        """
+        Given the repos' columns build the table - for providers whose repos are not repo records, ex: bitbucket
+        :param full_names: list of repo full names
+        :param languages: language per repo
+        :param repo_types: original or forked per repo
+        :param numeric: numeric column -> value per repo, columns not given are all 0 - ex: size=[10, 5]
+        :return: repo table
+        """
+
+        table = cls()
+
+        table.full_names = list(full_names)
+
+        for column in NUMERIC_COLUMNS:
+            values = numeric.get(column, [0] * len(table.full_names))
+            table.numeric[column] = array('q', [value or 0 for value in values])
+
+        # language -> code in the order they first appear
+        index = table.language_index
+        table.language_codes = array('I', [index.setdefault(language, len(index)) for language in languages])
+        table.languages = list(index)
+
+        table.type_codes = bytearray(map(TYPE_CODES.__getitem__, repo_types))
+
+        return table
+
+    def __len__(self):
+        return len(self.full_names)
+
+    def mask(self, repo_type):
+        """
+        Given a repo type get which rows are of it
+        :param repo_type: original or forked
+        :return: bytes, 1 per row of the repo type and 0 otherwise
+        """
+
+        return self.type_codes.translate(TYPE_MASKS[repo_type])
+
+    def column(self, column, repo_type=None):
+        """
+        Given a column get its values
+        :param column: full_name, a numeric column or a categorical column
+        :param repo_type: original or forked, default is None meaning every repo
+        :return: list of values in row order
+        """
+
+        if column == 'full_name':
+            values = self.full_names
+        elif column in self.numeric:
+            values = self.numeric[column]
+        elif column == 'language':
+            values = [self.languages[code] for code in self.language_codes]
+        elif column == 'pub_repo_type':
+            values = [REPO_TYPES[code] for code in self.type_codes]
+        else:
+            raise ValueError("Unknown column! Must be one of the following: {}".format(
+                ['full_name'] + list(NUMERIC_COLUMNS) + list(CATEGORICAL_COLUMNS)))
+
+        if repo_type:
+            return list(compress(values, self.mask(repo_type)))
+
+        return list(values)
+
+    def sum(self, column, repo_type=None):
+        """
+        Given a numeric column sum it up
+        :param column: numeric column - ex: star_count
+        :param repo_type: original or forked, default is None meaning every repo
+        :return: total
+        """
+
+        values = self.numeric[column]
+
+        if repo_type:
+            values = compress(values, self.mask(repo_type))
+
+        return sum(values)
+
+    def count(self, column, repo_type=None):
+        """
+        Given a categorical column count each value - in the order the values first appear, like count_items_in_list
+        :param column: language or pub_repo_type
+        :param repo_type: original or forked, default is None meaning every repo
+        :return: value -> count
+        """
+
+        if column == 'language':
+            codes, dictionary = self.language_codes, self.languages
+        elif column == 'pub_repo_type':
+            codes, dictionary = self.type_codes, REPO_TYPES
+        else:
+            raise ValueError("Unknown column! Must be one of the following: {}".format(list(CATEGORICAL_COLUMNS)))
+
+        if repo_type:
+            codes = compress(codes, self.mask(repo_type))
+
+        return {dictionary[code]: total for code, total in Counter(codes).items()}
+
+    @profiled
+    def summarize(self):
+        """
+        Get every sum and count over all repos - per repo type ones are asked for on their own, ex: sum(column, 'forked')
+        :return: {'sum': {column: total}, 'count': {column: {value: count}}}
+        """
+
+        result = {
+            'sum': {column: self.sum(column) for column in NUMERIC_COLUMNS},
+            'count': {column: self.count(column) for column in CATEGORICAL_COLUMNS}
+        }
+
+        return result
@@ -0,0 +1,191 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+import brotli
+import orjson
+from flask import Response, request
+
+from util import SERIALIZED_CACHE_MAX_ENTRIES, SERIALIZED_CACHE_MAX_BYTES, BROTLI_QUALITY
+
+# content codings sent when the client accepts them - preferred first
+ENCODINGS = ('br', 'gzip')
+
+
+class SerializedStats(object):
+    """
+    Stats document serialized once - raw json bytes, their gzip and brotli compressed copies and a strong ETag per copy
+    """
+
+    def __init__(self, document):
+        """
+        :param document: json document - ex: {'data': ...}
+        """
+        # non-string keys (ex: a None language) are written the way the json module writes them
+        body = orjson.dumps(document, option=orjson.OPT_NON_STR_KEYS)
+
+        # content coding -> bytes, mtime 0 keeps the gzip bytes the same for the same document
+        self.bodies = {
+            'identity': body,
+            'gzip': gzip.compress(body, mtime=0),
+            'br': brotli.compress(body, quality=BROTLI_QUALITY)
+        }
+
+        # each coding is its own representation - its own strong ETag
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etags = {encoding: digest if encoding == 'identity' else '{}-{}'.format(digest, encoding)
+                      for encoding in self.bodies}
+
+        self.size = sum(len(content) for content in self.bodies.values())
+
+
+class SerializedCache(object):
+    """
+    Bounded store of serialized stats per route key - reused for as long as the route serves the same stats objects,
+    evicts least recently used
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        """
+        :param max_entries: max number of documents kept
+        :param max_bytes: max size of all documents kept (all codings)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # key -> (stats objects the document was built from, serialized stats) - ordered least to most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_serialize(self, key, sources, build):
+        """
+        Given a route key and the stats objects it is serving get the serialized document - built only if they changed
+        :param key: route key - ex: ('github', user, fields)
+        :param sources: stats objects the document is built from - ex: the cached stats dict, compared by identity
+        :param build: function returning the json document
+        :return: serialized stats
+        """
+
+        sources = tuple(sources)
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            # the very same stats objects - the cache handed them out again
+            if entry and len(entry[0]) == len(sources) and all(a is b for a, b in zip(entry[0], sources)):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        serialized = SerializedStats(build())
+
+        with self.lock:
+            # never going to fit
+            if serialized.size > self.max_bytes:
+                return serialized
+
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1].size
+
+            # the sources are kept alive with it - identity checks stay valid
+            self.entries[key] = (sources, serialized)
+            self.total_bytes += serialized.size
+
+            # evict least recently used until within bounds
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.entries.popitem(last=False)[1][1].size
+                self.evictions += 1
+
+        return serialized
+
+    def stats(self):
+        """
+        Get the serialized cache counters
+        :return: counters json
+        """
+
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+    def clear(self):
+        """
+        Drop every serialized document
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+# process wide serialized stats cache
+serialized_cache = SerializedCache(max_entries=SERIALIZED_CACHE_MAX_ENTRIES, max_bytes=SERIALIZED_CACHE_MAX_BYTES)
+
+
+def get_encoding(accept_encodings):
+    """
+    Given the client's accepted content codings pick the one to send
+    :param accept_encodings: werkzeug accept header - ex: request.accept_encodings
+    :return: br, gzip or identity
+    """
+
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding]:
+            return encoding
+
+    return 'identity'
+
+
+def stats_response(serialized, headers=None):
+    """
+    Given serialized stats build the response for the current request - compressed if accepted, 304 if the client's
+    If-None-Match still matches
+    :param serialized: serialized stats
+    :param headers: extra headers - ex: X-Stats-Age
+    :return: flask response
+    """
+
+    encoding = get_encoding(request.accept_encodings)
+
+    response = Response(serialized.bodies[encoding], mimetype='application/json', headers=headers)
+    response.set_etag(serialized.etags[encoding])
+    response.vary.add('Accept-Encoding')
+
+    if encoding != 'identity':
+        response.content_encoding = encoding
+
+    # If-None-Match - 304 without a body
+    return response.make_conditional(request)
+
+
+def serve_serialized(key, sources, build, headers=None, cache=True):
+    """
+    Given a route key and the stats it serves respond with them - serialized once, while the stats objects are the same
+    :param key: route key - ex: ('github', user, fields)
+    :param sources: stats objects the document is built from, compared by identity
+    :param build: function returning the json document
+    :param headers: extra headers - ex: X-Stats-Age
+    :param cache: keep the serialized document, False for one-off documents (ex: with a ?profile=1 breakdown)
+    :return: flask response
+    """
+
+    if cache:
+        serialized = serialized_cache.get_or_serialize(key, sources, build)
+    else:
+        serialized = SerializedStats(build())
+
+    return stats_response(serialized, headers)
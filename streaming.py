@@ -0,0 +1,204 @@
+import contextvars
+import json
+import queue
+import time
+from functools import partial
+
+from flask import Response
+
+from ratelimit import RateLimitError
+from refresher import serve_stats
+from util import collect_stats, merge_provider_stats, submit_to_pool
+
+# supported ?stream= formats -> mimetype
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream'
+}
+
+# where a streamed computation sends each stat - unset for anyone else computing the same stats
+stat_events = contextvars.ContextVar('stat_events', default=None)
+
+
+def format_event(event, stream_format):
+    """
+    Given an event json format it for the stream
+    :param event: event json - ex: {'stat': 'followers', 'value': 3}, anything else is the final document
+    :param stream_format: ndjson or sse
+    :return: event string
+    """
+
+    if stream_format == 'sse':
+        name = 'stat' if 'stat' in event else 'done'
+        return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(event))
+
+    return json.dumps(event) + '\n'
+
+
+def stream_response(events, stream_format):
+    """
+    Given a generator of events stream them back as they come
+    :param events: generator of event json
+    :param stream_format: ndjson or sse
+    :return: streamed response
+    """
+
+    return Response((format_event(event, stream_format) for event in events), mimetype=STREAM_FORMATS[stream_format])
+
+
+def compute_streamed_stats(iter_stats, keys):
+    """
+    Given a provider's stats generator collect the whole stats, sending each stat to the stream waiting on them if any
+    :param iter_stats: function returning a generator of (stat, value) - only the fields asked for
+    :param keys: stats in the order they are reported
+    :return: stats dict
+    """
+
+    events = stat_events.get()
+    stats = []
+
+    try:
+        for stat, value in iter_stats():
+            stats.append((stat, value))
+
+            if events is not None:
+                events.put({'stat': stat, 'value': value})
+
+    # out of upstream quota - report it like any other error
+    except RateLimitError as e:
+        return {'message': str(e)}
+
+    return collect_stats(stats, keys)
+
+
+def stream_provider_stats(provider, user, iter_stats, keys, bypass=False, fields=None):
+    """
+    Given a provider's stats generator send each stat as it is computed, cached stats go out in one go - through the
+    stats cache like the other routes, so concurrent requests share one computation and hot users are kept warm
+    :param provider: github or bitbucket
+    :param user: provider user
+    :param iter_stats: function returning a generator of (stat, value) - only the fields asked for
+    :param keys: stats in the order they are reported
+    :param bypass: skip the cached stats and refresh them
+    :param fields: stats wanted, default is None meaning all of them
+    :return: generator of {'stat': ..., 'value': ...} events, ends with the whole stats {'data': ...}
+    """
+
+    events = queue.Queue()
+    compute = partial(compute_streamed_stats, iter_stats, keys)
+
+    def serve():
+        # this stream gets the stats as they are computed - unless it waits on someone else's computation of them
+        stat_events.set(events)
+
+        try:
+            result = serve_stats(provider, user, compute, bypass, fields)[0]
+        except Exception as e:
+            result = {'message': "Could not get {} stats: {}".format(provider, e)}
+
+        events.put({'data': result})
+
+    # served on the shared pool, its stats handed over as they come
+    context = contextvars.copy_context()
+    submit_to_pool(context.run, serve)
+
+    yield from iter_events(events)
+
+
+def iter_events(events):
+    """
+    Given the queue a computation hands its events to send them as they come
+    :param events: queue of events - the computation ends with {'data': ...}
+    :return: generator of events, ends with the whole stats {'data': ...}
+    """
+
+    while True:
+        event = events.get()
+        yield event
+
+        if 'data' in event:
+            return
+
+
+def merge_provider_streams(streams, timeouts, executor):
+    """
+    Given several providers' event streams run them side by side and send their events as they come
+    :param streams: provider -> generator of events (ends with {'data': ...})
+    :param timeouts: provider -> seconds the provider is allowed in total
+    :param executor: pool the providers run on - submit raises RuntimeError when it cannot take them
+    :return: generator of (provider, event) - a provider running out of time ends with {'data': {'message': ...}}
+    """
+
+    events = queue.Queue()
+
+    def run(provider, stream):
+        try:
+            for event in stream:
+                events.put((provider, event))
+        except Exception as e:
+            events.put((provider, {'data': {'message': "Could not get {} stats: {}".format(provider, e)}}))
+
+    started = time.monotonic()
+    for provider, stream in streams.items():
+        try:
+            executor.submit(run, provider, stream)
+
+        # not started - ex: every provider slot is taken
+        except RuntimeError as e:
+            events.put((provider, {'data': {'message': "Could not get {} stats: {}".format(provider, e)}}))
+
+    yield from iter_provider_events(events, timeouts, started)
+
+
+def iter_provider_events(events, timeouts, started):
+    """
+    Given the queue several providers hand their events to send them as they come, each provider within its timeout
+    :param events: queue of (provider, event) - each provider ends with {'data': ...}
+    :param timeouts: provider -> seconds the provider is allowed in total
+    :param started: time.monotonic() the providers were started at
+    :return: generator of (provider, event) - a provider running out of time ends with {'data': {'message': ...}}
+    """
+
+    # providers that have not sent their whole stats yet
+    pending = set(timeouts)
+
+    while pending:
+        # wait no longer than the provider with the least time left
+        remaining = min(timeouts[provider] for provider in pending) - (time.monotonic() - started)
+
+        try:
+            provider, event = events.get(timeout=max(0, remaining))
+        except queue.Empty:
+            # out of time - leave it running in the background
+            for provider in [provider for provider in pending if timeouts[provider] <= time.monotonic() - started]:
+                pending.discard(provider)
+                message = "{} did not respond within {} seconds".format(provider.capitalize(), timeouts[provider])
+                yield provider, {'data': {'message': message}}
+            continue
+
+        if provider not in pending:     # already timed out
+            continue
+
+        if 'data' in event:
+            pending.discard(provider)
+
+        yield provider, event
+
+
+def merge_streamed_stats(provider_events):
+    """
+    Given the github and bitbucket events send each stat tagged with its provider, then the aggregated stats
+    :param provider_events: generator of (provider, event) - each provider ends with {'data': ...}
+    :return: generator of {'provider': ..., 'stat': ..., 'value': ...} events, ends with the aggregated stats
+    """
+
+    # provider -> whole stats
+    done = {}
+
+    for provider, event in provider_events:
+        if 'data' in event:
+            done[provider] = event['data']
+        else:
+            yield dict(event, provider=provider)
+
+    yield merge_provider_stats(done['github'], done['bitbucket'])
@@ -1,10 +1,192 @@
+import asyncio
+import gzip
+import json
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from unittest import mock
+from urllib.parse import urlsplit
+
+import brotli
+from prometheus_client import REGISTRY
+
+import app
+import async_api
 import bitbucket_api
+import cache
+import coalesce
 import github_api
+import metrics
+import profiling
+import ratelimit
+import refresher
+import repo_store
+import repo_table
+import responses
+import transport
+import util
+
+
+def make_repo(name, fork=False, pushed_at='2020-01-01'):
+    """
+    Given a repo name make a github repo listing item
+    """
+
+    return {'full_name': name, 'fork': fork, 'language': 'Python', 'forks_count': 0, 'watchers_count': 1,
+            'open_issues_count': 0, 'stargazers_count': 2, 'url': '', 'html_url': '', 'size': 3,
+            'pushed_at': pushed_at, 'updated_at': pushed_at}
+
+
+def fake_github_data(bodies):
+    """
+    Given path -> json body make a stand in for github_api.get_github_data, records the paths hit
+    """
+
+    hits = []
+
+    def get_github_data(path):
+        path = path.split('?')[0]
+        hits.append(path)
+        r = mock.Mock(status_code=200 if path in bodies else 404, headers={})
+        r.json.return_value = bodies.get(path, {'message': 'Not Found'})
+        return {'result': r, 'endpoint': path.split('/')[-1]}
+
+    return get_github_data, hits
 
 
 class TestMyAPI(unittest.TestCase):
 
+    # test merged endpoint
+    def test_MergedAPI(self):
+        client = app.app.test_client()
+
+        gh_stats = {'user': 'gh', 'followers': 1, 'languages': {'Python': 1}}
+        bb_stats = {'user': 'bb', 'followers': 2, 'languages': {'Python': 2, 'C': 1}}
+
+        with mock.patch('app.get_github_stats', return_value=gh_stats), \
+                mock.patch('app.get_bitbucket_stats', return_value=bb_stats):
+            data = client.get('/stats/github/gh/bitbucket/bb?nocache=1').get_json()
+
+        self.assertEqual(data['data']['followers'], 3)
+        self.assertEqual(data['data']['languages'], {'Python': 3, 'C': 1})
+
+    def test_MergedAPI_provider_timeout(self):
+        client = app.app.test_client()
+
+        def slow_github_stats(user, max_workers=None, fields=None):
+            time.sleep(0.5)
+            return {'user': user}
+
+        # slow github should not hold the bitbucket result hostage
+        with mock.patch('app.get_github_stats', side_effect=slow_github_stats), \
+                mock.patch('app.get_bitbucket_stats', return_value={'user': 'bb'}), \
+                mock.patch('app.GITHUB_TIMEOUT', 0.05):
+            data = client.get('/stats/github/gh/bitbucket/bb?nocache=1').get_json()
+
+        self.assertEqual(data['bitbucket_data'], {'user': 'bb'})
+
+        # the timed out github pipeline still holds the only slot - bitbucket is refused right away, not queued
+        release = threading.Event()
+        with mock.patch('app.provider_pool', util.BoundedExecutor(1)), \
+                mock.patch('app.get_github_stats', side_effect=lambda *args: release.wait(5) and {'user': 'gh'}), \
+                mock.patch('app.get_bitbucket_stats', return_value={'user': 'bb'}) as get_bitbucket_stats, \
+                mock.patch('app.GITHUB_TIMEOUT', 0.05):
+            started = time.monotonic()
+            client.get('/stats/github/gh/bitbucket/bb?nocache=1')
+            release.set()
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertFalse(get_bitbucket_stats.called)
+
+        # let the timed out pipelines finish - later requests for the same users would share them
+        while coalesce.stats_flight.stats()['in_flight']:
+            time.sleep(0.01)
+
+    # test batch endpoint
+    def test_BatchAPI(self):
+        client = app.app.test_client()
+        users = [{'github': 'gh', 'bitbucket': 'bb'}, {'github': 'gh'}, {'bitbucket': 'bb'}]
+
+        with mock.patch('app.get_github_stats', return_value={'user': 'gh', 'followers': 1}), \
+                mock.patch('app.get_bitbucket_stats', return_value={'user': 'bb', 'followers': 2}):
+            r = client.post('/stats/batch?nocache=1', json={'users': users})
+            lines = sorted([json.loads(line) for line in r.get_data(as_text=True).splitlines()], key=lambda line: line['index'])
+
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        self.assertEqual([line['index'] for line in lines], [0, 1, 2])
+        self.assertEqual(lines[0]['result']['data']['followers'], 3)
+        self.assertEqual(lines[2]['result']['data'], {'user': 'bb', 'followers': 2})
+
+        self.assertEqual(client.post('/stats/batch', json={'users': [{}]}).status_code, 400)
+
+    def test_dedupe_call(self):
+        calls = mock.Mock(return_value='data')
+
+        # outside a batch every call goes through
+        coalesce.dedupe_call('url', calls)
+        self.assertEqual(calls.call_count, 1)
+
+        # inside a batch identical calls are made once, across threads
+        context = coalesce.new_batch_context()
+        results = context.run(util.run_in_pool, lambda _: coalesce.dedupe_call('url', calls), range(5), 3)
+        self.assertEqual(results, ['data'] * 5)
+        self.assertEqual(calls.call_count, 2)
+
+        # the batch holds on to what was parsed off of the upstream responses, not the responses
+        not_found = mock.Mock(status_code=404, headers={}, content=b'{"message": "Not Found"}')
+        not_found.json.return_value = {'message': 'Not Found'}
+        ok = mock.Mock(status_code=200, headers={}, content=b'{"size": 1}')
+        ok.json.return_value = {'size': 1}
+
+        with mock.patch('github_api.http_get', return_value=not_found), \
+                mock.patch('bitbucket_api.http_get', return_value=ok):
+            context.run(github_api.get_github_data, 'users/missing')
+            context.run(bitbucket_api.get_bitbucket_data, 'users/someone')
+
+        scope = context.run(coalesce.batch_scope.get)
+        kept = [future.result() for future in scope.calls.values()]
+        self.assertEqual([(r.status_code, r.json()) for r in kept if isinstance(r, cache.CachedResponse)],
+                         [(404, {'message': 'Not Found'})])
+        self.assertIn({'result': {'size': 1}}, kept)
+
+    def test_SingleFlight(self):
+        flight = coalesce.SingleFlight(timeout=1)
+        release = threading.Event()
+        calls = mock.Mock(return_value='stats')
+
+        def slow():
+            release.wait()
+            return calls()
+
+        # five concurrent callers, one call
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = [executor.submit(flight.do, 'user', slow) for _ in range(5)]
+            time.sleep(0.1)
+            release.set()
+            self.assertEqual([future.result() for future in futures], ['stats'] * 5)
+
+        self.assertEqual(calls.call_count, 1)
+        self.assertEqual(flight.stats(), {'started': 1, 'shared': 4, 'in_flight': 0})
+
+        # errors reach every waiter
+        def failing():
+            time.sleep(0.1)
+            raise ValueError('upstream down')
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(flight.do, 'bad', failing) for _ in range(2)]
+            for future in futures:
+                self.assertRaises(ValueError, future.result)
+
+        # waiters give up after the timeout
+        flight = coalesce.SingleFlight(timeout=0.05)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(flight.do, 'slow', lambda: time.sleep(0.3))
+            time.sleep(0.05)
+            self.assertRaises(FutureTimeoutError, flight.do, 'slow', calls)
+            leader.result()
+
     # test all things bitbucket
     def test_BitbucketAPI(self):
         pass
@@ -13,38 +195,556 @@ class TestMyAPI(unittest.TestCase):
         pass
 
     def test_page_thru_bitbucket_data_json(self):
-        pass
+        next_url = 'https://api.bitbucket.org/2.0/repositories/someone?pagelen=2&page=2'
+
+        def get_bitbucket_data(url):
+            page = int(util.get_query_param(url, 'page') or 1)
+            data = {'size': 5, 'page': page, 'pagelen': 2, 'values': [page] * (2 if page < 3 else 1)}
+            if page < 3:
+                data['next'] = util.set_query_params(next_url, page=page + 1)
+            return {'result': data}
+
+        with mock.patch('bitbucket_api.get_bitbucket_data', side_effect=get_bitbucket_data) as get_data:
+            result = bitbucket_api.page_thru_bitbucket_data_json('repositories/someone', max_workers=2)
+
+        # size known - every page fetched once, kept in page order
+        self.assertEqual(result['result'], [1, 1, 2, 2, 3])
+        self.assertEqual(get_data.call_count, 3)
+        self.assertEqual(get_data.call_args_list[0][0][0], 'repositories/someone?pagelen=100')
+
+        # no size - follow next
+        pages = [{'result': {'values': [1], 'next': next_url}}, {'result': {'values': [2]}}]
+        with mock.patch('bitbucket_api.get_bitbucket_data', side_effect=pages):
+            self.assertEqual(bitbucket_api.page_thru_bitbucket_data_json('repositories/someone')['result'], [1, 2])
+
+        # a page that could not be grabbed fails the listing instead of silently truncating it
+        def missing_page(url):
+            return None if util.get_query_param(url, 'page') == '2' else get_bitbucket_data(url)
+
+        with mock.patch('bitbucket_api.get_bitbucket_data', side_effect=missing_page):
+            self.assertRaises(ValueError, bitbucket_api.page_thru_bitbucket_data_json, 'repositories/someone', 2)
 
     def test_get_bitbucket_stats(self):
-        pass
+        def links(name, issues=True):
+            repo_links = {'commits': {'href': '{}/commits'.format(name)}}
+            if issues:
+                repo_links['issues'] = {'href': '{}/issues'.format(name)}
+            return repo_links
+
+        repos = [
+            {'full_name': 'u/a', 'size': 10, 'language': 'python', 'links': links('u/a')},
+            {'full_name': 'u/b', 'size': 5, 'language': '', 'links': links('u/b', issues=False)},
+            {'full_name': 'u/c', 'size': 1, 'language': 'c', 'parent': {}, 'links': links('u/c')},
+        ]
+        responses = {
+            'users/u': {'username': 'u', 'links': {stat: {'href': stat} for stat in
+                                                   ['repositories', 'followers', 'following']}},
+            'followers': {'size': 3},
+            'following': {'size': 4},
+            'u/a/commits': {'values': [{}, {}], 'next': 'u/a/commits/2'},
+            'u/a/commits/2': {'values': [{}, {}]},
+            'u/a/issues': {'size': 2},
+            'u/c/issues': {'size': 1},
+        }
+
+        def get_bitbucket_data(url):
+            path = url.split('?')[0]
+            if path in responses:
+                return {'result': responses[path]}
+
+        prefetch = util.LazyStats.prefetch
+
+        def check_prefetch(stats, names, max_workers=None):
+            # the links every prefetched value needs are there before they run on their own threads
+            self.assertTrue(stats.computed('links'))
+            return prefetch(stats, names, max_workers)
+
+        with mock.patch('bitbucket_api.get_bitbucket_data', side_effect=get_bitbucket_data) as get_data, \
+                mock.patch('bitbucket_api.page_thru_bitbucket_data_json', return_value={'result': repos}), \
+                mock.patch.object(util.LazyStats, 'prefetch', check_prefetch):
+            result = bitbucket_api.get_bitbucket_stats('u', max_workers=4)
+
+        self.assertEqual(result['followers'], 3)
+        self.assertEqual(result['following'], 4)
+        self.assertEqual(result['languages'], {'python': 1, 'Not Specified': 1, 'c': 1})
+        self.assertEqual(result['repos'], {'original': 2, 'forked': 1})
+        self.assertEqual(result['total_open_issues'], 3)
+        self.assertEqual(result['total_commits'], 4)
+        self.assertEqual(result['total_account_size'], 16)
+        self.assertNotIn('total_watchers', result)
+
+        # open issues filtered upstream - only their number comes back
+        self.assertIn(mock.call('u/a/issues?q=state%3D%22new%22&fields=size'), get_data.call_args_list)
+
+        # u/b commits could not be grabbed - recorded, not fatal
+        self.assertEqual([(failed['repo'], failed['stat']) for failed in result['failed_repos']], [('u/b', 'commits')])
+
+        # only the per-repo calls the fields need
+        with mock.patch('bitbucket_api.get_bitbucket_data', side_effect=get_bitbucket_data) as get_data, \
+                mock.patch('bitbucket_api.page_thru_bitbucket_data_json', return_value={'result': repos}):
+            result = bitbucket_api.get_bitbucket_stats('u', max_workers=4, fields=('repos', 'total_commits'))
+
+        # every commits page walked, only the hashes asked for
+        self.assertEqual({stat: result[stat] for stat in ['repos', 'total_commits']},
+                         {'repos': {'original': 2, 'forked': 1}, 'total_commits': 4})
+        self.assertEqual(sorted(call[0][0] for call in get_data.call_args_list),
+                         ['u/a/commits/2', 'u/a/commits?pagelen=100&fields=next%2Cvalues.hash',
+                          'u/b/commits?pagelen=100&fields=next%2Cvalues.hash', 'users/u'])
+
+    def test_async_get_bitbucket_stats(self):
+        repos = [
+            {'full_name': 'u/a', 'size': 10, 'language': 'python', 'links': {'commits': {'href': 'u/a/commits'}}},
+            {'full_name': 'u/c', 'size': 1, 'language': 'c', 'parent': {},
+             'links': {'commits': {'href': 'u/c/commits'}}},
+        ]
+        bodies = {
+            'users/u': {'username': 'u', 'links': {stat: {'href': stat} for stat in
+                                                   ['repositories', 'followers', 'following']}},
+            'followers': {'size': 3},
+            'following': {'size': 4},
+            'repositories': {'values': repos},
+            'u/a/commits': {'values': [{}, {}], 'next': 'u/a/commits/2'},
+            'u/a/commits/2': {'values': [{}]},
+        }
+        urls = []
+
+        class FakeClient(object):
+            async def get(self, url, headers=None):
+                urls.append(url)
+                path = url.split('2.0/')[-1].split('?')[0]
+                if path not in bodies:
+                    return async_api.AsyncResponse(404, {}, b'{}')
+                return async_api.AsyncResponse(200, {}, json.dumps(bodies[path]))
+
+        result = asyncio.run(async_api.get_bitbucket_stats(FakeClient(), 'u'))
+
+        # every commits page walked, only the hashes asked for
+        self.assertEqual(result['total_commits'], 3)
+        self.assertIn('u/a/commits?pagelen=100&fields=next%2Cvalues.hash', [url.split('2.0/')[-1] for url in urls])
+        self.assertEqual(result['repos'], {'original': 1, 'forked': 1})
+        self.assertNotIn('total_watchers', result)
 
     # test all things github
     def test_GithubAPI(self):
-        pass
+        client = app.app.test_client()
+        stats = {'user': 'gh', 'followers': 1, 'languages': {None: 1, 'Python': 2}}
+
+        cache.stats_cache.clear()
+        responses.serialized_cache.clear()
+        cache.stats_cache.set(('github', 'gh'), stats)
+
+        # compressed with the best coding accepted, each coding its own strong ETag
+        r = client.get('/stats/github/gh', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(r.headers['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(r.get_data())),
+                         {'data': dict(stats, languages={'null': 1, 'Python': 2})})
+        self.assertFalse(r.headers['ETag'].startswith('W/'))
+
+        r = client.get('/stats/github/gh', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(json.loads(gzip.decompress(r.get_data()))['data']['followers'], 1)
+
+        # unchanged - not modified, serialized only the once
+        r = client.get('/stats/github/gh', headers={'Accept-Encoding': 'gzip', 'If-None-Match': r.headers['ETag']})
+        self.assertEqual((r.status_code, r.get_data()), (304, b''))
+        self.assertEqual(responses.serialized_cache.stats()['misses'], 1)
+
+        # new stats - new document, new ETag
+        etag = client.get('/stats/github/gh').headers['ETag']
+        cache.stats_cache.set(('github', 'gh'), dict(stats, followers=2))
+        r = client.get('/stats/github/gh', headers={'If-None-Match': etag})
+        self.assertEqual((r.status_code, r.get_json()['data']['followers']), (200, 2))
+        self.assertNotEqual(r.headers['ETag'], etag)
+
+        # ?fields= picked out of the same whole stats - serialized only the once too
+        misses = responses.serialized_cache.stats()['misses']
+        for _ in range(2):
+            r = client.get('/stats/github/gh?fields=followers')
+            self.assertEqual(r.get_json()['data'], {'followers': 2})
+        self.assertEqual(responses.serialized_cache.stats()['misses'], misses + 1)
+
+        cache.stats_cache.clear()
+
+    def test_GithubAPI_stream(self):
+        client = app.app.test_client()
+        stats = [('user', 'gh'), ('followers', 1), ('total_commits', 5)]
+
+        with mock.patch('github_api.iter_github_stats', return_value=iter(stats)):
+            r = client.get('/stats/github/gh?stream=ndjson&nocache=1')
+            lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+
+        # each stat as it comes, then the whole document
+        self.assertEqual(lines[:3], [{'stat': stat, 'value': value} for stat, value in stats])
+        self.assertEqual(lines[3], {'data': {'user': 'gh', 'followers': 1, 'total_commits': 5}})
+
+        # cached like the other routes - in one go
+        r = client.get('/stats/github/gh?stream=ndjson')
+        self.assertEqual([json.loads(line) for line in r.get_data(as_text=True).splitlines()], [lines[3]])
+
+        # any error ends the stream with its message
+        with mock.patch('github_api.iter_github_stats', side_effect=ValueError('upstream down')):
+            r = client.get('/stats/github/gh?stream=ndjson&nocache=1')
+            lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+
+        self.assertEqual(lines, [{'data': {'message': 'Could not get github stats: upstream down'}}])
+
+        cache.stats_cache.clear()
+
+        self.assertEqual(client.get('/stats/github/gh?stream=xml').status_code, 400)
+
+    def test_MergedAPI_stream(self):
+        client = app.app.test_client()
+
+        with mock.patch('app.iter_github_stats', return_value=iter([('user', 'gh'), ('followers', 1)])), \
+                mock.patch('app.iter_bitbucket_stats', return_value=iter([('user', 'bb'), ('followers', 2)])):
+            r = client.get('/stats/github/gh/bitbucket/bb?stream=sse&nocache=1')
+            events = r.get_data(as_text=True).strip().split('\n\n')
+
+        self.assertEqual(r.mimetype, 'text/event-stream')
+        self.assertEqual(len(events), 5)
+        self.assertTrue(events[-1].startswith('event: done'))
+        self.assertEqual(json.loads(events[-1].split('data: ')[1])['data']['followers'], 3)
 
     def test_get_github_data(self):
         pass
 
+    def test_async_get_github_stats(self):
+        repo = {'full_name': 'gh/a', 'fork': False, 'language': None, 'forks_count': 0, 'watchers_count': 2,
+                'open_issues_count': 1, 'stargazers_count': 3, 'url': '', 'html_url': '', 'size': 7}
+        bodies = {
+            'users/gh': {'login': 'gh', 'followers': 1, 'following': 2},
+            'users/gh/repos': [repo],
+            'users/gh/starred': [{}],
+            'repos/gh/a/topics': {'names': ['api']},
+            'repos/gh/a/commits': [{}],
+        }
+
+        class FakeClient(object):
+            async def get(self, url, headers=None):
+                path = url.split('api.github.com/')[1].split('?')[0]
+                return async_api.AsyncResponse(200, {}, json.dumps(bodies[path]))
+
+        result = asyncio.run(async_api.get_github_stats(FakeClient(), 'gh'))
+
+        self.assertEqual(list(result), github_api.GITHUB_STATS_KEYS)
+        self.assertEqual(result['repo_topics'], {'api': 1})
+        self.assertEqual(result['languages'], {'Not Specified': 1})
+        self.assertEqual((result['total_commits'], result['total_stars_given'], result['total_account_size']), (1, 1, 7))
+
+    def test_async_stats_view_cache(self):
+        cache.stats_cache.clear()
+        cache.stats_cache.set(('github', 'gh'), {'user': 'gh', 'total_commits': 400})
+
+        async def async_github_stats(client, user, max_workers=None, fields=None):
+            self.assertIs(client, async_api.async_loop.client)
+            return {'user': user, 'total_commits': 160}
+
+        with mock.patch('async_api.get_github_stats', async_github_stats):
+            r = app.app.test_client().get('/async/stats/github/gh')
+
+        # computed on the shared loop, cached apart from the threaded route's stats
+        self.assertEqual(r.get_json()['data']['total_commits'], 160)
+        self.assertEqual(cache.stats_cache.get(('github', 'gh'))['total_commits'], 400)
+        self.assertEqual(cache.stats_cache.get(async_api.get_async_stats_key('github', 'gh'))['total_commits'], 160)
+
+        cache.stats_cache.clear()
+
+    def test_async_routes_match_threaded_routes(self):
+        bb_url = 'https://api.bitbucket.org/2.0/'
+        bb_repo = {'full_name': 'bb/a', 'size': 4, 'language': 'go',
+                   'links': {'commits': {'href': bb_url + 'repositories/bb/a/commits'}}}
+        bodies = {
+            'users/gh': {'login': 'gh', 'followers': 1, 'following': 2},
+            'users/gh/repos': [make_repo('gh/a'), make_repo('gh/b', fork=True)],
+            'users/gh/starred': [{}],
+            'repos/gh/a/topics': {'names': ['api']},
+            'repos/gh/b/topics': {'names': ['api', 'cli']},
+            'repos/gh/a/commits': [{}],
+            '2.0/users/bb': {'username': 'bb', 'links': {stat: {'href': bb_url + 'bb/' + stat}
+                                                         for stat in ['repositories', 'followers', 'following']}},
+            '2.0/bb/followers': {'size': 3},
+            '2.0/bb/following': {'size': 4},
+            '2.0/bb/repositories': {'values': [bb_repo]},
+            '2.0/repositories/bb/a/commits': {'values': [{}, {}]},
+        }
+
+        def upstream(url, headers=None):
+            path = urlsplit(url).path.lstrip('/')
+            if path not in bodies:
+                return async_api.AsyncResponse(404, {}, b'{"message": "Not Found"}')
+            return async_api.AsyncResponse(200, {}, json.dumps(bodies[path]).encode())
+
+        class FakeClient(object):
+            async def get(self, url, headers=None):
+                return upstream(url, headers)
+
+        client = app.app.test_client()
+        async_api.async_loop.start()
+
+        with mock.patch('github_api.http_get', side_effect=upstream), \
+                mock.patch('bitbucket_api.http_get', side_effect=upstream), \
+                mock.patch.object(async_api.async_loop, 'client', FakeClient()), \
+                mock.patch('github_api.repo_store', repo_store.RepoStore(':memory:')), \
+                mock.patch('async_api.repo_store', repo_store.RepoStore(':memory:')):
+
+            for route in ['/stats/github/gh', '/stats/bitbucket/bb', '/stats/github/gh/bitbucket/bb']:
+                for query in ['?nocache=1', '?nocache=1&workers=1&fields=followers,repos,total_commits']:
+                    threaded = client.get(route + query)
+
+                    # same document byte for byte - same stats, same key order
+                    self.assertEqual(client.get('/async' + route + query).get_data(), threaded.get_data())
+
+                # streamed the same - the providers of the merged route interleave
+                threaded = client.get(route + '?nocache=1&stream=ndjson').get_data(as_text=True).splitlines()
+                streamed = client.get('/async' + route + '?nocache=1&stream=ndjson').get_data(as_text=True).splitlines()
+                self.assertEqual((sorted(streamed[:-1]), streamed[-1]), (sorted(threaded[:-1]), threaded[-1]))
+
+            # options checked the same
+            self.assertEqual(client.get('/async/stats/github/gh?fields=nope').status_code, 400)
+
+        cache.stats_cache.clear()
+
+    def test_async_pipeline_errors(self):
+        first = async_api.AsyncResponse(200, {'Link': '<https://api.github.com/users/gh/repos?page=3>; rel="last"'},
+                                        b'[{}]')
+        cancelled = []
+
+        class FakeClient(object):
+            async def get(self, url, headers=None):
+                page = dict(param.split('=') for param in urlsplit(url).query.split('&')).get('page')
+
+                # page 2 fails right away, page 3 is still in flight
+                if page == '2':
+                    return async_api.AsyncResponse(500, {}, b'{"message": "Server Error"}')
+                if page == '3':
+                    try:
+                        await asyncio.sleep(5)
+                    except asyncio.CancelledError:
+                        cancelled.append(page)
+                        raise
+                return first
+
+        # an error page is not counted as repos - it fails the stats and the sibling page is not left running
+        with self.assertRaises(ValueError):
+            asyncio.run(async_api.page_thru_github_data_json(FakeClient(), 'users/gh/repos', asyncio.Semaphore(4)))
+
+        self.assertEqual(cancelled, ['3'])
+
+    def test_get_github_data_revalidates(self):
+        repo = dict(make_repo('etag-test/a'), owner={'login': 'etag-test'}, permissions={'admin': False})
+        first = mock.Mock(status_code=200, headers={'ETag': '"abc"'}, content=json.dumps([repo]).encode())
+        first.json.return_value = [repo]
+        not_modified = mock.Mock(status_code=304, headers={})
+
+        with mock.patch('github_api.http_get', side_effect=[first, not_modified]) as http_get:
+            first_body = github_api.get_github_data('users/etag-test/repos')['result'].json()
+            self.assertEqual(github_api.get_github_data('users/etag-test/repos')['result'].json(), first_body)
+
+        # second call sent the stored etag and was served the stored body
+        self.assertEqual(http_get.call_args[1]['headers']['If-None-Match'], '"abc"')
+        self.assertEqual(first.json.call_count, 1)
+
+        # repo listings are kept with only the keys the stats read
+        self.assertEqual(first_body, [make_repo('etag-test/a')])
+        self.assertEqual(github_api.get_repo_info(first_body[0]).full_name, 'etag-test/a')
+
     def test_get_github_pagination(self):
-        pass
+        link_str = '<https://api.github.com/repositories/42/commits?per_page=1&page=2>; rel="next", ' \
+                   '<https://api.github.com/repositories/42/commits?per_page=1&page=57>; rel="last"'
+
+        self.assertEqual(github_api.get_github_pagination(link_str),
+                         ('https://api.github.com/repositories/42/commits?per_page=1&page=57', 57))
+        self.assertEqual(github_api.get_github_pagination(None), (None, 1))
 
     def test_page_thru_github_data_count(self):
-        pass
+        link_str = '<https://api.github.com/user/7/starred?per_page=1&page=2>; rel="next", ' \
+                   '<https://api.github.com/user/7/starred?per_page=1&page=123>; rel="last"'
+        many = mock.Mock(status_code=200, headers={'Link': link_str})
+        one = mock.Mock(status_code=200, headers={})
+        one.json.return_value = [{}]
+
+        with mock.patch('github_api.get_github_data', side_effect=[{'result': many}, {'result': one}]) as get_data:
+            self.assertEqual(github_api.page_thru_github_data_count('users/someone/starred'), 123)
+            self.assertEqual(github_api.page_thru_github_data_count('repos/someone/repo/commits'), 1)
+
+        # one item per page, the body of a multi page listing is never read
+        self.assertEqual(get_data.call_args_list[0][0][0], 'users/someone/starred?per_page=1')
+        many.json.assert_not_called()
 
     def test_page_thru_github_data_json(self):
-        pass
+        link_str = '<https://api.github.com/user/7/repos?per_page=100&page=2>; rel="next", ' \
+                   '<https://api.github.com/user/7/repos?per_page=100&page=3>; rel="last"'
+
+        def get_github_data(path):
+            page = int(util.get_query_param(path, 'page') or 1)
+            r = mock.Mock(status_code=200, headers={'Link': link_str} if page == 1 else {})
+            r.json.return_value = [page * 10, page * 10 + 1]
+            return {'result': r}
+
+        with mock.patch('github_api.get_github_data', side_effect=get_github_data) as get_data:
+            result = github_api.page_thru_github_data_json('users/someone/repos', max_workers=2)
+
+        # first page reused, the rest fetched once each and put back in page order
+        self.assertEqual(result, [10, 11, 20, 21, 30, 31])
+        self.assertEqual(get_data.call_count, 3)
+        self.assertEqual(get_data.call_args_list[0][0][0], 'users/someone/repos?per_page=100')
 
     def test_get_repo_info(self):
-        pass
+        repo = dict(make_repo('gh/a', fork=True), language=None, description='not kept')
+        record = github_api.get_repo_info(repo)
+
+        # only the projected fields, read like a dict
+        self.assertEqual((record['full_name'], record['pub_repo_type'], record['language']),
+                         ('gh/a', 'forked', 'Not Specified'))
+        self.assertEqual(record.get('star_count'), 2)
+        self.assertIsNone(record.get('description'))
+        self.assertRaises(KeyError, lambda: record['description'])
+        self.assertFalse(hasattr(record, '__dict__'))
 
     def test_cleaned_repos_data(self):
-        pass
+        # streamed straight from the pages - a generator is consumed once
+        repos = (make_repo('gh/{}'.format(index)) for index in range(3))
+        records = github_api.cleaned_repos_data(repos)
+
+        self.assertEqual([record['full_name'] for record in records], ['gh/0', 'gh/1', 'gh/2'])
+        self.assertEqual(github_api.get_repo_summary(records, item='size', action='sum'), 9)
 
     def test_get_repo_summary(self):
         pass
 
+    def test_RepoTable(self):
+        repos = github_api.cleaned_repos_data([
+            dict(make_repo('gh/a'), stargazers_count=5),
+            dict(make_repo('gh/b', fork=True), language='Go'),
+            dict(make_repo('gh/c'), language=None, size=10)
+        ])
+        table = repo_table.RepoTable.from_repos(repos)
+        summary = table.summarize()
+
+        # same answers as scanning the repos once per stat
+        for column in ['language', 'pub_repo_type']:
+            self.assertEqual(summary['count'][column], github_api.get_repo_summary(repos, item=column, action='count'))
+        for column in ['star_count', 'watchers_count', 'open_issues_count', 'size']:
+            self.assertEqual(summary['sum'][column], github_api.get_repo_summary(repos, item=column, action='sum'))
+
+        # filtered by repo type
+        self.assertEqual(table.column('full_name', repo_type='original'), ['gh/a', 'gh/c'])
+        self.assertEqual(sorted(summary), ['count', 'sum'])
+        self.assertEqual(table.sum('star_count', repo_type='forked'), 2)
+        self.assertEqual(table.count('language', repo_type='forked'), {'Go': 1})
+
+        # bitbucket repos are not repo records - built from their columns, only sizes are summed
+        table = bitbucket_api.get_bitbucket_repo_table([
+            {'full_name': 'u/a', 'size': 10, 'language': ''},
+            {'full_name': 'u/b', 'size': 5, 'language': 'c', 'parent': {'full_name': 'o/b'}}
+        ])
+        self.assertEqual(table.summarize()['count'], {'language': {'Not Specified': 1, 'c': 1},
+                                                      'pub_repo_type': {'original': 1, 'forked': 1}})
+        self.assertEqual(table.sum('size', repo_type='original'), 10)
+        self.assertEqual(table.sum('star_count'), 0)
+
     def test_get_github_stats(self):
-        pass
+        bodies = {
+            'users/gh': {'login': 'gh', 'followers': 1, 'following': 2},
+            'users/gh/repos': [make_repo('gh/a'), make_repo('gh/b', fork=True)],
+            'users/gh/starred': [{}],
+            'repos/gh/a/topics': {'names': ['api', 'flask']},
+            'repos/gh/b/topics': {'names': ['api']},
+            'repos/gh/a/commits': [{}],
+        }
+        get_github_data, hits = fake_github_data(bodies)
+
+        with mock.patch('github_api.get_github_data', side_effect=get_github_data), \
+                mock.patch('github_api.repo_store', repo_store.RepoStore(':memory:')):
+            result = github_api.get_github_stats('gh')
+
+            self.assertEqual(list(result), github_api.GITHUB_STATS_KEYS)
+            self.assertEqual(result['repo_topics'], {'api': 2, 'flask': 1})
+            self.assertEqual(result['repos'], {'original': 1, 'forked': 1})
+            self.assertEqual((result['total_commits'], result['total_stars_given']), (1, 1))
+            self.assertEqual(len(hits), 6)
+
+            # refresh - only the repo pushed to since is fetched again
+            bodies['users/gh/repos'][0]['pushed_at'] = '2021-01-01'
+            del hits[:]
+            self.assertEqual(github_api.get_github_stats('gh'), result)
+            self.assertEqual(sorted(hits), ['repos/gh/a/commits', 'repos/gh/a/topics', 'users/gh',
+                                            'users/gh/repos', 'users/gh/starred'])
+
+    def test_get_github_stats_fields(self):
+        bodies = {
+            'users/gh': {'login': 'gh', 'followers': 1, 'following': 2},
+            'users/gh/repos': [make_repo('gh/a'), make_repo('gh/b', fork=True)],
+            'repos/gh/a/topics': {'names': ['api']},
+            'repos/gh/b/topics': {'names': []},
+        }
+        get_github_data, hits = fake_github_data(bodies)
+
+        with mock.patch('github_api.get_github_data', side_effect=get_github_data), \
+                mock.patch('github_api.repo_store', repo_store.RepoStore(':memory:')):
+
+            # profile only - no repo, starred, topic or commit calls
+            self.assertEqual(github_api.get_github_stats('gh', fields=('followers',)), {'followers': 1})
+            self.assertEqual(hits, ['users/gh'])
+
+            # topics - no commit or starred calls
+            del hits[:]
+            result = github_api.get_github_stats('gh', fields=('repo_topics', 'repos'))
+            self.assertEqual(list(result), ['repo_topics', 'repos'])
+            self.assertEqual(sorted(hits), ['repos/gh/a/topics', 'repos/gh/b/topics', 'users/gh', 'users/gh/repos'])
+
+        # unknown fields are refused
+        r = app.app.test_client().get('/stats/github/gh?fields=followers,nope')
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('nope', r.get_json()['message'])
+
+    def test_GithubAPI_profile(self):
+        bodies = {
+            '/users/gh': {'login': 'gh', 'followers': 1, 'following': 2},
+            '/users/gh/repos': [make_repo('gh/a')],
+            '/users/gh/starred': [{}],
+            '/repos/gh/a/topics': {'names': ['api']},
+            '/repos/gh/a/commits': [{}, {}],
+        }
+
+        def get(url, **kwargs):
+            body = bodies[urlsplit(url).path]
+            r = mock.Mock(status_code=200, headers={}, content=json.dumps(body).encode())
+            r.json.return_value = body
+            return r
+
+        session = mock.Mock()
+        session.get.side_effect = get
+
+        with mock.patch('transport.get_session', return_value=session), \
+                mock.patch('github_api.repo_store', repo_store.RepoStore(':memory:')):
+            data = app.app.test_client().get('/stats/github/gh?profile=1').get_json()
+
+        # computed fresh, every upstream call and aggregation broken down
+        profile = data['profile']
+        self.assertEqual(data['data']['total_commits'], 2)
+        self.assertEqual(profile['upstream_calls'], 5)
+        self.assertEqual(profile['upstream']['github']['topics']['calls'], 1)
+        self.assertEqual(profile['bytes'], sum(len(json.dumps(body)) for body in bodies.values()))
+        self.assertEqual(profile['pages'], {'github': 1})
+        self.assertEqual(profile['aggregation']['cleaned_repos_data']['calls'], 1)
+
+        # not with streaming
+        self.assertEqual(app.app.test_client().get('/stats/github/gh?profile=1&stream=ndjson').status_code, 400)
+
+    def test_profile_aggregation_excludes_pages(self):
+        def iter_github_pages(path, max_workers=None):
+            for page in range(2):
+                time.sleep(0.2)
+                yield [make_repo('gh/{}'.format(page))]
+
+        # cleaning is timed page by page - the waits on the pages stay out of it
+        with mock.patch('github_api.iter_github_pages', iter_github_pages), profiling.profile_request() as profile:
+            repos = github_api.get_github_producers('gh')['all_repos'](None)
+
+        aggregation = profile.report()['aggregation']['cleaned_repos_data']
+        self.assertEqual([repo['full_name'] for repo in repos], ['gh/0', 'gh/1'])
+        self.assertEqual(aggregation['calls'], 2)
+        self.assertLess(aggregation['seconds'], 0.1)
 
     # test util functions
     def test_flatten_list(self):
@@ -53,9 +753,296 @@ class TestMyAPI(unittest.TestCase):
     def test_count_items_in_list(self):
         pass
 
+    def test_parse_link_header(self):
+        links = util.parse_link_header('<https://x/y?page=2>; rel="next", <https://x/y?page=9>; rel="last"')
+        self.assertEqual(links, {'next': 'https://x/y?page=2', 'last': 'https://x/y?page=9'})
+        self.assertEqual(util.parse_link_header(''), {})
+
+    def test_set_query_params(self):
+        self.assertEqual(util.set_query_params('users/a/repos', per_page=100), 'users/a/repos?per_page=100')
+        self.assertEqual(util.set_query_params('https://x/y?page=9&per_page=100', page=3),
+                         'https://x/y?page=3&per_page=100')
+
     def test_get_specific_count_to_sum(self):
         pass
 
+    # test stats cache
+    def test_merge_provider_stats(self):
+        gh_data = {'user': 'g', 'followers': 1, 'languages': {'python': 1}}
+        bb_data = {'user': 'b', 'followers': 2, 'languages': {'c': 1},
+                   'failed_repos': [{'repo': 'b/a', 'stat': 'total_commits'}]}
+
+        # repos that failed are passed through per provider
+        result = util.merge_provider_stats(gh_data, bb_data)
+        self.assertEqual(result['data']['followers'], 3)
+        self.assertEqual(result['data']['failed_repos'], {'bitbucket': [{'repo': 'b/a', 'stat': 'total_commits'}]})
+
+        # and left out when none did
+        self.assertNotIn('failed_repos', util.merge_provider_stats(gh_data, {'user': 'b', 'followers': 2})['data'])
+
+    def test_StatsCache(self):
+        stats_cache = cache.StatsCache(ttls={'github': 60}, negative_ttl=0, max_entries=2, max_bytes=1024)
+        compute = mock.Mock(return_value={'user': 'a'})
+
+        # second call is a hit
+        self.assertEqual(stats_cache.get_or_compute(('github', 'a'), compute), {'user': 'a'})
+        self.assertEqual(stats_cache.get_or_compute(('github', 'a'), compute), {'user': 'a'})
+        self.assertEqual(compute.call_count, 1)
+
+        # bypass recomputes
+        stats_cache.get_or_compute(('github', 'a'), compute, bypass=True)
+        self.assertEqual(compute.call_count, 2)
+
+        # error results are not kept past the negative ttl
+        stats_cache.set(('github', 'bad'), {'message': 'Not Found'})
+        self.assertIsNone(stats_cache.get(('github', 'bad')))
+
+        # and neither are partial ones - some repos failed
+        stats_cache.set(('github', 'partial'), {'user': 'partial', 'failed_repos': [{'repo': 'partial/a'}]})
+        self.assertIsNone(stats_cache.get(('github', 'partial')))
+
+        # least recently used goes first
+        stats_cache.set(('github', 'b'), {'user': 'b'})
+        stats_cache.get(('github', 'a'))
+        stats_cache.set(('github', 'c'), {'user': 'c'})
+        self.assertIsNone(stats_cache.get(('github', 'b')))
+        self.assertIsNotNone(stats_cache.get(('github', 'a')))
+
+        # too big for the byte bound
+        stats_cache.set(('github', 'big'), {'user': 'x' * 2048})
+        self.assertIsNone(stats_cache.get(('github', 'big')))
+
+        counters = stats_cache.stats()
+        self.assertEqual((counters['hits'], counters['evictions'], counters['bypasses']), (3, 1, 1))
+
+    # test stale while revalidate of hot users
+    def test_Refresher(self):
+        stats_cache = cache.StatsCache(ttls={'github': 0.05}, negative_ttl=0, max_entries=8, max_bytes=4096,
+                                       stale_ttl=60)
+        warm = refresher.Refresher(stats_cache, window=60, hot_threshold=2, refresh_ahead=0.2, interval=60,
+                                   max_workers=1, budget=10)
+        compute = mock.Mock(side_effect=[{'user': 'a', 'n': 1}, {'user': 'a', 'n': 2}])
+
+        # computed, then a fresh hit with its age
+        self.assertEqual(warm.serve('github', 'a', compute), ({'user': 'a', 'n': 1}, None))
+        value, age = warm.serve('github', 'a', compute)
+        self.assertEqual((value['n'], age < 1), (1, True))
+
+        # expired - the hot user gets the stale stats while they are refreshed in the background
+        time.sleep(0.1)
+        value, age = warm.serve('github', 'a', compute)
+        self.assertEqual(value['n'], 1)
+
+        warm.executor.shutdown(wait=True)
+        self.assertEqual(stats_cache.get_stale(('github', 'a'))[0]['n'], 2)
+        self.assertEqual(compute.call_count, 2)
+        self.assertEqual([(user['user'], user['requests']) for user in warm.warmed()], [('a', 3)])
+
+        # admins only - off without a configured token
+        client = app.app.test_client()
+        self.assertEqual(client.get('/admin/warm').status_code, 404)
+
+        with mock.patch('refresher.ADMIN_TOKEN', 'secret'):
+            self.assertEqual(client.get('/admin/warm').status_code, 401)
+            self.assertEqual(client.get('/admin/warm', headers={'Authorization': 'Bearer nope'}).status_code, 401)
+            self.assertEqual(client.get('/admin/warm', headers={'Authorization': 'Bearer secret'}).status_code, 200)
+
+        # age of the oldest stats goes in the header
+        self.assertEqual(refresher.get_age_headers(None, 2.5, 7.9), {'X-Stats-Age': '7'})
+        self.assertEqual(refresher.get_age_headers(None), {})
+
+    # test rate limit scheduler
+    def test_RateLimitScheduler(self):
+        scheduler = ratelimit.RateLimitScheduler(rate=1000, burst=10, max_wait=0.5, background_reserve=0.2)
+
+        # quota reported by the upstream is tracked
+        scheduler.acquire('api.github.com', 'me')
+        scheduler.update('api.github.com', 'me', 200, {'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '15',
+                                                       'X-RateLimit-Reset': str(time.time() + 3600)})
+        self.assertEqual(scheduler.stats()[0]['remaining'], 15)
+
+        # background calls leave the last 20% of the quota to interactive ones
+        self.assertRaises(ratelimit.RateLimitError, scheduler.acquire, 'api.github.com', 'me', 'background')
+        scheduler.acquire('api.github.com', 'me', 'interactive')
+
+        # secondary rate limit - retry after the given seconds, longer than max_wait gives up
+        self.assertTrue(scheduler.update('api.github.com', 'other', 429, {'Retry-After': '60'}))
+        self.assertRaises(ratelimit.RateLimitError, scheduler.acquire, 'api.github.com', 'other')
+
+        # short backoff is waited out
+        self.assertTrue(scheduler.update('api.bitbucket.org', None, 429, {'Retry-After': '0.05'}))
+        started = time.time()
+        scheduler.acquire('api.bitbucket.org', None)
+        self.assertGreaterEqual(time.time() - started, 0.04)
+
+        # on the event loop - waited out by sleeping, the executor threads stay free
+        async def acquire_many():
+            loop = asyncio.get_running_loop()
+            with mock.patch.object(loop, 'run_in_executor') as run_in_executor:
+                await asyncio.gather(*[scheduler.acquire_async('api.bitbucket.org', None) for _ in range(3)])
+            return run_in_executor.called
+
+        self.assertTrue(scheduler.update('api.bitbucket.org', None, 429, {'Retry-After': '0.05'}))
+        started = time.time()
+        self.assertFalse(asyncio.run(acquire_many()))
+        self.assertGreaterEqual(time.time() - started, 0.04)
+
+        with self.assertRaises(ratelimit.RateLimitError):
+            asyncio.run(scheduler.acquire_async('api.github.com', 'other'))
+        self.assertEqual(scheduler.waiting, {'interactive': 0, 'background': 0})
+
+    def test_http_get_retries_rate_limited(self):
+        limited = mock.Mock(status_code=429, headers={'Retry-After': '0'}, content=b'')
+        ok = mock.Mock(status_code=200, headers={}, content=b'{}')
+        session = mock.Mock()
+        session.get.side_effect = [limited, ok]
+
+        with mock.patch('transport.get_session', return_value=session):
+            self.assertIs(transport.http_get('https://api.bitbucket.org/2.0/users/someone'), ok)
+
+        self.assertEqual(session.get.call_count, 2)
+
+    def test_async_client_retries_rate_limited(self):
+        statuses = [429, 403, 200]
+        calls = []
+
+        class FakeResponse(object):
+            def __init__(self, status):
+                self.status = status
+                self.headers = {'Retry-After': '0'} if status == 429 else {}
+
+            async def read(self):
+                return b'{"message": "API rate limit exceeded"}' if self.status == 403 else b'{}'
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc_info):
+                pass
+
+        class FakeSession(object):
+            def get(self, url, headers=None, auth=None):
+                calls.append(url)
+                return FakeResponse(statuses[len(calls) - 1])
+
+        async def get(url):
+            client = async_api.AsyncClient()
+            client.session = FakeSession()
+            return await client.get(url)
+
+        scheduler = ratelimit.RateLimitScheduler(rate=1000, burst=10, max_wait=5, background_reserve=0)
+
+        with mock.patch('async_api.scheduler', scheduler), mock.patch('async_api.RATE_LIMIT_RETRIES', 1):
+            # paced by the scheduler, the 429 retried - the plain 403 goes back to the caller
+            self.assertEqual(asyncio.run(get('https://api.github.com/repos/gh/a/topics')).status_code, 403)
+            self.assertEqual(len(calls), 2)
+            self.assertLess(scheduler.limits[('api.github.com', None)].tokens, 10)
+
+            # still rate limited after the retries
+            statuses[2:] = [429, 429]
+            with self.assertRaises(ratelimit.RateLimitError):
+                asyncio.run(get('https://api.github.com/users/gh'))
+
+        # a topics call that is refused fails the stats, like on the threaded routes
+        class RefusedClient(object):
+            async def get(self, url, headers=None):
+                return async_api.AsyncResponse(403, {}, b'{"message": "Forbidden"}')
+
+        refused = mock.Mock(status_code=403, headers={}, content=b'{"message": "Forbidden"}')
+        refused.json.return_value = {'message': 'Forbidden'}
+
+        with mock.patch('github_api.http_get', return_value=refused), self.assertRaises(KeyError):
+            github_api.get_repo_topics('repos/gh/a/topics')
+
+        with self.assertRaises(KeyError):
+            asyncio.run(async_api.get_repo_topics(RefusedClient(), 'repos/gh/a/topics'))
+
+    # test prometheus metrics
+    def test_metrics(self):
+        self.assertEqual(metrics.get_upstream_labels('https://api.github.com/repos/someone/repo/topics'),
+                         ('github', 'topics'))
+        self.assertEqual(metrics.get_upstream_labels('https://api.bitbucket.org/2.0/repositories/someone?pagelen=100'),
+                         ('bitbucket', 'repositories'))
+        self.assertEqual(metrics.get_upstream_labels('https://api.bitbucket.org/2.0/teams/someone'),
+                         ('bitbucket', 'user'))
+
+        def sample(name, labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        labels = {'provider': 'github', 'endpoint': 'starred'}
+        calls = sample('upstream_calls_total', dict(labels, status='200'))
+        received = sample('upstream_received_bytes_total', labels)
+
+        session = mock.Mock()
+        session.get.return_value = mock.Mock(status_code=200, headers={}, content=b'[1, 2]')
+
+        with mock.patch('transport.get_session', return_value=session):
+            transport.http_get('https://api.github.com/users/someone/starred?per_page=1')
+
+        self.assertEqual(sample('upstream_calls_total', dict(labels, status='200')), calls + 1)
+        self.assertEqual(sample('upstream_received_bytes_total', labels), received + 6)
+
+        # exposed in the prometheus text format
+        r = app.app.test_client().get('/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('upstream_calls_total{endpoint="starred",provider="github",status="200"}', r.get_data(as_text=True))
+
+    # test transport
+    def test_get_session(self):
+        session = transport.get_session()
+        other = util.run_in_pool(lambda _: transport.get_session(), [0, 1], max_workers=2)
+
+        # same session within a thread, separate sessions across threads, one shared connection pool
+        self.assertIs(session, transport.get_session())
+        self.assertNotIn(session, other)
+        self.assertIs(session.get_adapter('https://api.github.com'), other[0].get_adapter('https://api.bitbucket.org'))
+
+    def test_get_max_workers(self):
+        self.assertEqual(util.get_max_workers(), util.MAX_WORKERS)
+        self.assertEqual(util.get_max_workers('4'), 4)
+        self.assertEqual(util.get_max_workers(0), 1)
+        self.assertEqual(util.get_max_workers(10 ** 6), util.MAX_WORKERS_LIMIT)
+        self.assertRaises(ValueError, util.get_max_workers, 'many')
+
+    def test_run_in_pool(self):
+        # results come back in the order of the items
+        self.assertEqual(util.run_in_pool(lambda x: x * 2, range(50), max_workers=8), [x * 2 for x in range(50)])
+        self.assertEqual(util.run_in_pool(lambda x: x, [], max_workers=8), [])
+
+        # handed back as they come in order - never more than max_workers calls ahead of the consumer
+        started = []
+
+        def call(x):
+            started.append(x)
+            return x
+
+        results = util.iter_in_pool(call, range(20), max_workers=4)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(started), 5)
+        self.assertEqual(list(results), list(range(1, 20)))
+
+        # one pool for every call - nested calls past its threads run on the caller's thread instead of waiting
+        running = {'now': set(), 'most': 0}
+        lock = threading.Lock()
+
+        def leaf(y):
+            with lock:
+                running['now'].add(threading.get_ident())
+                running['most'] = max(running['most'], len(running['now']))
+            time.sleep(0.001)
+            with lock:
+                running['now'].discard(threading.get_ident())
+            return y
+
+        def nested(x):
+            return sum(util.run_in_pool(leaf, range(x), max_workers=8))
+
+        with mock.patch('util.pool', util.BoundedExecutor(2)):
+            self.assertEqual(util.run_in_pool(nested, range(10), max_workers=8), [sum(range(x)) for x in range(10)])
+
+        # two pool threads and the caller
+        self.assertLessEqual(running['most'], 3)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import observe_upstream
+from ratelimit import scheduler, RateLimitError
+from util import AUTH, GITHUB_API_URL, BITBUCKET_API_URL, HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, \
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, RATE_LIMIT_RETRIES
+
+# sent on every upstream call
+DEFAULT_HEADERS = {
+    'User-Agent': 'dd-git-profile-api',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive'
+}
+
+# credentials per upstream host - github auth is only for rate limiting, never send it anywhere else
+HOST_AUTH = {
+    urlsplit(GITHUB_API_URL).netloc: AUTH,
+    urlsplit(BITBUCKET_API_URL).netloc: None
+}
+
+# one adapter for the whole process - holds a keep-alive connection pool per host, urllib3 pools are thread safe
+adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+
+# sessions keep cookies/headers state which is not safe to share, so each thread gets its own session on the shared adapter
+local = threading.local()
+
+
+def get_session():
+    """
+    Get the calling thread's session - all sessions share the same connection pools
+    :return: requests session
+    """
+
+    session = getattr(local, 'session', None)
+
+    if session is None:
+        session = requests.Session()
+        session.headers.update(DEFAULT_HEADERS)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        local.session = session
+
+    return session
+
+
+def get_credential(auth):
+    """
+    Given the auth for a host get the name its quota is tracked under
+    :param auth: (user, password) or None
+    :return: user or None when anonymous
+    """
+
+    return auth[0] if auth else None
+
+
+def http_get(url, headers=None, timeout=None):
+    """
+    Given a url make a pooled, keep-alive GET request with the host's default auth - paced by the rate limit scheduler,
+    rate limited calls are retried after backing off
+    :param url: full url
+    :param headers: extra headers for this call
+    :param timeout: (connect, read) seconds, default is None meaning use HTTP_CONNECT_TIMEOUT & HTTP_READ_TIMEOUT
+    :return: response
+    """
+
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+    # auth based on the host being hit
+    host = urlsplit(url).netloc
+    auth = HOST_AUTH.get(host)
+    credential = get_credential(auth)
+
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+
+        # wait for quota - raises RateLimitError when it would take too long
+        scheduler.acquire(host, credential)
+
+        # counted per provider, logical endpoint and status - retries included
+        with observe_upstream(url) as call:
+            r = get_session().get(url, headers=headers, auth=auth, timeout=timeout)
+            call.record(r.status_code, len(r.content))
+
+        # record the quota left, back off and retry if rate limited
+        if not scheduler.update(host, credential, r.status_code, r.headers):
+            return r
+
+    raise RateLimitError("Rate limit for {} exhausted after {} retries".format(host, RATE_LIMIT_RETRIES))
@@ -1,10 +1,400 @@
+import contextvars
 import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from profiling import profiled
 
 # authenticate for more pings - GITHUB_USER & GITHUB_PASSWORD needed in env vars
 AUTH = (os.getenv('GITHUB_USER'), os.getenv('GITHUB_PASSWORD'))
 if AUTH == (None, None):
     AUTH = None
 
+# upstream api base urls
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+BITBUCKET_API_URL = os.getenv('BITBUCKET_API_URL', 'https://api.bitbucket.org/2.0/')
+
+# http connection pooling - number of hosts kept and keep-alive connections kept per host
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 32))
+
+# seconds to wait on upstream connect and read
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+
+# stats cache - seconds a result is kept per provider, seconds an error result is kept, and size bounds
+GITHUB_CACHE_TTL = float(os.getenv('GITHUB_CACHE_TTL', 300))
+BITBUCKET_CACHE_TTL = float(os.getenv('BITBUCKET_CACHE_TTL', 300))
+NEGATIVE_CACHE_TTL = float(os.getenv('NEGATIVE_CACHE_TTL', 30))
+STALE_CACHE_TTL = float(os.getenv('STALE_CACHE_TTL', 3600))
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 1024))
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# background refresh of hot users - seconds of requests counted, requests within them that make a user hot,
+# fraction of the ttl left when a hot user is refreshed, seconds between checks, refreshes at once and per minute
+HOT_WINDOW = float(os.getenv('HOT_WINDOW', 600))
+HOT_THRESHOLD = int(os.getenv('HOT_THRESHOLD', 3))
+REFRESH_AHEAD = float(os.getenv('REFRESH_AHEAD', 0.2))
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', 15))
+REFRESH_MAX_WORKERS = int(os.getenv('REFRESH_MAX_WORKERS', 2))
+REFRESH_BUDGET = int(os.getenv('REFRESH_BUDGET', 30))
+
+# admin routes (ex: /admin/warm) - off unless set, then only for requests sending it as a bearer token
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# max seconds a request waits on an identical request already in flight
+COALESCE_WAIT_TIMEOUT = float(os.getenv('COALESCE_WAIT_TIMEOUT', 120))
+
+# batch stats - max number of users per batch and provider pipelines run at once per batch
+BATCH_MAX_USERS = int(os.getenv('BATCH_MAX_USERS', 100))
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', 8))
+
+# github conditional request cache - max number of responses and approximate bytes kept
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 4096))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+
+# our own stats responses - serialized documents kept (json, gzip and brotli bytes), brotli quality (0-11)
+SERIALIZED_CACHE_MAX_ENTRIES = int(os.getenv('SERIALIZED_CACHE_MAX_ENTRIES', 1024))
+SERIALIZED_CACHE_MAX_BYTES = int(os.getenv('SERIALIZED_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+
+# per-repo stats store - sqlite database file, ':memory:' to not keep it across restarts
+REPO_STORE_PATH = os.getenv('REPO_STORE_PATH', 'repo_stats.db')
+
+# async routes - max number of upstream calls in flight per upstream host, every async request together
+ASYNC_HOST_CONCURRENCY = int(os.getenv('ASYNC_HOST_CONCURRENCY', 50))
+
+# upstream rate limiting - calls per second and burst per host and credential, max seconds a call waits for quota,
+# retries of a rate limited call, and fraction of the quota background calls leave for interactive ones
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', 20))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', 50))
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 30))
+RATE_LIMIT_RETRIES = int(os.getenv('RATE_LIMIT_RETRIES', 3))
+RATE_LIMIT_BACKGROUND_RESERVE = float(os.getenv('RATE_LIMIT_BACKGROUND_RESERVE', 0.2))
+
+# default number of upstream calls in flight per stats request - tune against the upstream rate limits
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 8))
+
+# hard ceiling on the per-request concurrency a caller can ask for
+MAX_WORKERS_LIMIT = int(os.getenv('MAX_WORKERS_LIMIT', 32))
+
+# max worker threads of every request together - past it a request's calls run one by one on its own thread
+POOL_MAX_WORKERS = int(os.getenv('POOL_MAX_WORKERS', 64))
+
+# seconds the merged route waits on each provider before giving up on it
+GITHUB_TIMEOUT = float(os.getenv('GITHUB_TIMEOUT', 120))
+BITBUCKET_TIMEOUT = float(os.getenv('BITBUCKET_TIMEOUT', 120))
+
+# max provider pipelines of merged requests running at once - timed out ones that are still finishing included
+PROVIDER_MAX_WORKERS = int(os.getenv('PROVIDER_MAX_WORKERS', 32))
+
+
+def is_truthy(value):
+    """
+    Given a query string value decide if the flag is on
+    :param value: query string value - ex: 1, true, yes
+    :return: bool
+    """
+
+    return value is not None and value.lower() in ['1', 'true', 'yes', 'on', '']
+
+
+def get_max_workers(requested=None):
+    """
+    Given a requested concurrency limit return a usable worker count
+    :param requested: requested number of workers (ex: from query string), default is None meaning use MAX_WORKERS
+    :return: worker count between 1 and MAX_WORKERS_LIMIT
+    """
+
+    # nothing requested - use the configured default
+    if requested is None:
+        return MAX_WORKERS
+
+    try:
+        workers = int(requested)
+    except (TypeError, ValueError):
+        raise ValueError("Incorrect worker count! Must be a number, got: {}".format(requested))
+
+    # keep it within bounds
+    return max(1, min(workers, MAX_WORKERS_LIMIT))
+
+
+class ProviderBusyError(RuntimeError):
+    """
+    Every provider slot is taken - the call was not started
+    """
+    pass
+
+
+class BoundedExecutor(object):
+    """
+    Runs each task on its own daemon thread, at most max_workers at once - tasks nobody waits on anymore (ex: timed out)
+    keep their slot until they finish, a new task is never queued behind them: it is refused right away instead
+    """
+
+    def __init__(self, max_workers, name='provider'):
+        """
+        :param max_workers: max number of tasks running at once
+        :param name: what the tasks are, used in the busy message
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self.slots = threading.BoundedSemaphore(max_workers)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Given a function start it on its own thread
+        :param func: function
+        :return: future holding its result - raises ProviderBusyError when every slot is taken
+        """
+
+        if not self.slots.acquire(blocking=False):
+            message = "Too many {} calls in flight ({}), try again later".format(self.name, self.max_workers)
+            raise ProviderBusyError(message)
+
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self.slots.release()
+
+        threading.Thread(target=run, daemon=True).start()
+
+        return future
+
+
+# worker threads shared by every run_in_pool/iter_in_pool call - bounded for the whole process
+pool = BoundedExecutor(max_workers=POOL_MAX_WORKERS, name='pooled')
+
+
+def submit_to_pool(func, item):
+    """
+    Given a function and an item call it on a shared pool thread in a copy of the caller's context - on the caller's
+    thread if every pool thread is taken, so nested pooled calls never wait on each other
+    :param func: function taking a single item
+    :param item: item
+    :return: future holding the result
+    """
+
+    try:
+        return pool.submit(contextvars.copy_context().run, func, item)
+
+    except ProviderBusyError:
+        future = Future()
+
+        try:
+            future.set_result(func(item))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+def run_in_pool(func, items, max_workers=None):
+    """
+    Given a function and a list of items call the function on every item with bounded concurrency
+    :param func: function taking a single item
+    :param items: list of items
+    :param max_workers: max number of calls in flight, default is None meaning use MAX_WORKERS
+    :return: list of results in the same order as items
+    """
+
+    return list(iter_in_pool(func, items, max_workers))
+
+
+def iter_in_pool(func, items, max_workers=None):
+    """
+    Given a function and a list of items call the function on every item with bounded concurrency, handing back each
+    result as soon as it is next in order - at most max_workers results are held at once
+    :param func: function taking a single item
+    :param items: list of items
+    :param max_workers: max number of calls in flight, default is None meaning use MAX_WORKERS
+    :return: generator of results in the same order as items
+    """
+
+    items = list(items)
+
+    # nothing to do
+    if not items:
+        return
+
+    workers = min(get_max_workers(max_workers), len(items))
+
+    # single worker - no need for threads
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # at most workers calls of this request on the shared pool - a new call starts as each result is handed back
+    futures = deque()
+
+    for item in items:
+        futures.append(submit_to_pool(func, item))
+
+        if len(futures) == workers:
+            yield futures.popleft().result()
+
+    while futures:
+        yield futures.popleft().result()
+
+
+def call_safely(task):
+    """
+    Given a task call it, hand back the error instead of raising it
+    :param task: function taking no arguments
+    :return: result, error - one of them is None
+    """
+
+    try:
+        return task(), None
+    except Exception as e:
+        return None, e
+
+
+def run_tasks(tasks, max_workers=None):
+    """
+    Given a list of independent tasks run them all with bounded concurrency, a failed task does not stop the rest
+    :param tasks: list of functions taking no arguments
+    :param max_workers: max number of tasks in flight, default is None meaning use MAX_WORKERS
+    :return: list of (result, error) in the same order as the tasks
+    """
+
+    return run_in_pool(call_safely, tasks, max_workers)
+
+
+def parse_link_header(link_str):
+    """
+    Given a Link header string parse out the url per rel - ex: '<https://...?page=2>; rel="next", <...>; rel="last"'
+    :param link_str: Link string from request header
+    :return: dict of rel -> url ex: {'next': 'https://...?page=2', 'last': ...}
+    """
+
+    links = {}
+
+    # nothing to parse
+    if not link_str:
+        return links
+
+    # each link is <url> followed by its ; separated params
+    for url, params in re.findall(r'<([^>]*)>([^<]*)', link_str):
+        rel = re.search(r'rel\s*=\s*"?([^";,]+)"?', params)
+
+        # a link can have more than one rel - ex: rel="last first"
+        if rel:
+            for name in rel.group(1).split():
+                links[name] = url
+
+    return links
+
+
+def get_query_param(url, name):
+    """
+    Given a url get the value of a query string param
+    :param url: url or path
+    :param name: query string param name
+    :return: value or None if not in the url
+    """
+
+    return dict(parse_qsl(urlsplit(url).query)).get(name)
+
+
+def set_query_params(url, **params):
+    """
+    Given a url add or replace query string params
+    :param url: url or path
+    :param params: params to set - ex: page=2, per_page=100
+    :return: url with the params set
+    """
+
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.update(params)
+
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+
+def collect_stats(stats, keys):
+    """
+    Given (stat, value) pairs build the stats json in the reported order
+    :param stats: iterable of (stat, value)
+    :param keys: stats in the order they are reported - anything else (ex: message) goes after
+    :return: stats json
+    """
+
+    stats = dict(stats)
+
+    result = {key: stats.pop(key) for key in keys if key in stats}
+    result.update(stats)
+
+    return result
+
+
+def select_stats(stats, fields):
+    """
+    Given whole stats json keep only the requested stats - a message or failed repos are always kept
+    :param stats: stats json
+    :param fields: stats wanted, default is None meaning all of them
+    :return: stats json
+    """
+
+    if fields is None:
+        return stats
+
+    return {key: value for key, value in stats.items() if key in fields or key in ['message', 'failed_repos']}
+
+
+class LazyStats(object):
+    """
+    Stats and the intermediate values they need, each computed by its producer the first time it is asked for
+    """
+
+    def __init__(self, producers):
+        """
+        :param producers: name -> function taking the lazy stats (to ask for the values it needs) returning the value
+        """
+        self.producers = producers
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            self.values[name] = self.producers[name](self)
+
+        return self.values[name]
+
+    def computed(self, name):
+        """
+        Given a name check if its value was asked for already
+        :param name: stat or intermediate value
+        :return: bool
+        """
+
+        return name in self.values
+
+    def prefetch(self, names, max_workers=None):
+        """
+        Given independent names compute the ones not computed yet at the same time - what they need must be computed already
+        :param names: stats or intermediate values
+        :param max_workers: max number of producers running at once, default is None meaning use MAX_WORKERS
+        """
+
+        names = [name for name in names if name not in self.values]
+
+        for name, (value, error) in zip(names, run_tasks([partial(self.producers[name], self) for name in names],
+                                                         max_workers)):
+            if error:
+                raise error
+
+            self.values[name] = value
+
 
 def flatten_list(nested_list):
     """
@@ -22,22 +412,6 @@ def flatten_list(nested_list):
     return flat_list
 
 
-def flatten_list_of_dicts(nested_list):
-    """
-    Flatten a list of dictionaries ex: [{k1:v1, k2:v2}, {k3:v3}]
-    :param nested_list: nested list
-    :return: list of [{k1:v1}, {k2:v2} {k1:v1}]
-    """
-
-    agg_dict_list = []
-
-    for dict_obj in nested_list:
-        for key, value in dict_obj.items():
-            agg_dict_list.append({key:value})
-
-    return agg_dict_list
-
-
 def aggregate_list_of_dicts(list_of_dicts):
     """
     Given a list of single dictionaries: [{k1:v1}, {k2:v2} {k1:v1}] get unique counts/aggregate
@@ -49,7 +423,7 @@ def aggregate_list_of_dicts(list_of_dicts):
 
     for dict_obj in list_of_dicts:
         for key, value in dict_obj.items():
-            if key not in agg.keys():
+            if key not in agg:
                 agg[key] = value
             else:
                 agg[key] += value
@@ -103,6 +477,7 @@ def get_specific_count_to_sum(list_of_json, key_of_interest):
     return sum(to_sum)
 
 
+@profiled
 def aggregate_git_accounts(github_data, bitbucket_data):
     """
     Merge/aggregate github_data and bitbucket_data
@@ -117,6 +492,10 @@ def aggregate_git_accounts(github_data, bitbucket_data):
 
     # iter thru github result keys - github has all of the desired keys
     for key in gh_results.keys():
+        # repos that failed are listed per provider below
+        if key == 'failed_repos':
+            continue
+
         # when key is not user
         if key not in ['user']:
 
@@ -126,13 +505,8 @@ def aggregate_git_accounts(github_data, bitbucket_data):
                 if type(gh_results[key]) == int:
                     result[key] = gh_results[key] + bb_results[key]
 
-                else: # not int, dict - aggregate the counts
-                    # make into list of dicts
-                    non_int_agg_list = [gh_results[key]] + [bb_results[key]]
-                    # flatten list of dicts
-                    flattened_list = flatten_list_of_dicts(non_int_agg_list)
-                    # aggregate list of dicts
-                    result[key] = aggregate_list_of_dicts(flattened_list)
+                else: # not int, dict - aggregate the counts, one dict merged into a copy of the other
+                    result[key] = aggregate_list_of_dicts([gh_results[key], bb_results[key]])
             else:
                 result[key] = gh_results[key]
 
@@ -142,4 +516,44 @@ def aggregate_git_accounts(github_data, bitbucket_data):
                 'bitbucket': bb_results[key]
             }
 
-    return result
\ No newline at end of file
+    # repos whose stats could not be fetched - per provider, only when some did
+    providers = [('github', gh_results), ('bitbucket', bb_results)]
+    failed_repos = {provider: data['failed_repos'] for provider, data in providers if data.get('failed_repos')}
+    if failed_repos:
+        result['failed_repos'] = failed_repos
+
+    return result
+
+
+def merge_provider_stats(gh_data, bb_data):
+    """
+    Given github and bitbucket stats aggregate them, or explain which user could not be aggregated
+    :param gh_data: github stats
+    :param bb_data: bitbucket stats
+    :return: aggregated stats or message
+    """
+
+    if 'message' not in gh_data.keys() and 'message' not in bb_data.keys():
+        # aggregate stats - github & bitbucket
+        result = {
+            'data': aggregate_git_accounts(gh_data, bb_data)
+        }
+
+    elif 'message' in gh_data.keys() and 'message' not in bb_data.keys():
+        result = {
+            'message': "Check Github user, could not aggregate with Bitbucket user",
+            'bitbucket_data': bb_data
+        }
+
+    elif 'message' in bb_data.keys() and 'message' not in gh_data.keys():
+        result = {
+            'message': "Check Bitbucket user, could not aggregate with Github user",
+            'github_data': gh_data
+        }
+
+    else:
+        result = {
+            'messsage': "Check Github and Bitbucket user, could not aggregate the users"
+        }
+
+    return result